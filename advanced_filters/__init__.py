@@ -1 +1,3 @@
 __version__ = '1.1.1'
+
+default_app_config = 'advanced_filters.apps.AdvancedFiltersConfig'
@@ -16,6 +16,11 @@ from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
+from .cache import track_model_changes
+from .changelist import EstimatedCountChangeList, KeysetChangeList
+from .compiler import related_models
+from .counts import count_filters
+from .field_tree import FieldTree
 from .forms import AdvancedFilterForm
 from .models import AdvancedFilter
 
@@ -54,8 +59,25 @@ class AdvancedListFilters(admin.SimpleListFilter):
                             'model_admin')
         model_name = "%s.%s" % (model_admin.model._meta.app_label,
                                 model_admin.model._meta.object_name)
-        return AdvancedFilter.objects.filter_by_user(request.user).filter(
-            model=model_name).values_list('id', 'title', 'heading')
+        filters = AdvancedFilter.objects.filter_by_user(request.user).filter(
+            model=model_name)
+        if not getattr(model_admin, 'advanced_filter_show_counts', False):
+            return filters.values_list('id', 'title', 'heading')
+        filters = list(filters)
+        counts = count_filters(
+            [f for f in filters if not f.heading],
+            model_admin.get_queryset(request))
+        return [
+            (f.id, self._title_with_count(f.title, counts.get(f.id)),
+             f.heading)
+            for f in filters
+        ]
+
+    @staticmethod
+    def _title_with_count(title, count):
+        if count is None:
+            return title
+        return '%s (%s)' % (title, count)
 
     def queryset(self, request, queryset):
         if self.value():
@@ -84,6 +106,19 @@ class AdminAdvancedFiltersMixin(object):
     """ Generic AdvancedFilters mixin """
     advanced_change_list_template = "admin/advanced_filters.html"
     advanced_filter_fields = ()
+    # with advanced_filter_fields = '__all__': additional field paths,
+    # excluded paths (fnmatch patterns) and the number of relations the
+    # field selector may follow
+    advanced_filter_fields_include = ()
+    advanced_filter_fields_exclude = ()
+    advanced_filter_max_depth = 1
+    # display the number of matching rows next to each stored filter
+    advanced_filter_show_counts = False
+    # paginate by seeking on a unique column when a filter is applied
+    advanced_filter_keyset_pagination = False
+    advanced_filter_keyset_field = 'pk'
+    # count filtered results exactly only up to this number of rows
+    advanced_filter_count_threshold = None
 
     @property
     def media(self):
@@ -106,6 +141,32 @@ class AdminAdvancedFiltersMixin(object):
         self.change_list_template = self.advanced_change_list_template
         # add list filters to filters
         self.list_filter = (AdvancedListFilters,) + tuple(self.list_filter)
+        # cached filter results depend on the models these fields read; the
+        # deeper paths of '__all__' are tracked once a filter using them is
+        # evaluated, rather than walking the whole relation graph here
+        tree = FieldTree.for_admin(self)
+        if tree is not None:
+            paths = [path for path, _ in tree.fields()]
+        else:
+            paths = self.get_advanced_filter_paths()
+        track_model_changes(related_models(self.model, paths))
+
+    def get_advanced_filter_paths(self):
+        """ The field paths filters of this ModelAdmin may use """
+        tree = FieldTree.for_admin(self)
+        if tree is not None:
+            return tree.paths()
+        return [f[0] if isinstance(f, (list, tuple)) else f
+                for f in self.advanced_filter_fields]
+
+    def get_changelist(self, request, **kwargs):
+        if request.GET.get(AdvancedListFilters.parameter_name):
+            if self.advanced_filter_keyset_pagination:
+                return KeysetChangeList
+            if self.advanced_filter_count_threshold is not None:
+                return EstimatedCountChangeList
+        return super(AdminAdvancedFiltersMixin, self).get_changelist(
+            request, **kwargs)
 
     def changelist_view(self, request, extra_context=None):
         """Add advanced_filters form to changelist context"""
@@ -129,7 +190,7 @@ class AdvancedFilterAdmin(SortableAdminMixin, admin.ModelAdmin):
     form = AdvancedFilterForm
     extra = 0
 
-    list_display = ('title', 'model_link', 'heading',)
+    list_display = ('title', 'model_link', 'heading', 'export_links',)
     list_filter = ('model_name',)
     search_fields = ('model_name', 'title',)
     readonly_fields = ('model_link', 'usage_links', 'edit_link',)
@@ -137,6 +198,7 @@ class AdvancedFilterAdmin(SortableAdminMixin, admin.ModelAdmin):
     fields = (
         'title',
         'heading',
+        'materialized',
         'model_link',
         'usage_links',
     )
@@ -170,6 +232,15 @@ class AdvancedFilterAdmin(SortableAdminMixin, admin.ModelAdmin):
     model_link.short_description = 'model'
     model_link.admin_order_field = 'model_name'
 
+    def export_links(self, obj):
+        if obj.heading or not obj.pk:
+            return ''
+        path = reverse('afilters_export', args=(obj.pk,))
+        return format_html(
+            '<a href="{0}?format=csv">CSV</a> | '
+            '<a href="{0}?format=jsonl">JSONL</a>', path)
+    export_links.short_description = _('Export')
+
     def usage_links(self, obj):
         if not obj or not obj.id:
             return '(new)'
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+from django.utils.translation import ugettext_lazy as _
+
+
+class AdvancedFiltersConfig(AppConfig):
+    name = 'advanced_filters'
+    verbose_name = _('Advanced Filters')
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,237 @@
+"""In-process caches used by advanced_filters."""
+from collections import OrderedDict
+from copy import deepcopy
+import hashlib
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .q_serializer import QSerializer
+
+
+class LRUCache(object):
+    """
+    A thread-safe, bounded, least-recently-used mapping which keeps
+    hit/miss/eviction counters.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.set('a', 1); cache.set('b', 2); cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 1,
+    ...                   'size': 2, 'maxsize': 2}
+    True
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class HitCounter(object):
+    """
+    Thread-safe hit/miss counters, for caches that are not an LRUCache.
+
+    >>> counter = HitCounter()
+    >>> counter.hit(); counter.miss(); counter.miss()
+    >>> counter.stats() == {'hits': 1, 'misses': 2}
+    True
+    """
+    def __init__(self):
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def clear(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def query_digest(b64_query):
+    """ A stable digest of a stored (serialized) query """
+    return hashlib.sha1(b64_query.encode('utf-8')).hexdigest()
+
+
+query_cache = LRUCache(
+    maxsize=getattr(settings, 'ADVANCED_FILTERS_QUERY_CACHE_SIZE', 256))
+sql_cache = LRUCache(
+    maxsize=getattr(settings, 'ADVANCED_FILTERS_SQL_CACHE_SIZE', 256))
+# lookups of GetFieldChoices lists in the django cache
+choices_stats = HitCounter()
+
+
+def _load(b64_query):
+    key = query_digest(b64_query)
+    entry = query_cache.get(key)
+    if entry is None:
+        s = QSerializer(base64=True)
+        entry = (s.decode(b64_query, raw=True), s.decode(b64_query))
+        query_cache.set(key, entry)
+    return entry
+
+
+def load_query(b64_query):
+    """ Return a (private copy of the) Q object stored in b64_query """
+    # deserialize() builds a new tree without modifying the cached dict
+    return QSerializer().deserialize(_load(b64_query)[1])
+
+
+def load_raw_query(b64_query):
+    """ Return a (private copy of the) raw dict stored in b64_query """
+    return deepcopy(_load(b64_query)[0])
+
+
+MODEL_VERSION_KEY = 'advanced_filters:version:%s'
+
+
+def _initial_version():
+    # a fresh, time based version makes sure an evicted counter can not
+    # restart at a value that was already used for cached results
+    return int(time.time() * 1000)
+
+
+def _version_models(model):
+    """
+    The models whose versions cover the rows of ``model``: its concrete
+    model and the (multi-table inheritance) parents it inherits fields from.
+    """
+    concrete = model._meta.concrete_model
+    return [concrete] + concrete._meta.get_parent_list()
+
+
+def bump_model_version(model):
+    """ Mark the data of ``model`` (and of its parents) as changed """
+    for changed in _version_models(model):
+        key = MODEL_VERSION_KEY % changed._meta.label_lower
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), None)
+
+
+def get_model_versions(models):
+    """
+    Return the current data version of each of the given models (and of
+    their parents), tracking changes to them from now on.
+    """
+    track_model_changes(models)
+    keys = dict((MODEL_VERSION_KEY % m._meta.label_lower, m)
+                for model in models for m in _version_models(model))
+    versions = cache.get_many(list(keys))
+    if len(versions) < len(keys):
+        for key in keys:
+            if key not in versions:
+                cache.add(key, _initial_version(), None)
+        versions = cache.get_many(list(keys))
+    return sorted((keys[k]._meta.label_lower, v) for k, v in versions.items())
+
+
+def model_changed(sender, **kwargs):
+    bump_model_version(sender)
+
+
+def m2m_relation_changed(sender, instance, model, action, **kwargs):
+    if action.startswith('pre_'):
+        return
+    for changed in (sender, type(instance), model):
+        bump_model_version(changed)
+
+
+# concrete models whose versions are bumped by the receivers above
+_tracked = set()
+
+
+def _connect(sender):
+    post_save.connect(model_changed, sender=sender)
+    post_delete.connect(model_changed, sender=sender)
+    m2m_changed.connect(m2m_relation_changed, sender=sender)
+
+
+def track_model_changes(models):
+    """
+    Bump the versions of ``models`` whenever one of their rows is saved or
+    deleted (through the model itself, a proxy or a multi-table child) and
+    when their many-to-many relations change.
+
+    The receivers are connected for these models only: models with
+    post_delete receivers can not be deleted in bulk anymore. Nothing is
+    connected with ADVANCED_FILTERS_TRACK_MODEL_CHANGES = False.
+    """
+    if not getattr(settings, 'ADVANCED_FILTERS_TRACK_MODEL_CHANGES', True):
+        return
+    targets = set()
+    for model in models:
+        targets.update(_version_models(model))
+    targets.difference_update(_tracked)
+    if not targets:
+        return
+    targets = tuple(targets)
+    for sender in apps.get_models(include_auto_created=True):
+        if issubclass(sender, targets):
+            _connect(sender)
+    _tracked.update(targets)
+
+
+def track_new_model(sender):
+    """ Track a model prepared late, i.e a proxy of a tracked model """
+    if _tracked and issubclass(sender, tuple(_tracked)):
+        _connect(sender)
@@ -0,0 +1,193 @@
+"""ChangeList variants used by AdminAdvancedFiltersMixin."""
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import (ALL_VAR, ORDER_VAR, PAGE_VAR,
+                                             ChangeList)
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.utils.formats import number_format
+
+from .counts import estimate_count
+
+AFTER_VAR = '_after'
+BEFORE_VAR = '_before'
+
+
+class KeysetChangeList(ChangeList):
+    """
+    A ChangeList paginating by "seeking" on a unique, indexed column
+    (the primary key by default) instead of using OFFSET, with next/previous
+    cursors passed in the query string. The full COUNT(*) is skipped.
+
+    Falls back to the default pagination when the user sorts by a column
+    or asks to show all results.
+    """
+    keyset_params = (AFTER_VAR, BEFORE_VAR)
+
+    def __init__(self, request, *args, **kwargs):
+        self.keyset_pagination = (ORDER_VAR not in request.GET and
+                                  ALL_VAR not in request.GET)
+        self.cursor_after = request.GET.get(AFTER_VAR)
+        self.cursor_before = request.GET.get(BEFORE_VAR)
+        self.next_cursor = self.previous_cursor = None
+        super(KeysetChangeList, self).__init__(request, *args, **kwargs)
+
+    @property
+    def keyset_field(self):
+        return getattr(self.model_admin, 'advanced_filter_keyset_field', 'pk')
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(KeysetChangeList, self).get_filters_params(
+            params)
+        for param in self.keyset_params:
+            lookup_params.pop(param, None)
+        return lookup_params
+
+    def get_ordering(self, request, queryset):
+        if not self.keyset_pagination:
+            return super(KeysetChangeList, self).get_ordering(
+                request, queryset)
+        return [self.keyset_field]
+
+    def _cursor(self, value):
+        """ A cursor of the query string as a value of the keyset field """
+        if value is None:
+            return None
+        if self.keyset_field == 'pk':
+            field = self.opts.pk
+        else:
+            field = self.opts.get_field(self.keyset_field)
+        try:
+            return field.to_python(value)
+        except ValidationError:
+            raise IncorrectLookupParameters
+
+    def _key(self, obj):
+        if self.keyset_field == 'pk':
+            return obj.pk
+        return getattr(obj, self.opts.get_field(self.keyset_field).attname)
+
+    def get_results(self, request):
+        if not self.keyset_pagination:
+            return super(KeysetChangeList, self).get_results(request)
+
+        per_page = self.list_per_page
+        key = self.keyset_field
+        queryset = self.queryset
+        cursor_after = self._cursor(self.cursor_after)
+        cursor_before = self._cursor(self.cursor_before)
+        if cursor_before is not None:
+            queryset = queryset.filter(**{key + '__lt': cursor_before})
+            rows = list(queryset.order_by('-' + key)[:per_page + 1])
+            has_previous = len(rows) > per_page
+            rows = rows[:per_page][::-1]
+            has_next = True
+        else:
+            if cursor_after is not None:
+                queryset = queryset.filter(**{key + '__gt': cursor_after})
+            rows = list(queryset[:per_page + 1])
+            has_next = len(rows) > per_page
+            rows = rows[:per_page]
+            has_previous = cursor_after is not None
+
+        if rows and has_previous:
+            self.previous_cursor = self._key(rows[0])
+        if rows and has_next:
+            self.next_cursor = self._key(rows[-1])
+
+        self.result_count = len(rows)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = has_next or has_previous
+        self.paginator = None
+
+    @property
+    def next_url(self):
+        if self.next_cursor is None:
+            return None
+        return self.get_query_string(
+            {AFTER_VAR: self.next_cursor}, [BEFORE_VAR])
+
+    @property
+    def previous_url(self):
+        if self.previous_cursor is None:
+            return None
+        return self.get_query_string(
+            {BEFORE_VAR: self.previous_cursor}, [AFTER_VAR])
+
+
+class EstimatedCountChangeList(ChangeList):
+    """
+    A ChangeList which counts the filtered results exactly only up to the
+    ModelAdmin's ``advanced_filter_count_threshold``; above it, an estimate
+    is used for pagination and the full (unfiltered) count is skipped.
+    """
+    count_is_estimate = False
+
+    def get_results(self, request):
+        threshold = self.model_admin.advanced_filter_count_threshold
+        result_count, exact = estimate_count(self.queryset, threshold)
+        paginator = self.model_admin.get_paginator(
+            request, self.queryset, self.list_per_page)
+        # use the (estimated) count instead of running COUNT(*), allowing
+        # to page past an estimate that turns out to be too low
+        paginator.count = result_count if exact else max(
+            result_count, (self.page_num + 2) * self.list_per_page)
+
+        show_full_result_count = (exact and
+                                  self.model_admin.show_full_result_count)
+        if show_full_result_count:
+            full_result_count = self.root_queryset.count()
+        else:
+            full_result_count = None
+        can_show_all = exact and result_count <= self.list_max_show_all
+        # an estimate may be far below the real count: always paginate it
+        multi_page = not exact or result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.queryset._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.count_is_estimate = not exact
+        self.result_count = result_count
+        self.show_full_result_count = show_full_result_count
+        self.show_admin_actions = (not show_full_result_count or
+                                   bool(full_result_count))
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+    @property
+    def result_count_display(self):
+        count = number_format(self.result_count, force_grouping=True)
+        if not self.count_is_estimate:
+            return count
+        threshold = self.model_admin.advanced_filter_count_threshold
+        if self.result_count == threshold:
+            return '%s+' % count  # capped count
+        return '~%s' % count  # planner estimate
+
+    @property
+    def previous_page_url(self):
+        if self.page_num <= 0:
+            return None
+        return self.get_query_string({PAGE_VAR: self.page_num - 1})
+
+    @property
+    def next_page_url(self):
+        if self.count_is_estimate:
+            has_next = len(self.result_list) >= self.list_per_page
+        else:
+            has_next = (self.page_num + 1) * self.list_per_page < \
+                self.result_count
+        if not has_next:
+            return None
+        return self.get_query_string({PAGE_VAR: self.page_num + 1})
@@ -0,0 +1,216 @@
+"""
+Compile a (deserialized) Q tree of an AdvancedFilter into a queryset.
+
+Conditions which only follow forward (many-to-one / one-to-one) relations
+are applied in a single ``filter()`` call, while conditions that traverse a
+multi-valued relation (reverse foreign keys and many-to-many) are compiled
+into correlated ``Exists()`` subqueries. As a result the outer query never
+joins a multi-valued relation and no ``distinct()`` is required.
+"""
+from functools import reduce
+import logging
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Exists, Field, OuterRef, Q, QuerySet
+from django.db.models.constants import LOOKUP_SEP
+
+
+logger = logging.getLogger('advanced_filters.compiler')
+
+
+def resolve_lookup(model, lookup):
+    """
+    Split an ORM lookup string (i.e "assigned_to__email__iexact") into the
+    list of fields it traverses and the remaining lookup/transform parts.
+
+    >>> from django.contrib.auth.models import Group
+    >>> fields, lookups = resolve_lookup(Group, 'name__iexact')
+    >>> [f.name for f in fields], lookups
+    (['name'], ['iexact'])
+
+    Raises FieldDoesNotExist if the first part of the lookup is not a field.
+    """
+    fields = []
+    parts = lookup.split(LOOKUP_SEP)
+    opts = model._meta
+    for i, part in enumerate(parts):
+        if opts is None:
+            return fields, parts[i:]
+        if part == 'pk':
+            part = opts.pk.name
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            if not fields:
+                raise
+            return fields, parts[i:]
+        fields.append(field)
+        if field.is_relation and field.related_model is not None:
+            opts = field.related_model._meta
+        else:
+            opts = None
+    return fields, []
+
+
+def is_multivalued(fields):
+    """ Whether a resolved path traverses a to-many relation """
+    return any(f.many_to_many or f.one_to_many for f in fields)
+
+
+def iter_lookups(query):
+    """ Yield all (lookup, value) tuples contained in a Q tree """
+    stack = [query]
+    while stack:
+        node = stack.pop()
+        for child in node.children:
+            if isinstance(child, Q):
+                stack.append(child)
+            else:
+                yield child[0], child[1]
+
+
+def referenced_paths(model, query):
+    """
+    Return the set of field paths a Q tree references, without lookups and
+    transforms, including the relations leading to them:
+
+    >>> from django.contrib.auth.models import User
+    >>> sorted(referenced_paths(User, Q(groups__name__iexact='staff')))
+    ['groups', 'groups__name']
+
+    Lookups on fields the model does not have (anymore) are kept as they
+    were stored, less a trailing lookup name.
+    """
+    paths = set()
+    for lookup, _ in iter_lookups(query):
+        try:
+            fields, _ = resolve_lookup(model, lookup)
+            parts = [f.name for f in fields]
+        except FieldDoesNotExist:
+            parts = lookup.split(LOOKUP_SEP)
+            if len(parts) > 1 and parts[-1] in Field.get_lookups():
+                parts = parts[:-1]
+        for i in range(1, len(parts) + 1):
+            paths.add(LOOKUP_SEP.join(parts[:i]))
+    return paths
+
+
+def related_models(model, lookups):
+    """
+    Return the set of models whose data may affect the given lookups of
+    ``model``: the model itself, every model on the lookups' paths and the
+    through models of many-to-many relations.
+
+    >>> from django.contrib.auth.models import Group, Permission
+    >>> related_models(Group, ['permissions__name']) == {
+    ...     Group, Permission, Group.permissions.through}
+    True
+    """
+    related = {model}
+    for lookup in lookups:
+        try:
+            fields, _ = resolve_lookup(model, lookup)
+        except FieldDoesNotExist:
+            continue
+        for field in fields:
+            if field.related_model is not None:
+                related.add(field.related_model)
+            through = getattr(field, 'through', None) or getattr(
+                field.remote_field, 'through', None)
+            if through is not None:
+                related.add(through)
+    return related
+
+
+def _spans_multivalued(model, query):
+    for lookup, _ in iter_lookups(query):
+        try:
+            fields, _ = resolve_lookup(model, lookup)
+        except FieldDoesNotExist:
+            # keep the per-condition join semantics for unknown paths
+            return True
+        if is_multivalued(fields):
+            return True
+    return False
+
+
+class CompiledFilter(object):
+    """
+    The result of compiling a Q tree against a model: a list of Q
+    conditions and the Exists() annotations those conditions refer to.
+    """
+    def __init__(self, model, conditions=(), annotations=None):
+        self.model = model
+        self.conditions = list(conditions)
+        self.annotations = annotations or {}
+
+    @property
+    def condition(self):
+        """ All conditions reduced into a single Q object """
+        return Q(*self.conditions)
+
+    def apply(self, queryset):
+        if self.annotations:
+            queryset = queryset.annotate(**self.annotations)
+        return queryset.filter(*self.conditions)
+
+
+def compile_query(model, query, prefix='_afilter', correlated=True,
+                  using=None):
+    """
+    Compile ``query`` into a CompiledFilter for ``model``.
+
+    The top-level AND-ed children are inspected one by one (matching the
+    semantics of applying each of them in a separate filter() call). Any
+    other top-level node (OR / negated) is compiled as a single unit.
+
+    Pass correlated=False to express multi-valued units as
+    ``pk IN (subquery)`` conditions instead of Exists() annotations, i.e.
+    when the condition is used inside an aggregate.
+
+    Subqueries use the base manager (on the ``using`` database), so rows
+    hidden by a filtering default manager still match when the outer
+    queryset includes them.
+    """
+    if query.connector == Q.AND and not query.negated:
+        units = [c if isinstance(c, Q) else Q(c) for c in query.children]
+    else:
+        units = [query]
+
+    manager = model._base_manager.db_manager(using)
+    conditions = []
+    annotations = {}
+    for unit in units:
+        if not _spans_multivalued(model, unit):
+            conditions.append(unit)
+            continue
+        if not correlated:
+            subquery = manager.filter(unit).order_by()
+            conditions.append(Q(pk__in=subquery.values('pk')))
+            continue
+        alias = '%s_exists_%d' % (prefix, len(annotations))
+        subquery = manager.filter(
+            unit, pk=OuterRef('pk')).order_by().values('pk')
+        annotations[alias] = Exists(subquery)
+        conditions.append(Q(**{alias: True}))
+    return CompiledFilter(model, conditions, annotations)
+
+
+def legacy_filter_queryset(queryset, query):
+    """ Pre-compiler semantics: chained filter() per child + distinct() """
+    qs = [queryset.filter(child) for child in query.children]
+    return reduce(QuerySet.__and__, qs).distinct()
+
+
+def filter_queryset(queryset, query):
+    """
+    Apply ``query`` to ``queryset``; set ADVANCED_FILTERS_LEGACY_FILTERING
+    to keep the previous filter() + distinct() behaviour.
+    """
+    if getattr(settings, 'ADVANCED_FILTERS_LEGACY_FILTERING', False):
+        return legacy_filter_queryset(queryset, query)
+    compiled = compile_query(queryset.model, query, using=queryset.db)
+    logger.debug('Compiled filter: %s (%d subqueries)',
+                 compiled.conditions, len(compiled.annotations))
+    return compiled.apply(queryset)
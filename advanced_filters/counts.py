@@ -0,0 +1,194 @@
+"""
+Count the results of several advanced filters at once, and estimate
+counts where an exact one would be too expensive.
+"""
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldError
+from django.db import DatabaseError, connections
+from django.db.models import Count
+
+from .compiler import compile_query
+
+logger = logging.getLogger('advanced_filters.counts')
+
+
+def _count_one(advfilter, queryset):
+    try:
+        return advfilter.filter_queryset(queryset).count()
+    except (FieldError, DatabaseError, ValueError) as e:
+        logger.warning('Unable to count results of filter %s: %s',
+                       advfilter.pk, e)
+        return None
+
+
+def _aggregate_counts(filters, queryset):
+    """
+    Count all given filters in one query using conditional aggregation,
+    returns the counts by filter id and the filters that could not be
+    compiled into the aggregation.
+    """
+    aggregates = {}
+    fallback = []
+    for advfilter in filters:
+        try:
+            compiled = compile_query(queryset.model, advfilter.query,
+                                     correlated=False, using=queryset.db)
+        except (FieldError, ValueError) as e:
+            logger.debug('Filter %s cannot be aggregated: %s',
+                         advfilter.pk, e)
+            fallback.append(advfilter)
+            continue
+        aggregates['_afilter%d_count' % advfilter.pk] = Count(
+            'pk', filter=compiled.condition)
+    counts = {}
+    if aggregates:
+        try:
+            result = queryset.aggregate(**aggregates)
+        except (FieldError, DatabaseError, ValueError) as e:
+            logger.debug('Aggregated count failed, counting separately: %s', e)
+            return {}, list(filters)
+        counts = dict((int(k[len('_afilter'):-len('_count')]), v)
+                      for k, v in result.items())
+    return counts, fallback
+
+
+def _cache_key(filters, queryset):
+    signature = ','.join('%s:%s' % (f.pk, f.b64_query) for f in filters)
+    signature += str(queryset.query)
+    digest = hashlib.sha1(signature.encode('utf-8')).hexdigest()
+    return 'advanced_filters:counts:%s:%s:%s' % (
+        queryset.model._meta.label_lower, queryset.db, digest)
+
+
+def count_filters(filters, queryset):
+    """
+    Return a dict of {filter id: number of matching rows in queryset} for
+    the given AdvancedFilter instances.
+
+    All filters are counted in a single aggregate query where possible,
+    filters that cannot be expressed that way are counted one by one.
+    Results are cached for ADVANCED_FILTERS_COUNTS_TIMEOUT seconds (60 by
+    default) in the default cache.
+    """
+    filters = [f for f in filters if f.b64_query]
+    if not filters:
+        return {}
+    timeout = getattr(settings, 'ADVANCED_FILTERS_COUNTS_TIMEOUT', 60)
+    try:
+        key = _cache_key(filters, queryset)
+    except EmptyResultSet:  # i.e .none(), which matches no rows
+        return dict((f.pk, 0) for f in filters)
+    counts = cache.get(key) if timeout else None
+    if counts is not None:
+        return counts
+
+    counts, fallback = _aggregate_counts(filters, queryset)
+    for advfilter in fallback:
+        counts[advfilter.pk] = _count_one(advfilter, queryset)
+    if timeout:
+        cache.set(key, counts, timeout)
+    return counts
+
+
+def _planner_estimate(queryset):
+    """ The number of rows PostgreSQL's planner expects queryset to return """
+    # QuerySet.explain() returns the text of the (already parsed) plan
+    sql, params = queryset.order_by().query.get_compiler(
+        using=queryset.db).as_sql()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):  # drivers not decoding json columns
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def estimate_count(queryset, threshold):
+    """
+    Return a tuple of (count, is_exact) for queryset, only counting exactly
+    when there are no more than ``threshold`` rows.
+
+    On PostgreSQL the planner's row estimate is used to decide, on other
+    databases rows are counted up to ``threshold + 1`` and the returned
+    count is capped at ``threshold``.
+    """
+    if connections[queryset.db].vendor == 'postgresql':
+        try:
+            estimate = _planner_estimate(queryset)
+        except EmptyResultSet:
+            return 0, True
+        except (DatabaseError, KeyError, IndexError, ValueError) as e:
+            logger.debug('Unable to get a row estimate: %s', e)
+        else:
+            if estimate > threshold:
+                return estimate, False
+            return queryset.count(), True
+    count = queryset.order_by()[:threshold + 1].count()
+    if count > threshold:
+        return threshold, False
+    return count, True
+
+
+def _pg_n_distinct(connection, table, column):
+    """ PostgreSQL's statistics estimate, None for tables not analyzed """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT s.n_distinct, c.reltuples FROM pg_stats s "
+            "JOIN pg_namespace n ON n.nspname = s.schemaname "
+            "JOIN pg_class c ON c.relnamespace = n.oid "
+            "AND c.relname = s.tablename "
+            "WHERE s.schemaname = ANY(current_schemas(false)) "
+            "AND s.tablename = %s AND s.attname = %s", [table, column])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    n_distinct, reltuples = row
+    if n_distinct < 0:  # a (negated) fraction of the number of rows
+        return int(-n_distinct * max(reltuples, 0))
+    return int(n_distinct)
+
+
+def _sampled_n_distinct(model, field, using, sample_size):
+    """
+    The number of distinct values in (at most) ``sample_size`` rows, which
+    is exact for smaller tables and a lower bound otherwise.
+    """
+    sample = model._default_manager.using(using).order_by().values_list(
+        field.name, flat=True)[:sample_size]
+    return len(set(sample))
+
+
+def estimate_distinct(model, field, using='default'):
+    """
+    Return an estimate of the number of distinct values of a concrete
+    field, without scanning the whole table.
+
+    On PostgreSQL the planner statistics (pg_stats.n_distinct) are used,
+    elsewhere (or for tables that were never analyzed) the distinct values
+    of ADVANCED_FILTERS_CARDINALITY_SAMPLE_SIZE rows are counted. Estimates
+    are cached per table and column for ADVANCED_FILTERS_CARDINALITY_TIMEOUT
+    seconds (3600 by default).
+    """
+    connection = connections[using]
+    table, column = model._meta.db_table, field.column
+    key = 'advanced_filters:cardinality:%s:%s:%s' % (using, table, column)
+    estimate = cache.get(key)
+    if estimate is not None:
+        return estimate
+    if connection.vendor == 'postgresql':
+        try:
+            estimate = _pg_n_distinct(connection, table, column)
+        except DatabaseError as e:
+            logger.debug('Unable to read statistics of %s.%s: %s',
+                         table, column, e)
+    if estimate is None:
+        estimate = _sampled_n_distinct(model, field, using, getattr(
+            settings, 'ADVANCED_FILTERS_CARDINALITY_SAMPLE_SIZE', 10000))
+    cache.set(key, estimate, getattr(
+        settings, 'ADVANCED_FILTERS_CARDINALITY_TIMEOUT', 3600))
+    return estimate
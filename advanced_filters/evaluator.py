@@ -0,0 +1,187 @@
+"""
+Evaluate a (deserialized) Q tree of an AdvancedFilter against model
+instances in memory, without querying the database.
+
+Only lookups that can be produced by ``AdvancedFilterQueryForm`` over
+forward relations are supported; ``compile_matcher`` raises
+UnsupportedLookup for anything else, so callers can fall back to the
+database explicitly. The forward relations a matcher follows are listed in
+its ``relations`` attribute, for prefetching them in bulk.
+"""
+from datetime import datetime
+import re
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+from django.utils import timezone
+
+from .compiler import resolve_lookup
+from .optimizer import LOWER_LOOKUP
+
+
+class UnsupportedLookup(Exception):
+    """ A lookup of the query cannot be evaluated in Python """
+
+
+def _text(value):
+    return str(value).lower()
+
+
+def _iexact(actual, expected):
+    return _text(actual) == _text(expected)
+
+
+def _icontains(actual, expected):
+    return _text(expected) in _text(actual)
+
+
+def _contains(actual, expected):
+    return str(expected) in str(actual)
+
+
+def _iregex(actual, expected):
+    return re.search(expected, str(actual), re.IGNORECASE) is not None
+
+
+def _regex(actual, expected):
+    return re.search(expected, str(actual)) is not None
+
+
+def _range(actual, expected):
+    return expected[0] <= actual <= expected[1]
+
+
+def _in(actual, expected):
+    return actual in expected
+
+
+COMPARATORS = {
+    'exact': lambda actual, expected: actual == expected,
+    'iexact': _iexact,
+    'contains': _contains,
+    'icontains': _icontains,
+    'regex': _regex,
+    'iregex': _iregex,
+    'lt': lambda actual, expected: actual < expected,
+    'lte': lambda actual, expected: actual <= expected,
+    'gt': lambda actual, expected: actual > expected,
+    'gte': lambda actual, expected: actual >= expected,
+    'range': _range,
+    'in': _in,
+}
+# lookups comparing a typed (python) value rather than its text
+TYPED_LOOKUPS = ('exact', 'lt', 'lte', 'gt', 'gte', 'range', 'in')
+
+
+def _prepare(field, value):
+    """ Coerce a query value to the python type of the compared field """
+    if value is None:
+        return None
+    try:
+        value = field.to_python(value)
+    except ValidationError:
+        raise UnsupportedLookup('Invalid value %r for %s' % (value, field))
+    if (isinstance(value, datetime) and settings.USE_TZ and
+            timezone.is_naive(value)):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+
+def _compile_lookup(model, lookup, value):
+    try:
+        fields, lookups = resolve_lookup(model, lookup)
+    except FieldDoesNotExist as e:
+        raise UnsupportedLookup(str(e))
+    transform = None
+    if len(lookups) == 2 and lookups[0] == LOWER_LOOKUP:
+        transform, lookups = _text, lookups[1:]
+    if len(lookups) > 1:
+        raise UnsupportedLookup('Transforms are not supported: %s' % lookup)
+    lookup_name = lookups[0] if lookups else 'exact'
+    if lookup_name != 'isnull' and lookup_name not in COMPARATORS:
+        raise UnsupportedLookup('Unsupported lookup: %s' % lookup)
+    for field in fields[:-1]:
+        if not (field.many_to_one or field.one_to_one) or not field.concrete:
+            raise UnsupportedLookup(
+                'Only forward relations are supported: %s' % lookup)
+    target = fields[-1]
+    if target.many_to_many or target.one_to_many:
+        raise UnsupportedLookup(
+            'Multi-valued relations are not supported: %s' % lookup)
+    # compare a relation by its primary key value
+    attnames = [f.name for f in fields[:-1]] + [target.attname]
+    relations = set()
+    if len(fields) > 1:
+        relations.add(LOOKUP_SEP.join(attnames[:-1]))
+    if target.is_relation:
+        target = target.target_field
+
+    if lookup_name == 'isnull':
+        expected = bool(value)
+    elif value is None and lookup_name in ('exact', 'iexact'):
+        lookup_name, expected = 'isnull', True
+    elif lookup_name in TYPED_LOOKUPS:
+        if lookup_name in ('range', 'in'):
+            expected = [_prepare(target, v) for v in value]
+        else:
+            expected = _prepare(target, value)
+    else:
+        expected = value
+    compare = COMPARATORS.get(lookup_name)
+
+    def getter(instance):
+        for attname in attnames:
+            if instance is None:
+                return None
+            instance = getattr(instance, attname)
+        return instance
+
+    def matcher(instance):
+        actual = getter(instance)
+        if lookup_name == 'isnull':
+            return (actual is None) == expected
+        if actual is None:
+            return False
+        if transform is not None:
+            actual = transform(actual)
+        try:
+            return compare(actual, expected)
+        except TypeError as e:
+            raise UnsupportedLookup('Cannot compare %s: %s' % (lookup, e))
+    matcher.relations = relations
+    return matcher
+
+
+def _match_all(instance):
+    return True
+
+
+_match_all.relations = frozenset()
+
+
+def compile_matcher(model, query):
+    """
+    Compile a Q tree into a callable which takes an instance of ``model``
+    and returns whether it matches the query.
+
+    Raises UnsupportedLookup if any part of the query can not be evaluated
+    in Python.
+    """
+    if not query.children:
+        return _match_all
+    matchers = []
+    for child in query.children:
+        if isinstance(child, Q):
+            matchers.append(compile_matcher(model, child))
+        else:
+            matchers.append(_compile_lookup(model, child[0], child[1]))
+    combine = any if query.connector == Q.OR else all
+    negated = query.negated
+
+    def matcher(instance):
+        result = combine(m(instance) for m in matchers)
+        return not result if negated else result
+    matcher.relations = set().union(*(m.relations for m in matchers))
+    return matcher
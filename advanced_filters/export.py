@@ -0,0 +1,117 @@
+"""Stream the results of an advanced filter as CSV or JSON lines."""
+import csv
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.constants import LOOKUP_SEP
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .compiler import is_multivalued, resolve_lookup
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class Echo(object):
+    """ A file-like object which returns what is written to it """
+    def write(self, value):
+        return value
+
+
+def _excluded(path):
+    """ Whether a field path ends in a field never exported, i.e password """
+    excluded = getattr(settings, 'ADVANCED_FILTERS_EXPORT_EXCLUDE',
+                       ('password',))
+    return path.split(LOOKUP_SEP)[-1] in excluded
+
+
+def _exported(model):
+    """ The primary key and the editable, not excluded concrete fields """
+    return [f for f in model._meta.concrete_fields
+            if f.primary_key or (f.editable and not _excluded(f.name))]
+
+
+def default_fields(model):
+    """ The column names exported when none are selected """
+    return [f.attname for f in _exported(model)]
+
+
+def exportable_fields(model, model_admin=None):
+    """
+    The field paths the export view accepts for ``model``: the fields
+    exported by default and the paths the advanced filters of its
+    ModelAdmin expose (except the excluded ones).
+    """
+    fields = {'pk'}
+    for field in _exported(model):
+        fields.update((field.name, field.attname))
+    get_paths = getattr(model_admin, 'get_advanced_filter_paths', None)
+    if get_paths is not None:
+        fields.update(p for p in get_paths() if not _excluded(p))
+    return fields
+
+
+def validate_fields(model, fields, allowed=None):
+    """
+    Raise ValueError if one of the given (possibly related) field paths
+    can not be resolved, does not point to a single value or (when given)
+    is not one of the ``allowed`` paths.
+    """
+    for field in fields:
+        if allowed is not None and field not in allowed:
+            raise ValueError('Field can not be exported: %s' % field)
+        try:
+            path, lookups = resolve_lookup(model, field)
+        except FieldDoesNotExist as e:
+            raise ValueError(str(e))
+        if lookups or is_multivalued(path):
+            raise ValueError('Invalid field: %s' % field)
+
+
+def iter_values(queryset, fields, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield a tuple of values for each row in queryset. Rows are fetched in
+    chunks (using server-side cursors where the database supports them) to
+    keep memory usage flat.
+    """
+    return queryset.order_by().values_list(*fields).iterator(
+        chunk_size=chunk_size)
+
+
+def iter_csv(queryset, fields, chunk_size=DEFAULT_CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in iter_values(queryset, fields, chunk_size):
+        yield writer.writerow(row)
+
+
+def iter_jsonl(queryset, fields, chunk_size=DEFAULT_CHUNK_SIZE):
+    encoder = DjangoJSONEncoder()
+    for row in iter_values(queryset, fields, chunk_size):
+        yield encoder.encode(dict(zip(fields, row))) + '\n'
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'jsonl': (iter_jsonl, 'application/x-ndjson'),
+}
+
+
+def export_filter(advfilter, fields=None, format='csv',
+                  chunk_size=DEFAULT_CHUNK_SIZE, allowed_fields=None,
+                  queryset=None):
+    """
+    Return (iterator of text chunks, content type) exporting the results
+    of ``advfilter`` within ``queryset`` (all rows by default), restricted
+    to ``allowed_fields`` when given.
+    """
+    try:
+        renderer, content_type = FORMATS[format]
+    except KeyError:
+        raise ValueError('Unsupported format: %s' % format)
+    if chunk_size <= 0:
+        raise ValueError('Chunk size must be strictly positive')
+    model = advfilter.model_class
+    fields = list(fields or default_fields(model))
+    validate_fields(model, fields, allowed_fields)
+    queryset = advfilter.filter_queryset(queryset)
+    return renderer(queryset, fields, chunk_size), content_type
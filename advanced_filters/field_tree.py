@@ -0,0 +1,167 @@
+"""
+Discover the fields available for filtering with
+``advanced_filter_fields = '__all__'``.
+
+Relations are only expanded on demand (by the field selector of the query
+form, through the GetFieldTree view), so the whole relation graph is never
+built or sent to the browser.
+"""
+from fnmatch import fnmatchcase
+
+from django.db.models.constants import LOOKUP_SEP
+
+
+ALL_FIELDS = '__all__'
+
+
+def model_fields(model):
+    """
+    Return a tuple of (name, verbose name, related model or None) for each
+    field of ``model`` that can be filtered on (``_meta.get_fields()`` is
+    cached by Django).
+
+    Reverse relations are included under their query name, unless hidden
+    (with a related_name ending with "+").
+    """
+    fields = []
+    for field in model._meta.get_fields():
+        if not field.is_relation:
+            fields.append((field.name, field.verbose_name, None))
+        elif field.related_model is None:  # i.e GenericForeignKey
+            continue
+        elif field.auto_created and not field.concrete:
+            if field.is_hidden():
+                continue
+            fields.append((
+                field.name,
+                field.related_model._meta.verbose_name_plural,
+                field.related_model))
+        else:
+            fields.append(
+                (field.name, field.verbose_name, field.related_model))
+    return tuple(fields)
+
+
+def _fields_by_name(model):
+    return dict((f[0], f) for f in model_fields(model))
+
+
+class FieldTree(object):
+    """
+    The field paths of ``model`` available for filtering: fields of the
+    model and of the models reached by following at most ``max_depth``
+    relations, less the paths matching one of the ``exclude`` (fnmatch)
+    patterns, plus the paths explicitly listed in ``include``.
+    """
+    def __init__(self, model, include=(), exclude=(), max_depth=1):
+        self.model = model
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.max_depth = max_depth
+
+    @classmethod
+    def for_admin(cls, model_admin):
+        """
+        The tree of a ModelAdmin with ``advanced_filter_fields = '__all__'``,
+        or None for other ModelAdmins.
+        """
+        if getattr(model_admin, 'advanced_filter_fields', ()) != ALL_FIELDS:
+            return None
+        return cls(
+            model_admin.model,
+            include=getattr(model_admin, 'advanced_filter_fields_include', ()),
+            exclude=getattr(model_admin, 'advanced_filter_fields_exclude', ()),
+            max_depth=getattr(model_admin, 'advanced_filter_max_depth', 1))
+
+    def _excluded(self, path):
+        parts = path.split(LOOKUP_SEP)
+        # excluding a relation excludes all paths through it
+        prefixes = [LOOKUP_SEP.join(parts[:i + 1]) for i in range(len(parts))]
+        return any(fnmatchcase(prefix, pattern) for prefix in prefixes
+                   for pattern in self.exclude)
+
+    def _resolve(self, path):
+        """ The (name, verbose name, related model) entries along a path """
+        model = self.model
+        entries = []
+        for part in path.split(LOOKUP_SEP):
+            if model is None:
+                return None
+            entry = _fields_by_name(model).get(part)
+            if entry is None:
+                return None
+            entries.append(entry)
+            model = entry[2]
+        return entries
+
+    def allows(self, path):
+        """ Whether filtering on ``path`` is allowed """
+        if path in self.include:
+            return self._resolve(path) is not None
+        if path.count(LOOKUP_SEP) > self.max_depth or self._excluded(path):
+            return False
+        return self._resolve(path) is not None
+
+    def is_expandable(self, path):
+        """ Whether ``path`` is a relation whose fields may be listed """
+        entries = self._resolve(path)
+        return bool(entries and entries[-1][2] is not None and
+                    path.count(LOOKUP_SEP) < self.max_depth and
+                    not self._excluded(path))
+
+    def verbose_name(self, path):
+        """ The verbose names along a path, i.e "assigned to / email" """
+        return ' / '.join(
+            '%s' % entry[1] for entry in self._resolve(path) or ())
+
+    def children(self, path=''):
+        """
+        Return a list of (path, verbose name, is expandable) for the fields
+        of the relation at ``path`` (of the model itself by default), or
+        None if that relation can not be expanded.
+        """
+        if path:
+            if not self.is_expandable(path):
+                return None
+            model = self._resolve(path)[-1][2]
+            prefix = path + LOOKUP_SEP
+        else:
+            model = self.model
+            prefix = ''
+        children = []
+        for name, verbose_name, related_model in model_fields(model):
+            child = prefix + name
+            if self.allows(child):
+                children.append((
+                    child, self.verbose_name(child),
+                    related_model is not None and self.is_expandable(child)))
+        return children
+
+    def fields(self, extra_paths=()):
+        """
+        Return the list of (path, verbose name) the field select starts
+        with: the fields of the model, the included paths and the allowed
+        ``extra_paths`` (i.e paths of a stored query).
+        """
+        fields = [(path, name) for path, name, _ in self.children()]
+        known = set(path for path, _ in fields)
+        for path in self.include + tuple(extra_paths):
+            if path not in known and self.allows(path):
+                fields.append((path, self.verbose_name(path)))
+                known.add(path)
+        return fields
+
+    def paths(self):
+        """ All allowed paths, following every expandable relation """
+        paths = list(self.include)
+        pending = ['']
+        while pending:
+            for path, _, expandable in self.children(pending.pop()):
+                paths.append(path)
+                if expandable:
+                    pending.append(path)
+        return paths
+
+    def relations(self, paths):
+        """ The subset of ``paths`` that are expandable relations """
+        return frozenset(path for path in paths if self.is_expandable(path))
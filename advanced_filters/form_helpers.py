@@ -40,6 +40,35 @@ class VaryingTypeCharField(forms.CharField):
         return res
 
 
+class FieldSelect(forms.Select):
+    """
+    A Select marking the options of expandable relations (listed in
+    ``relations``) with a "data-relation" attribute, for the field selector
+    to load the fields of the related model on demand.
+    """
+    relations = frozenset()
+
+    def create_option(self, name, value, *args, **kwargs):
+        option = super(FieldSelect, self).create_option(
+            name, value, *args, **kwargs)
+        if value in self.relations:
+            option['attrs']['data-relation'] = 'true'
+        return option
+
+
+class FieldPathChoiceField(forms.ChoiceField):
+    """
+    A ChoiceField which also accepts the values ``allowed_path`` (if set)
+    approves of, i.e field paths loaded by the field selector.
+    """
+    allowed_path = None
+
+    def valid_value(self, value):
+        if self.allowed_path is not None and self.allowed_path(value):
+            return True
+        return super(FieldPathChoiceField, self).valid_value(value)
+
+
 class CleanWhiteSpacesMixin(object):
     """
     This mixin, when added to any form subclass, adds a clean method which
@@ -1,5 +1,6 @@
 from collections import OrderedDict
-from datetime import datetime as dt
+from datetime import date, datetime as dt, time as dt_time
+from decimal import Decimal
 from pprint import pformat
 import logging
 import operator
@@ -10,10 +11,13 @@ from django.apps import apps
 
 from django.conf import settings
 from django.contrib import admin
-from django.contrib.admin.utils import get_fields_from_path
+from django.contrib.admin.utils import NotRelationField, get_fields_from_path
+from django.core.exceptions import ValidationError
+from django.db import models
 from django.db.models import Q, FieldDoesNotExist
 from django.forms.formsets import formset_factory, BaseFormSet
 from django.utils.functional import cached_property
+from django.utils import six, timezone
 from django.utils.translation import ugettext_lazy as _
 # noinspection PyUnresolvedReferences
 from django.utils.six.moves import range, reduce
@@ -22,7 +26,11 @@ from django.utils.text import capfirst
 import django
 
 from .models import AdvancedFilter
-from .form_helpers import CleanWhiteSpacesMixin,  VaryingTypeCharField
+from .field_tree import ALL_FIELDS, FieldTree
+from .form_helpers import (CleanWhiteSpacesMixin, FieldPathChoiceField,
+                           FieldSelect, VaryingTypeCharField)
+from .optimizer import (anchored_pattern, target_field, to_field_value,
+                        uses_exact_match)
 
 
 # django < 1.9 support
@@ -34,13 +42,26 @@ SELECT2_JS = getattr(settings, 'SELECT2_JS', 'select2/select2.min.js')
 SELECT2_CSS = getattr(settings, 'SELECT2_CSS', 'select2/select2.min.css')
 
 
-def date_to_string(timestamp):
+def date_to_string(timestamp, fmt='%Y-%m-%d'):
     if timestamp:
-        return dt.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+        return dt.fromtimestamp(timestamp).strftime(fmt)
     else:
         return ""
 
 
+def storable_value(value):
+    """
+    A typed value as stored in a query: numbers as they are, other types
+    (dates, UUIDs...) as their canonical string, which every query format
+    can keep and the ORM converts back.
+    """
+    if isinstance(value, (dt, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, (bool, six.integer_types, float, Decimal)):
+        return value
+    return six.text_type(value)
+
+
 class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
     """ Build the query from field, operator and value """
     OPERATORS = (
@@ -57,11 +78,14 @@ class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
         ("gte", _("Greater Than or Equal To")),
     )
 
+    # operators comparing a value of the field's type
+    TYPED_OPERATORS = ("iexact", "lt", "gt", "lte", "gte")
+
     FIELD_CHOICES = (
         ("_OR", _("Or (mark an or between blocks)")),
     )
 
-    field = forms.ChoiceField(required=True, widget=forms.Select(
+    field = FieldPathChoiceField(required=True, widget=FieldSelect(
         attrs={'class': 'query-field'}), label=_('Field'))
     operator = forms.ChoiceField(
         label=_('Operator'),
@@ -75,13 +99,17 @@ class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
         attrs={'class': 'query-dt-to'}), required=False)
     negate = forms.BooleanField(initial=False, required=False, label=_('Negate'))
 
-    def _build_field_choices(self, fields):
+    @classmethod
+    def build_field_choices(cls, fields):
         """
         Iterate over passed model fields tuple and update initial choices.
         """
         return tuple([
             (fquery, capfirst(fname)) for fquery, fname in fields.items()
-        ]) + self.FIELD_CHOICES
+        ]) + cls.FIELD_CHOICES
+
+    def _build_field_choices(self, fields):
+        return self.build_field_choices(fields)
 
     def _build_query_dict(self, formdata=None):
         """
@@ -99,8 +127,41 @@ class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
             return {formdata['field']: True}
         elif formdata['operator'] == "isfalse":
             return {formdata['field']: False}
+        elif formdata['operator'] in self.TYPED_OPERATORS:
+            operator_, value = self._typed_lookup(
+                formdata['field'], formdata['operator'], formdata['value'])
+            return {'%s__%s' % (formdata['field'], operator_): value}
+        elif formdata['operator'] == "iregex":
+            return {key: anchored_pattern(formdata['value'])}
         return {key: formdata['value']}
 
+    def _typed_lookup(self, field_path, operator_, value):
+        """
+        Return the cheapest lookup equivalent to ``operator_`` on the field
+        at ``field_path`` (exact instead of iexact for numeric, date, UUID
+        and foreign key fields) and the value coerced to the field's type.
+
+        The operator and value are returned unchanged for text fields, when
+        the form has no model, or when the value does not fit the field.
+        """
+        if self.model is None:
+            return operator_, value
+        try:
+            field = target_field(get_fields_from_path(self.model, field_path))
+        except (FieldDoesNotExist, NotRelationField):
+            return operator_, value
+        if field is None or not uses_exact_match(field):
+            return operator_, value
+        try:
+            # submitted in the time zone of the user filling in the form
+            value = storable_value(to_field_value(
+                field, value, timezone.get_current_timezone()))
+        except ValidationError:
+            return operator_, value
+        if operator_ == 'iexact':
+            operator_ = 'exact'
+        return operator_, value
+
     @staticmethod
     def _parse_query_dict(query_data, model):
         """
@@ -118,6 +179,8 @@ class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
             if parts[-1] in dict(AdvancedFilterQueryForm.OPERATORS).keys():
                 field = '__'.join(parts[:-1])
                 operator_ = parts[-1]
+            elif parts[-1] == 'exact':  # "Equals" on a non-text field
+                field = '__'.join(parts[:-1])
             else:
                 field = query_data['field']
 
@@ -138,6 +201,14 @@ class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
         else:
             if not query_data.get('operator') == 'range':
                 query_data['operator'] = operator_  # default
+            # typed queries return dates as timestamps
+            value = query_data['value']
+            if (isinstance(value, (six.integer_types, float)) and
+                    isinstance(mfield[-1], models.DateField)):
+                fmt = ('%Y-%m-%d %H:%M:%S'
+                       if isinstance(mfield[-1], models.DateTimeField)
+                       else '%Y-%m-%d')
+                query_data['value'] = date_to_string(value, fmt)
         if isinstance(query_data.get('value'),
                       list) and query_data['operator'] == 'range':
             date_from = date_to_string(query_data.get('value_from'))
@@ -190,8 +261,16 @@ class AdvancedFilterQueryForm(CleanWhiteSpacesMixin, forms.Form):
 
     def __init__(self, model_fields=None, *args, **kwargs):
         model_fields = model_fields or {}
+        self.model = kwargs.pop('model', None)
+        field_choices = kwargs.pop('field_choices', None)
+        allowed_path = kwargs.pop('allowed_path', None)
+        relation_paths = kwargs.pop('relation_paths', frozenset())
         super(AdvancedFilterQueryForm, self).__init__(*args, **kwargs)
-        self.FIELD_CHOICES = self._build_field_choices(model_fields)
+        self.fields['field'].allowed_path = allowed_path
+        self.fields['field'].widget.relations = relation_paths
+        if field_choices is None:
+            field_choices = self._build_field_choices(model_fields)
+        self.FIELD_CHOICES = field_choices
         self.fields['field'].choices = self.FIELD_CHOICES
         if not self.fields['field'].initial:
             self.fields['field'].initial = self.FIELD_CHOICES[0]
@@ -204,6 +283,10 @@ class AdvancedFilterFormSet(BaseFormSet):
 
     def __init__(self, *args, **kwargs):
         self.model_fields = kwargs.pop('model_fields', {})
+        self.model = kwargs.pop('model', None)
+        self.field_choices = kwargs.pop('field_choices', None)
+        self.allowed_path = kwargs.pop('allowed_path', None)
+        self.relation_paths = kwargs.pop('relation_paths', frozenset())
         super(AdvancedFilterFormSet, self).__init__(*args, **kwargs)
         if self.forms:
             form = self.forms[0]
@@ -212,13 +295,22 @@ class AdvancedFilterFormSet(BaseFormSet):
     def get_form_kwargs(self, index):
         kwargs = super(AdvancedFilterFormSet, self).get_form_kwargs(index)
         kwargs['model_fields'] = self.model_fields
+        kwargs['model'] = self.model
+        if self.field_choices is None:
+            # built once, shared by all forms (and empty_form)
+            self.field_choices = self.form.build_field_choices(
+                self.model_fields)
+        kwargs['field_choices'] = self.field_choices
+        kwargs['allowed_path'] = self.allowed_path
+        kwargs['relation_paths'] = self.relation_paths
         return kwargs
 
     @cached_property
     def forms(self):
-        # override the original property to include `model_fields` argument
-        forms_ = [self._construct_form(i, model_fields=self.model_fields)
-                 for i in range(self.total_form_count())]
+        # override the original property to include `model_fields` and
+        # `model` arguments
+        forms_ = [self._construct_form(i, **self.get_form_kwargs(i))
+                  for i in range(self.total_form_count())]
         forms_.append(self.empty_form)  # add initial empty form
         return forms_
 
@@ -295,6 +387,10 @@ class AdvancedFilterForm(CleanWhiteSpacesMixin, forms.ModelForm):
             raise ValueError('No ModelAdmin registered for %s', self._model)
         self._filter_fields = filter_fields or getattr(
             model_admin, 'advanced_filter_fields', ())
+        self._field_tree = None
+        if self._filter_fields == ALL_FIELDS:
+            self._field_tree = (FieldTree.for_admin(model_admin) or
+                                FieldTree(self._model))
 
         super(AdvancedFilterForm, self).__init__(
             data, files, instance=instance, **kwargs)
@@ -347,8 +443,6 @@ class AdvancedFilterForm(CleanWhiteSpacesMixin, forms.ModelForm):
 
     def initialize_form(self, instance, model, data=None, extra_inlines=False):
         """ Takes a "finalized" query and generate it's form data """
-        model_fields = self.get_fields_from_model(model, self._filter_fields)
-
         forms = []
         if instance:
             for field_data in instance.list_fields():
@@ -356,11 +450,28 @@ class AdvancedFilterForm(CleanWhiteSpacesMixin, forms.ModelForm):
                     AdvancedFilterQueryForm._parse_query_dict(
                         field_data, model))
 
+        filter_fields = self._filter_fields
+        tree_kwargs = {}
+        if self._field_tree is not None:
+            # the fields of the model, and the paths of related fields in
+            # use, selected further down the tree
+            paths = [f['field'] for f in forms]
+            if data:
+                paths.extend(data[k] for k in data if k.endswith('-field'))
+            filter_fields = tuple(self._field_tree.fields(paths))
+            tree_kwargs = dict(
+                allowed_path=self._field_tree.allows,
+                relation_paths=self._field_tree.relations(
+                    path for path, name in filter_fields))
+        model_fields = self.get_fields_from_model(model, filter_fields)
+
         formset = AFQFormSetNoExtra if not extra_inlines else AFQFormSet
         self.fields_formset = formset(
             data=data,
             initial=forms or None,
-            model_fields=model_fields
+            model_fields=model_fields,
+            model=model,
+            **tree_kwargs
         )
 
     def save(self, commit=True):
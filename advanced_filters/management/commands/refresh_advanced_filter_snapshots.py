@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from advanced_filters.models import AdvancedFilter
+
+
+class Command(BaseCommand):
+    help = "Refresh the snapshots of materialized advanced filters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'filter_ids', nargs='*', type=int,
+            help="Only refresh these filters (default: all materialized)")
+        parser.add_argument(
+            '--full', action='store_true',
+            help="Rebuild snapshots even if an incremental refresh is possible")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, filter_ids, **options):
+        filters = AdvancedFilter.objects.filter(materialized=True)
+        if filter_ids:
+            filters = filters.filter(pk__in=filter_ids)
+        for advfilter in filters.order_by('pk'):
+            tested = advfilter.refresh_snapshot(
+                full=options['full'], batch_size=options['batch_size'])
+            self.stdout.write('Refreshed "%s" (%s rows tested, %s matching)' % (
+                advfilter, tested, advfilter.snapshot_rows.count()))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from advanced_filters.export import DEFAULT_CHUNK_SIZE, FORMATS, export_filter
+from advanced_filters.models import AdvancedFilter
+
+
+class Command(BaseCommand):
+    help = "Stream the results of a stored advanced filter as CSV or JSONL"
+
+    def add_arguments(self, parser):
+        parser.add_argument('filter_id', type=int)
+        parser.add_argument('--format', default='csv', choices=sorted(FORMATS))
+        parser.add_argument(
+            '--fields', default='',
+            help="Comma separated list of fields (default: all model fields)")
+        parser.add_argument('--chunk-size', type=int,
+                            default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--output', help="Output file (default: stdout)")
+
+    def handle(self, filter_id, **options):
+        try:
+            advfilter = AdvancedFilter.objects.get(pk=filter_id)
+        except AdvancedFilter.DoesNotExist:
+            raise CommandError('AdvancedFilter %s does not exist' % filter_id)
+        fields = [f.strip() for f in options['fields'].split(',') if f.strip()]
+        try:
+            chunks, _ = export_filter(
+                advfilter, fields, options['format'], options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from advanced_filters.admin import AdminAdvancedFiltersMixin
+from advanced_filters.field_tree import FieldTree
+from advanced_filters.forms import AdvancedFilterForm
+from advanced_filters.models import AdvancedFilter
+from advanced_filters.views import GetFieldChoices
+
+
+class Command(BaseCommand):
+    help = ("Precompute the field choices and result counts of advanced "
+            "filters, i.e after a deploy")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Number of worker threads, each using its own database "
+                 "connection (0 runs everything in the main thread)")
+        parser.add_argument(
+            '--time-budget', type=float, default=None,
+            help="Stop starting new work after this many seconds")
+        parser.add_argument('--skip-choices', action='store_true')
+        parser.add_argument('--skip-filters', action='store_true')
+
+    def handle(self, **options):
+        if options['workers'] < 0:
+            raise CommandError('--workers must not be negative')
+        timeout = getattr(
+            settings, 'ADVANCED_FILTERS_CHOICES_CACHE_TIMEOUT', 3600)
+        tasks = []
+        if not options['skip_choices'] and timeout:
+            tasks.extend(self.choices_tasks(timeout))
+        if not options['skip_filters']:
+            tasks.extend(self.filter_tasks())
+
+        deadline = None
+        if options['time_budget'] is not None:
+            deadline = time.monotonic() + options['time_budget']
+        done, failed = self.run(tasks, options['workers'], deadline)
+        self.stdout.write('Warmed %d of %d entries (%d failed, %d skipped)' % (
+            done, len(tasks), failed, len(tasks) - done - failed))
+
+    def choices_tasks(self, timeout):
+        """
+        The first page of choices the value widget requests (an empty
+        search term) for the advanced_filter_fields of every ModelAdmin
+        using AdminAdvancedFiltersMixin, resolved upfront.
+        """
+        view = GetFieldChoices()
+        for model, model_admin in sorted(admin.site._registry.items(),
+                                         key=lambda item: item[0]._meta.label):
+            if not isinstance(model_admin, AdminAdvancedFiltersMixin):
+                continue
+            label = model._meta.label
+            tree = FieldTree.for_admin(model_admin)
+            if tree is not None:
+                # the fields the field select starts with
+                fields = [path for path, _ in tree.fields()]
+            else:
+                fields = AdvancedFilterForm.get_fields_from_model(
+                    model, model_admin.advanced_filter_fields)
+            for field_name in fields:
+                yield ('choices %s.%s' % (label, field_name),
+                       lambda label=label, field_name=field_name:
+                       view.cached_choices(label, field_name, timeout,
+                                           term='', page=1))
+
+    def filter_tasks(self):
+        """ The (deserialized) query and result count of stored filters """
+        filters = AdvancedFilter.objects.exclude(b64_query='').exclude(
+            model__isnull=True).exclude(model='')
+        for advfilter in filters.order_by('pk'):
+            yield ('filter %s "%s"' % (advfilter.pk, advfilter.title),
+                   advfilter.result_count)
+
+    def run(self, tasks, workers, deadline=None):
+        """
+        Run tasks in ``workers`` threads until all are done or the deadline
+        is reached, reporting progress. Returns the numbers of tasks done
+        and failed.
+        """
+        pending = queue.Queue()
+        for task in tasks:
+            pending.put(task)
+        results = queue.Queue()
+
+        def work():
+            try:
+                while deadline is None or time.monotonic() < deadline:
+                    try:
+                        label, func = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    started = time.monotonic()
+                    try:
+                        func()
+                        error = None
+                    except Exception as e:  # keep warming the other entries
+                        error = e
+                    results.put((label, time.monotonic() - started, error))
+            finally:
+                if workers:
+                    # the connections of this thread are not used anymore
+                    connections.close_all()
+                results.put(None)
+
+        if workers:
+            for _ in range(workers):
+                threading.Thread(target=work, daemon=True).start()
+        else:
+            work()
+
+        done = failed = 0
+        running = max(workers, 1)
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+            label, duration, error = result
+            if error is None:
+                done += 1
+                status = 'ok'
+            else:
+                failed += 1
+                status = 'failed: %s' % error
+            self.stdout.write('[%d/%d] %s: %s (%.0f ms)' % (
+                done + failed, len(tasks), label, status, duration * 1000))
+        return done, failed
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advanced_filters', '0006_advancedfilter_heading'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='advancedfilter',
+            name='materialized',
+            field=models.BooleanField(default=False, help_text='Serve results from a periodically refreshed snapshot', verbose_name='Materialized'),
+        ),
+        migrations.AddField(
+            model_name='advancedfilter',
+            name='snapshot_query_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='advancedfilter',
+            name='snapshot_refreshed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='AdvancedFilterSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_pk', models.CharField(max_length=255)),
+                ('advanced_filter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot_rows', to='advanced_filters.AdvancedFilter')),
+            ],
+            options={
+                'verbose_name': 'Advanced Filter snapshot row',
+                'verbose_name_plural': 'Advanced Filter snapshot rows',
+                'unique_together': {('advanced_filter', 'object_pk')},
+            },
+        ),
+    ]
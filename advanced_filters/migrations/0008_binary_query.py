@@ -0,0 +1,63 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:09
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.serializers.base import SerializationError
+from django.db import migrations, models
+
+from advanced_filters.q_serializer import BinaryQSerializer, QSerializer
+
+
+log = logging.getLogger('advanced_filters.migrations')
+
+
+def _digest(b64_query):
+    return hashlib.sha1(b64_query.encode('utf-8')).hexdigest()
+
+
+def _convert(apps, serializer):
+    AdvancedFilter = apps.get_model('advanced_filters', 'AdvancedFilter')
+    reader = QSerializer(base64=True)
+    for afilter in AdvancedFilter.objects.exclude(b64_query='').iterator():
+        try:
+            converted = serializer.dumps(reader.loads(afilter.b64_query))
+        except (SerializationError, ValueError, TypeError) as e:
+            log.warning('Could not convert query of filter %s: %s',
+                        afilter.pk, e)
+            continue
+        # keep an up-to-date snapshot valid for the re-encoded query
+        if afilter.snapshot_query_hash == _digest(afilter.b64_query):
+            afilter.snapshot_query_hash = _digest(converted)
+        afilter.b64_query = converted
+        afilter.save(update_fields=['b64_query', 'snapshot_query_hash'])
+
+
+def to_binary(apps, schema_editor):
+    _convert(apps, BinaryQSerializer(base64=True))
+
+
+def forwards(apps, schema_editor):
+    # opt-in: the binary format does not decode faster than JSON
+    if getattr(settings, 'ADVANCED_FILTERS_QUERY_FORMAT', 'json') == 'binary':
+        to_binary(apps, schema_editor)
+
+
+def to_json(apps, schema_editor):
+    _convert(apps, QSerializer(base64=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advanced_filters', '0007_advancedfilter_snapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='advancedfilter',
+            name='b64_query',
+            field=models.TextField(),
+        ),
+        migrations.RunPython(forwards, to_json),
+    ]
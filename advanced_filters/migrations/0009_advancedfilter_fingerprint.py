@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:14
+import logging
+
+from django.core.serializers.base import SerializationError
+from django.db import migrations, models
+
+from advanced_filters.q_serializer import QSerializer, fingerprint
+
+
+log = logging.getLogger('advanced_filters.migrations')
+
+
+def set_fingerprints(apps, schema_editor):
+    AdvancedFilter = apps.get_model('advanced_filters', 'AdvancedFilter')
+    s = QSerializer(base64=True)
+    for afilter in AdvancedFilter.objects.exclude(b64_query='').iterator():
+        try:
+            afilter.fingerprint = fingerprint(s.loads(afilter.b64_query))
+        except (SerializationError, ValueError, TypeError, KeyError) as e:
+            log.warning('Could not fingerprint query of filter %s: %s',
+                        afilter.pk, e)
+            continue
+        afilter.save(update_fields=['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advanced_filters', '0008_binary_query'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='advancedfilter',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Digest of the canonical form of the query', max_length=40),
+        ),
+        migrations.RunPython(set_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:23
+import logging
+
+from django.apps import apps as global_apps
+from django.core.serializers.base import SerializationError
+from django.db import migrations, models
+import django.db.models.deletion
+
+from advanced_filters.compiler import referenced_paths
+from advanced_filters.q_serializer import QSerializer
+
+
+log = logging.getLogger('advanced_filters.migrations')
+
+
+def set_field_paths(apps, schema_editor):
+    AdvancedFilter = apps.get_model('advanced_filters', 'AdvancedFilter')
+    AdvancedFilterFieldPath = apps.get_model(
+        'advanced_filters', 'AdvancedFilterFieldPath')
+    s = QSerializer(base64=True)
+    for afilter in AdvancedFilter.objects.exclude(b64_query='').iterator():
+        try:
+            query = s.loads(afilter.b64_query)
+            afilter.query_json = QSerializer().dumps(query)
+        except (SerializationError, ValueError, TypeError, KeyError) as e:
+            log.warning('Could not decode query of filter %s: %s',
+                        afilter.pk, e)
+            continue
+        afilter.save(update_fields=['query_json'])
+        # the filtered model is only inspected, not queried: the current
+        # registry also knows apps without a migration history
+        try:
+            model = global_apps.get_model(*afilter.model.split('.'))
+        except (AttributeError, LookupError, ValueError):
+            log.warning('Unknown model of filter %s: %s',
+                        afilter.pk, afilter.model)
+            continue
+        AdvancedFilterFieldPath.objects.bulk_create([
+            AdvancedFilterFieldPath(advanced_filter=afilter, path=path)
+            for path in sorted(referenced_paths(model, query))])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('advanced_filters', '0009_advancedfilter_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='advancedfilter',
+            name='query_json',
+            field=models.TextField(blank=True, editable=False, help_text='The query tree as JSON'),
+        ),
+        migrations.CreateModel(
+            name='AdvancedFilterFieldPath',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(db_index=True, max_length=255)),
+                ('advanced_filter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='referenced_fields', to='advanced_filters.AdvancedFilter')),
+            ],
+            options={
+                'verbose_name': 'Advanced Filter field path',
+                'verbose_name_plural': 'Advanced Filter field paths',
+                'unique_together': {('advanced_filter', 'path')},
+            },
+        ),
+        migrations.RunPython(set_field_paths, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,26 @@
+import hashlib
 import logging
-from functools import reduce
 
 from django.apps import apps
 from django.conf import settings
-from django.db import models
-from django.db.models import Q, QuerySet
+from django.core.cache import cache
+from django.core.serializers.base import SerializationError
+from django.db import connections, models, transaction
+from django.db.models import Q, Subquery, prefetch_related_objects
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.utils import timezone
 from django.utils.six import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
-from .q_serializer import QSerializer
+from .cache import (get_model_versions, load_query, load_raw_query,
+                    query_digest, sql_cache)
+from .compiler import (filter_queryset, iter_lookups, referenced_paths,
+                       related_models)
+from .evaluator import UnsupportedLookup, compile_matcher
+from .optimizer import optimize_query
+from .q_serializer import QSerializer, get_serializer
+from .q_serializer import fingerprint as query_fingerprint
 
 
 log = logging.getLogger(__name__)
@@ -21,6 +33,18 @@ class UserLookupManager(models.Manager):
             return self.all()
         return self.filter(Q(users=user) | Q(groups__in=user.groups.all()))
 
+    def referencing(self, path, model=None):
+        """
+        All filters whose query references the field path ``path`` (i.e
+        "assigned_to__email", or "assigned_to" for any field reached through
+        it), optionally only the filters of ``model`` ("app_label.Model").
+        """
+        paths = AdvancedFilterFieldPath.objects.filter(path=path)
+        filters = self.filter(pk__in=paths.values('advanced_filter'))
+        if model is not None:
+            filters = filters.filter(model=model)
+        return filters
+
 
 @python_2_unicode_compatible
 class AdvancedFilter(models.Model):
@@ -44,37 +68,88 @@ class AdvancedFilter(models.Model):
 
     objects = UserLookupManager()
 
-    b64_query = models.CharField(max_length=2048)
+    b64_query = models.TextField()
     model = models.CharField(max_length=64, blank=True, null=True)
     model_name = models.CharField(
         max_length=64, blank=True, null=True, verbose_name='model',
         editable=False)
     order = models.PositiveIntegerField(default=0)
 
+    materialized = models.BooleanField(
+        default=False, verbose_name=_('Materialized'),
+        help_text=_('Serve results from a periodically refreshed snapshot'))
+    snapshot_query_hash = models.CharField(
+        max_length=40, blank=True, editable=False)
+    snapshot_refreshed_at = models.DateTimeField(
+        null=True, blank=True, editable=False)
+    fingerprint = models.CharField(
+        max_length=40, blank=True, editable=False, db_index=True,
+        help_text=_('Digest of the canonical form of the query'))
+    query_json = models.TextField(
+        blank=True, editable=False,
+        help_text=_('The query tree as JSON'))
+
     @property
     def query(self):
         """
-        De-serialize, decode and return an ORM query stored in b64_query.
+        De-serialize, decode and return an ORM query stored in b64_query,
+        with its lookups rewritten by the optimizer (unless disabled with
+        ADVANCED_FILTERS_OPTIMIZE_QUERIES).
         """
         if not self.b64_query:
             return None
-        s = QSerializer(base64=True)
-        return s.loads(self.b64_query)
+        query = load_query(self.b64_query)
+        if self.model and getattr(
+                settings, 'ADVANCED_FILTERS_OPTIMIZE_QUERIES', True):
+            query = optimize_query(self.model_class, query)
+        return query
 
     @query.setter
     def query(self, value):
         """
-        Serialize an ORM query, Base-64 encode it and set it to
-        the b64_query field
+        Serialize an ORM query (in ADVANCED_FILTERS_QUERY_FORMAT),
+        Base-64 encode it and set it to the b64_query field
         """
         if not isinstance(value, Q):
             raise Exception('Must only be passed a Django (Q)uery object')
-        s = QSerializer(base64=True)
+        s = get_serializer(base64=True)
         self.b64_query = s.dumps(value)
+        self.fingerprint = query_fingerprint(value)
+        self.query_json = QSerializer().dumps(value)
+
+    def save(self, *args, **kwargs):
+        super(AdvancedFilter, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'b64_query' in update_fields:
+            self.update_field_paths()
+
+    def field_paths(self):
+        """ The set of field paths the query references """
+        if not self.b64_query or not self.model:
+            return set()
+        try:
+            model_class = self.model_class
+            query = load_query(self.b64_query)
+        except LookupError:
+            return set()
+        except (SerializationError, ValueError, TypeError, KeyError) as e:
+            log.warning('Could not decode query of filter %s: %s', self.pk, e)
+            return set()
+        return referenced_paths(model_class, query)
+
+    def update_field_paths(self):
+        """ Sync the indexed field paths used by ``referencing()`` """
+        paths = self.field_paths()
+        stored = set(self.referenced_fields.values_list('path', flat=True))
+        if stored - paths:
+            self.referenced_fields.filter(path__in=stored - paths).delete()
+        AdvancedFilterFieldPath.objects.bulk_create([
+            AdvancedFilterFieldPath(advanced_filter=self, path=path)
+            for path in sorted(paths - stored)])
 
     def list_fields(self):
         s = QSerializer(base64=True)
-        d = s.loads(self.b64_query, raw=True)
+        d = load_raw_query(self.b64_query)
         return s.get_field_values_list(d)
 
     def __str__(self):
@@ -84,10 +159,252 @@ class AdvancedFilter(models.Model):
     def model_class(self):
         return apps.get_model(*self.model.split('.'))
 
+    def compiled_sql(self, using='default'):
+        """
+        Return the (sql, params) of a query selecting the primary keys
+        matching this filter on database ``using``.
+
+        The result is compiled once and cached per filter id, query digest,
+        model and database alias.
+        """
+        digest = query_digest(self.b64_query)
+        key = (self.pk, using)
+        entry = sql_cache.get(key) if self.pk else None
+        if entry is None or entry[:2] != (digest, self.model):
+            queryset = filter_queryset(
+                self.model_class._base_manager.db_manager(using).all(),
+                self.query)
+            query = queryset.order_by().values('pk').query
+            sql, params = query.get_compiler(using=using).as_sql()
+            entry = (digest, self.model, sql, params)
+            if self.pk:
+                sql_cache.set(key, entry)
+        return entry[2], entry[3]
+
+    def invalidate_compiled_sql(self):
+        for alias in connections:
+            sql_cache.delete((self.pk, alias))
+
+    def related_models(self):
+        """
+        Return the set of models whose data may affect the results of this
+        filter (the filtered model and every model on the query's paths).
+        """
+        return related_models(self.model_class, (
+            lookup for lookup, _ in iter_lookups(self.query)))
+
+    def duplicates(self):
+        """ Other filters of the same model with an equivalent query """
+        if not self.fingerprint:
+            return AdvancedFilter.objects.none()
+        return AdvancedFilter.objects.filter(
+            model=self.model, fingerprint=self.fingerprint).exclude(pk=self.pk)
+
+    def _result_cache_key(self, kind):
+        versions = get_model_versions(self.related_models())
+        # equivalent filters share results, unless served from a snapshot
+        if self.has_snapshot:
+            # refreshing the snapshot changes its results
+            identity = 'snapshot:%s:%s' % (
+                self.pk, self.snapshot_refreshed_at.isoformat())
+        else:
+            identity = query_fingerprint(self.query)
+        signature = '%s:%s:%r' % (identity, self.model, versions)
+        return 'advanced_filters:results:%s:%s' % (
+            kind, hashlib.sha1(signature.encode('utf-8')).hexdigest())
+
+    def _cached_result(self, kind, compute):
+        timeout = getattr(settings, 'ADVANCED_FILTERS_RESULT_CACHE_TIMEOUT',
+                          3600)
+        if not timeout:
+            return compute()
+        key = self._result_cache_key(kind)
+        result = cache.get(key)
+        if result is None:
+            result = compute()
+            cache.set(key, result, timeout)
+        return result
+
+    def result_pks(self):
+        """
+        Return the list of primary keys matching this filter, served from
+        the cache until data of one of the related models changes.
+        """
+        return self._cached_result('pks', lambda: list(
+            self.filter_queryset().order_by().values_list('pk', flat=True)))
+
+    def result_count(self):
+        """
+        Return the number of rows matching this filter, served from the
+        cache until data of one of the related models changes.
+        """
+        return self._cached_result(
+            'count', lambda: self.filter_queryset().count())
+
+    def _compile_matcher(self):
+        try:
+            return compile_matcher(self.model_class, self.query)
+        except UnsupportedLookup as e:
+            log.debug('Filter %s can not be evaluated in python, '
+                      'using the database: %s', self.pk, e)
+            return None
+
+    def matches(self, instance):
+        """
+        Whether a (saved) model instance matches this filter, evaluated in
+        python when possible and in the database otherwise.
+        """
+        return self.matches_many([instance])[0]
+
+    def matches_many(self, instances):
+        """
+        Return a list of booleans stating whether each of the given model
+        instances matches this filter. The query is compiled only once;
+        instances that can not be evaluated in python are checked against
+        the database with a single query, and the forward relations the
+        query follows are prefetched (unless already loaded).
+        """
+        instances = list(instances)
+        matcher = self._compile_matcher()
+        results = [None] * len(instances)
+        if matcher is not None:
+            # load the related rows the query compares in one query each
+            prefetch_related_objects(instances, *matcher.relations)
+            for i, instance in enumerate(instances):
+                try:
+                    results[i] = matcher(instance)
+                except UnsupportedLookup as e:
+                    log.debug('Falling back to the database: %s', e)
+        pending = [i for i, r in enumerate(results) if r is None]
+        if pending:
+            pks = [instances[i].pk for i in pending]
+            found = set(self.filter_queryset().filter(
+                pk__in=pks).values_list('pk', flat=True))
+            for i in pending:
+                results[i] = instances[i].pk in found
+        return results
+
+    @property
+    def has_snapshot(self):
+        """ Whether results can be served from an up-to-date snapshot """
+        return bool(self.materialized and self.snapshot_refreshed_at and
+                    self.snapshot_query_hash == query_digest(self.b64_query))
+
+    def snapshot_watermark_field(self):
+        """
+        The name of the "last modified" field of the filtered model, as
+        configured in ADVANCED_FILTERS_SNAPSHOT_WATERMARK_FIELDS.
+        """
+        fields = getattr(
+            settings, 'ADVANCED_FILTERS_SNAPSHOT_WATERMARK_FIELDS', {})
+        return fields.get(self.model)
+
+    def _snapshot_pks(self):
+        pk = self.model_class._meta.pk
+        if pk.is_relation:  # multi-table inheritance
+            pk = pk.target_field
+        snapshot = self.snapshot_rows.order_by()
+        if pk.get_internal_type() in ('AutoField', 'BigAutoField',
+                                      'IntegerField', 'BigIntegerField',
+                                      'PositiveIntegerField',
+                                      'SmallIntegerField'):
+            snapshot = snapshot.annotate(
+                typed_pk=Cast('object_pk', models.BigIntegerField()))
+            return snapshot.values('typed_pk')
+        if pk.get_internal_type() == 'UUIDField':
+            snapshot = snapshot.annotate(
+                typed_pk=Cast('object_pk', models.UUIDField()))
+            return snapshot.values('typed_pk')
+        return snapshot.values('object_pk')
+
+    def refresh_snapshot(self, full=False, batch_size=1000):
+        """
+        Rebuild the snapshot of matching primary keys.
+
+        Unless ``full`` is set, when the model has a watermark field and the
+        stored query did not change since the last refresh, only rows
+        modified since then are re-tested. Returns the number of rows that
+        were (re-)tested.
+        """
+        model_class = self.model_class
+        digest = query_digest(self.b64_query)
+        watermark = self.snapshot_watermark_field()
+        incremental = bool(not full and watermark and
+                           self.snapshot_refreshed_at and
+                           self.snapshot_query_hash == digest)
+        started_at = timezone.now()
+        candidates = model_class._default_manager.all()
+        if incremental:
+            candidates = candidates.filter(**{
+                '%s__gte' % watermark: self.snapshot_refreshed_at})
+
+        with transaction.atomic():
+            tested = 0
+            if incremental:
+                changed = candidates.values_list('pk', flat=True)
+                pks = [str(pk) for pk in changed.iterator()]
+                tested = len(pks)
+                for i in range(0, len(pks), batch_size):
+                    self.snapshot_rows.filter(
+                        object_pk__in=pks[i:i + batch_size]).delete()
+            else:
+                tested = candidates.count()
+                # a single DELETE, AdvancedFilterSnapshot has no receivers
+                self.snapshot_rows.all().delete()
+            matching = self._filter_live(candidates).order_by().values_list(
+                'pk', flat=True)
+            rows = []
+            for pk in matching.iterator(chunk_size=batch_size):
+                rows.append(AdvancedFilterSnapshot(
+                    advanced_filter=self, object_pk=str(pk)))
+                if len(rows) >= batch_size:
+                    AdvancedFilterSnapshot.objects.bulk_create(rows)
+                    rows = []
+            AdvancedFilterSnapshot.objects.bulk_create(rows)
+
+            self.snapshot_query_hash = digest
+            self.snapshot_refreshed_at = started_at
+            self.save(update_fields=['snapshot_query_hash',
+                                     'snapshot_refreshed_at'])
+        return tested
+
+    def _filter_live(self, queryset):
+        if getattr(settings, 'ADVANCED_FILTERS_COMPILED_SQL_CACHE', False):
+            sql, params = self.compiled_sql(queryset.db)
+            return queryset.filter(pk__in=RawSQL(sql, params))
+        query = self.query
+        log.debug(query.__dict__)
+        return filter_queryset(queryset, query)
+
     def filter_queryset(self, queryset=None):
         if queryset is None:
             queryset = self.model_class.objects.all()
-        query = self.query
-        log.debug(query.__dict__)
-        qs = [queryset.filter(child) for child in query.children]
-        return reduce(QuerySet.__and__, qs).distinct()
+        if self.has_snapshot:
+            return queryset.filter(pk__in=Subquery(self._snapshot_pks()))
+        return self._filter_live(queryset)
+
+
+class AdvancedFilterSnapshot(models.Model):
+    """ The primary key of a row matching a materialized AdvancedFilter """
+    class Meta:
+        verbose_name = _('Advanced Filter snapshot row')
+        verbose_name_plural = _('Advanced Filter snapshot rows')
+        unique_together = (('advanced_filter', 'object_pk'),)
+
+    advanced_filter = models.ForeignKey(
+        AdvancedFilter, related_name='snapshot_rows',
+        on_delete=models.CASCADE)
+    object_pk = models.CharField(max_length=255)
+
+
+class AdvancedFilterFieldPath(models.Model):
+    """ A field path referenced by the query of an AdvancedFilter """
+    class Meta:
+        verbose_name = _('Advanced Filter field path')
+        verbose_name_plural = _('Advanced Filter field paths')
+        unique_together = (('advanced_filter', 'path'),)
+
+    advanced_filter = models.ForeignKey(
+        AdvancedFilter, related_name='referenced_fields',
+        on_delete=models.CASCADE)
+    path = models.CharField(max_length=255, db_index=True)
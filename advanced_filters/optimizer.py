@@ -0,0 +1,314 @@
+"""
+Rewrite the lookups of a (deserialized) Q tree into equivalents the
+database can answer with an index.
+
+The stored query is never modified, so filters keep round-tripping through
+``AdvancedFilterForm``; the rewrite is applied whenever the query of an
+AdvancedFilter is loaded, which covers existing filters as well.
+"""
+from datetime import date, datetime, timedelta
+import logging
+import re
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import models
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.functions import Lower
+from django.utils import six, timezone
+
+from .compiler import is_multivalued, resolve_lookup
+from .q_serializer import max_datetime, min_datetime
+
+
+logger = logging.getLogger('advanced_filters.optimizer')
+
+
+class AdvancedFiltersLower(Lower):
+    """
+    LOWER() under a namespaced lookup name, enabling
+    "<text field>__afilters_lower__in" for case-insensitive membership tests
+    without touching a project's own "lower" lookup.
+    """
+    lookup_name = 'afilters_lower'
+
+
+LOWER_LOOKUP = AdvancedFiltersLower.lookup_name
+models.CharField.register_lookup(AdvancedFiltersLower)
+models.TextField.register_lookup(AdvancedFiltersLower)
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]|()\\')
+_anchored_group = re.compile(r'^\^\((?P<body>[^()]*)\)\$$', re.DOTALL)
+
+
+def anchored_pattern(pattern):
+    """
+    Anchor a "One of" pattern so that it matches whole values only, as an
+    ``__in`` lookup would, rather than any value containing an alternative.
+
+    >>> anchored_pattern('(ru|en)')
+    '^(ru|en)$'
+    >>> anchored_pattern('test')
+    '^(test)$'
+    >>> anchored_pattern('^(ru|en)$')
+    '^(ru|en)$'
+    """
+    if _anchored_group.match(pattern) or (
+            pattern.startswith('^') and pattern.endswith('$') and
+            '|' not in pattern):
+        return pattern
+    if _anchored_group.match('^%s$' % pattern):
+        return '^%s$' % pattern
+    return '^(%s)$' % pattern
+
+
+def literal_alternatives(pattern):
+    """
+    Return the list of literals of an anchored pattern which is a pure
+    alternation of literals, as saved for "One of", or None.
+
+    Unanchored patterns match any value containing one of the literals and
+    are not equivalent to an ``__in`` lookup, so None is returned for them.
+
+    >>> literal_alternatives('^(ru|en|fr\\\\.ca)$')
+    ['ru', 'en', 'fr.ca']
+    >>> literal_alternatives('^test$')
+    ['test']
+    >>> literal_alternatives('(ru|en)') is None
+    True
+    >>> literal_alternatives('^(a.*|b)$') is None
+    True
+    """
+    match = _anchored_group.match(pattern)
+    if match:
+        body = match.group('body')
+    elif (pattern.startswith('^') and pattern.endswith('$') and
+            not pattern.endswith('\\$') and '|' not in pattern):
+        # '^a|b$' anchors each alternative on one side only
+        body = pattern[1:-1]
+    else:
+        return None
+    literals = []
+    current = []
+    chars = iter(body)
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, '')
+            if not escaped or escaped.isalnum():  # i.e \d, \w
+                return None
+            current.append(escaped)
+        elif char == '|':
+            literals.append(''.join(current))
+            current = []
+        elif char in REGEX_METACHARACTERS:
+            return None
+        else:
+            current.append(char)
+    literals.append(''.join(current))
+    if not all(literals):  # an empty alternative matches anything
+        return None
+    return literals
+
+
+# fields "Equals" compares with exact rather than iexact
+EXACT_FIELD_TYPES = (
+    models.AutoField, models.IntegerField, models.FloatField,
+    models.DecimalField, models.DateField, models.TimeField,
+    models.DurationField, models.UUIDField,
+)
+
+
+def target_field(fields):
+    """
+    The field values of a resolved path are compared with: the last field,
+    or the field a forward relation points to. None for reverse and
+    many-to-many relations.
+    """
+    field = fields[-1]
+    if not field.is_relation:
+        return field
+    if (field.many_to_one or field.one_to_one) and field.concrete:
+        return target_field([field.target_field])
+    return None
+
+
+def uses_exact_match(field):
+    """ Whether "Equals" can compare ``field`` with exact instead of iexact """
+    return isinstance(field, EXACT_FIELD_TYPES)
+
+
+def to_field_value(field, value, tzinfo=None):
+    """
+    Coerce a submitted value to the python type of ``field``; naive
+    datetimes are made aware in ``tzinfo``, the default time zone unless
+    given, so that a stored filter means the same for every request.
+
+    Raises ValidationError for values the field does not accept.
+    """
+    value = field.to_python(value)
+    if value is None:
+        raise ValidationError('A value is required')
+    if (isinstance(value, datetime) and settings.USE_TZ and
+            timezone.is_naive(value)):
+        value = timezone.make_aware(
+            value, tzinfo or timezone.get_default_timezone())
+    return value
+
+
+def rewrite_iregex(fields, lookups, lookup, value):
+    """
+    "One of" (a pure alternation of literals) as an ``__in`` lookup, using
+    ``Lower(field) IN (...)`` for case-insensitive text comparisons.
+    """
+    if lookups != ['iregex'] or not isinstance(value, six.string_types):
+        return None
+    literals = literal_alternatives(value)
+    target = target_field(fields)
+    if literals is None or target is None:
+        return None
+    prefix = lookup[:-len('__iregex')]
+    if isinstance(target, (models.CharField, models.TextField)):
+        if all(v.lower() == v.upper() for v in literals):
+            return (prefix + '__in', literals)
+        values = []
+        for v in literals:
+            if v.lower() not in values:
+                values.append(v.lower())
+        return (prefix + LOOKUP_SEP + LOWER_LOOKUP + '__in', values)
+    try:
+        values = [target.to_python(v) for v in literals]
+    except ValidationError:
+        return None
+    # '01' matches no integer written out as text, but to_python gives 1
+    if any(six.text_type(value) != v for value, v in zip(values, literals)):
+        return None
+    return (prefix + '__in', values)
+
+
+def rewrite_iexact(fields, lookups, lookup, value):
+    """
+    "Equals" on a numeric, date, UUID or foreign key field as an exact
+    comparison with the typed value, which can use the column's index.
+    """
+    if lookups != ['iexact'] or value is None:
+        return None
+    target = target_field(fields)
+    if target is None or not uses_exact_match(target):
+        return None
+    try:
+        value = to_field_value(target, value)
+    except ValidationError:
+        return None
+    return (lookup[:-len('iexact')] + 'exact', value)
+
+
+def _is_open(bound):
+    return bound is None or bound == min_datetime or bound == max_datetime
+
+
+def _date_bound(bound):
+    # the conversion DateField.to_python() applies to datetimes
+    if not isinstance(bound, datetime):
+        return bound
+    if settings.USE_TZ and timezone.is_aware(bound):
+        bound = timezone.make_naive(bound, timezone.get_default_timezone())
+    return bound.date()
+
+
+def _datetime_bound(bound):
+    if not isinstance(bound, datetime):
+        bound = datetime.combine(bound, datetime.min.time())
+    if settings.USE_TZ:
+        if timezone.is_naive(bound):
+            bound = timezone.make_aware(bound,
+                                        timezone.get_default_timezone())
+        return bound.astimezone(timezone.utc)
+    if timezone.is_aware(bound):
+        bound = timezone.make_naive(bound, timezone.get_default_timezone())
+    return bound
+
+
+def rewrite_range(fields, lookups, lookup, value):
+    """
+    A date range as half-open ``gte``/``lt`` bounds typed for the field:
+    dates for a DateField, UTC datetimes for an aware DateTimeField.
+
+    Open bounds (stored as min_datetime/max_datetime) are left out instead
+    of being compared with sentinel values. Ranges over multi-valued
+    relations are kept, negating two conditions over such a relation is not
+    equivalent to negating the range.
+    """
+    if lookups != ['range'] or len(value) != 2 or is_multivalued(fields):
+        return None
+    target = target_field(fields)
+    if not isinstance(target, models.DateField):
+        return None
+    low, high = value
+    if not all(_is_open(b) or isinstance(b, date) for b in (low, high)):
+        return None
+
+    prefix = lookup[:-len('range')]
+    conditions = []
+    if isinstance(target, models.DateTimeField):
+        # BETWEEN includes the upper bound: stop right after it
+        if not _is_open(low):
+            conditions.append((prefix + 'gte', _datetime_bound(low)))
+        if not _is_open(high):
+            conditions.append((prefix + 'lt', _datetime_bound(high) +
+                               timedelta(microseconds=1)))
+    else:
+        if not _is_open(low):
+            conditions.append((prefix + 'gte', _date_bound(low)))
+        if not _is_open(high):
+            conditions.append((prefix + 'lt', _date_bound(high) +
+                               timedelta(days=1)))
+    if not conditions:
+        # an open range still excludes NULL values
+        conditions.append((prefix + 'isnull', False))
+    if len(conditions) == 1:
+        return conditions[0]
+    return Q(*conditions)
+
+
+LOOKUP_REWRITES = [
+    rewrite_iregex,
+    rewrite_iexact,
+    rewrite_range,
+]
+
+
+def rewrite_lookup(model, child):
+    """
+    Return the (lookup, value) tuple or Q object the first applicable
+    rewrite produces for a (lookup, value) child, or the child unchanged.
+    """
+    lookup, value = child[0], child[1]
+    try:
+        fields, lookups = resolve_lookup(model, lookup)
+    except FieldDoesNotExist:
+        return child
+    for rewrite in LOOKUP_REWRITES:
+        result = rewrite(fields, lookups, lookup, value)
+        if result is not None:
+            logger.debug('Rewrote %s=%r into %r', lookup, value, result)
+            return result
+    return child
+
+
+def optimize_query(model, query):
+    """ Return a new Q tree with the lookups of ``query`` rewritten """
+    root = Q()
+    stack = [(query, root)]
+    while stack:
+        node, optimized = stack.pop()
+        optimized.connector = node.connector
+        optimized.negated = node.negated
+        for child in node.children:
+            if isinstance(child, Q):
+                subquery = Q()
+                optimized.children.append(subquery)
+                stack.append((child, subquery))
+            else:
+                optimized.children.append(rewrite_lookup(model, child))
+    return root
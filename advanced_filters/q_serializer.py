@@ -1,8 +1,14 @@
 """This is a module to serializers/deserializes Django Q (query) object."""
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
+from decimal import Decimal
 import base64
+import hashlib
+import struct
 import time
+import uuid
+import zlib
 
+from django.conf import settings
 from django.utils import six
 from django.db.models import Q
 from django.core.serializers.base import SerializationError
@@ -21,6 +27,18 @@ except OverflowError:
     max_ts = time.mktime((2038,) + (0,) * 8)  # limit 32bits
 
 
+def _from_timestamp(timestamp, fallback):
+    try:
+        return datetime.fromtimestamp(timestamp)
+    except (ValueError, OverflowError, OSError):
+        return fallback
+
+
+# the bounds an open-ended range is stored with
+min_datetime = _from_timestamp(min_ts, datetime.min)
+max_datetime = _from_timestamp(max_ts, datetime(3000, 1, 1))
+
+
 def dt2ts(obj):
     return time.mktime(obj.timetuple()) if isinstance(obj, date) else obj
 
@@ -44,45 +62,71 @@ class QSerializer(object):
     def _is_range(qtuple):
         return qtuple[0].endswith("__range") and len(qtuple[1]) == 2
 
+    @staticmethod
+    def _range_bound(value, default):
+        # typed (binary) queries store dates, legacy ones timestamps
+        if isinstance(value, date):
+            return value
+        return datetime.fromtimestamp(value) if value else default
+
     def prepare_value(self, qtuple):
+        """
+        Return a new (field, value) child with the value converted to what
+        the ORM expects; the passed child is left untouched.
+        """
+        value = qtuple[1]
         if self._is_range(qtuple):
-            qtuple[1][0] = qtuple[1][0] or min_ts
-            qtuple[1][1] = qtuple[1][1] or max_ts
-            qtuple[1] = (datetime.fromtimestamp(qtuple[1][0]),
-                         datetime.fromtimestamp(qtuple[1][1]))
-        return qtuple
+            value = (self._range_bound(value[0], min_datetime),
+                     self._range_bound(value[1], max_datetime))
+        elif isinstance(value, list):
+            value = list(value)
+        if isinstance(qtuple, tuple):
+            return (qtuple[0], value)
+        return [qtuple[0], value]
 
     def serialize(self, q):
         """
         Serialize a Q object into a (possibly nested) dict.
+
+        The tree is walked iteratively and the Q object is not modified.
         """
-        children = []
-        for child in q.children:
-            if isinstance(child, Q):
-                children.append(self.serialize(child))
-            else:
-                children.append(child)
-        serialized = q.__dict__
-        serialized['children'] = children
-        return serialized
+        root = dict(q.__dict__)
+        stack = [(q, root)]
+        while stack:
+            node, serialized = stack.pop()
+            children = serialized['children'] = []
+            for child in node.children:
+                if isinstance(child, Q):
+                    d = child.__dict__.copy()
+                    children.append(d)
+                    stack.append((child, d))
+                else:
+                    children.append(child)
+        return root
 
     def deserialize(self, d):
         """
         De-serialize a Q object from a (possibly nested) dict.
+
+        The tree is walked iteratively and the dict is not modified.
         """
-        children = []
-        for child in d.pop('children'):
-            if isinstance(child, dict):
-                children.append(self.deserialize(child))
-            else:
-                children.append(self.prepare_value(child))
-        query = Q()
-        query.children = children
-        query.connector = d['connector']
-        query.negated = d['negated']
-        if 'subtree_parents' in d:
-            query.subtree_parents = d['subtree_parents']
-        return query
+        root = Q()
+        stack = [(d, root)]
+        while stack:
+            data, query = stack.pop()
+            query.connector = data['connector']
+            query.negated = data['negated']
+            if 'subtree_parents' in data:
+                query.subtree_parents = data['subtree_parents']
+            children = query.children = []
+            for child in data['children']:
+                if isinstance(child, dict):
+                    subquery = Q()
+                    children.append(subquery)
+                    stack.append((child, subquery))
+                else:
+                    children.append(self.prepare_value(child))
+        return root
 
     def get_field_values_list(self, d):
         """
@@ -99,21 +143,29 @@ class QSerializer(object):
         OR relations are expressed as an extra "line" between queries.
         """
         fields = []
-        children = d.get('children', [])
-        for child in children:
-            if isinstance(child, dict):
-                fields.extend(self.get_field_values_list(child))
-            else:
+        # (node, index of the next child to visit)
+        stack = [(d, 0)]
+        while stack:
+            node, i = stack.pop()
+            children = node.get('children', [])
+            negate = node.get('negated', False)
+            is_or = node.get('connector') == 'OR'
+            while i < len(children):
+                # add _OR line
+                if i and is_or:
+                    fields.append({'field': '_OR', 'value': 'null'})
+                child = children[i]
+                i += 1
+                if isinstance(child, dict):
+                    stack.append((node, i))
+                    stack.append((child, 0))
+                    break
                 f = {'field': child[0], 'value': child[1]}
                 if self._is_range(child):
                     f['value_from'] = child[1][0]
                     f['value_to'] = child[1][1]
-                f['negate'] = d.get('negated', False)
+                f['negate'] = negate
                 fields.append(f)
-
-            # add _OR line
-            if d['connector'] == 'OR' and children[-1] != child:
-                fields.append({'field': '_OR', 'value': 'null'})
         return fields
 
     def dumps(self, obj):
@@ -124,11 +176,403 @@ class QSerializer(object):
             return base64.b64encode(six.b(string)).decode("utf-8")
         return string
 
+    def decode(self, string, raw=False):
+        """
+        Decode a query dumped by this or any other serializer of this module
+        into its dict structure; the binary format is detected by its
+        header, anything else is decoded as (legacy) JSON.
+
+        With raw=True the JSON compatible dict is returned, i.e dates are
+        returned as timestamps in either format.
+        """
+        data = base64.b64decode(string) if self.b64_enabled else string
+        if isinstance(data, bytes) and data[:2] == BINARY_MAGIC:
+            return decode_binary(data, raw=raw)
+        return json.loads(data)
+
     def loads(self, string, raw=False):
-        if self.b64_enabled:
-            d = json.loads(base64.b64decode(string))
-        else:
-            d = json.loads(string)
+        d = self.decode(string, raw=raw)
         if raw:
             return d
         return self.deserialize(d)
+
+
+# Binary format: a 4 bytes header (magic, format version, flags) followed
+# by the (optionally zlib compressed) tagged encoding of the Q tree.
+BINARY_MAGIC = b'\xafQ'
+BINARY_VERSION = 1
+FLAG_ZLIB = 0x01
+
+T_NONE, T_TRUE, T_FALSE, T_INT, T_FLOAT, T_STR, T_LIST, T_Q = range(8)
+T_DATETIME, T_DATETIME_TZ, T_DATE, T_DECIMAL, T_UUID = range(8, 13)
+# a ("field__lookup", <scalar>) child, decoded without a list frame
+T_LOOKUP = 13
+
+Q_OR = 0x01
+Q_NEGATED = 0x02
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_TZ = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_double = struct.Struct('>d')
+
+
+def _write_varint(out, n):
+    n = n << 1 if n >= 0 else (-n << 1) - 1  # zigzag
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (n >> 1) ^ -(n & 1), pos
+        shift += 7
+
+
+def _micros(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _write_str(out, value):
+    encoded = value.encode('utf-8')
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _write_scalar(out, value):
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, int):
+        out.append(T_INT)
+        _write_varint(out, value)
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += _double.pack(value)
+    elif isinstance(value, six.string_types):
+        out.append(T_STR)
+        _write_str(out, value)
+    elif isinstance(value, datetime):
+        offset = value.utcoffset()
+        if offset is None:
+            out.append(T_DATETIME)
+            _write_varint(out, _micros(value - EPOCH))
+        else:
+            out.append(T_DATETIME_TZ)
+            _write_varint(out, _micros(value - EPOCH_TZ))
+            _write_varint(out, offset.days * 86400 + offset.seconds)
+    elif isinstance(value, date):
+        out.append(T_DATE)
+        _write_varint(out, value.toordinal())
+    elif isinstance(value, Decimal):
+        out.append(T_DECIMAL)
+        _write_str(out, str(value))
+    elif isinstance(value, uuid.UUID):
+        out.append(T_UUID)
+        out += value.bytes
+    else:
+        raise SerializationError(
+            'Can not serialize %r (%s)' % (value, type(value).__name__))
+
+
+def encode_binary(q, compress=True):
+    """ Encode a Q tree into the versioned binary format """
+    out = bytearray()
+    stack = [q]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, Q):
+            out.append(T_Q)
+            out.append((Q_OR if value.connector == Q.OR else 0) |
+                       (Q_NEGATED if value.negated else 0))
+            _write_varint(out, len(value.children))
+            stack.extend(reversed(value.children))
+        elif isinstance(value, (list, tuple)):
+            if (len(value) == 2 and isinstance(value[0], six.string_types) and
+                    not isinstance(value[1], (list, tuple, Q))):
+                out.append(T_LOOKUP)
+                _write_str(out, value[0])
+                _write_scalar(out, value[1])
+                continue
+            out.append(T_LIST)
+            _write_varint(out, len(value))
+            stack.extend(reversed(value))
+        else:
+            _write_scalar(out, value)
+
+    flags = 0
+    payload = bytes(out)
+    if compress:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            flags |= FLAG_ZLIB
+            payload = compressed
+    return BINARY_MAGIC + bytes((BINARY_VERSION, flags)) + payload
+
+
+def decode_binary(data, raw=False):
+    """
+    Decode the binary format into the dict structure used by
+    QSerializer.deserialize(); lookups are decoded as lists.
+
+    With raw=True values are returned as their JSON counterparts:
+    timestamps for dates, strings for decimals and UUIDs.
+    """
+    if len(data) < 4 or data[:2] != BINARY_MAGIC:
+        raise SerializationError('Not a binary encoded query')
+    version, flags = data[2], data[3]
+    if version > BINARY_VERSION:
+        raise SerializationError(
+            'Unsupported query format version %d' % version)
+    try:
+        payload = data[4:]
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return _decode_payload(payload, raw)
+    except (IndexError, ValueError, OverflowError, struct.error,
+            UnicodeDecodeError, zlib.error) as e:
+        raise SerializationError('Corrupt binary query: %s' % e)
+
+
+def _read_scalar(data, pos, tag, raw):
+    if tag == T_STR or tag == T_DECIMAL:
+        length, pos = _read_varint(data, pos)
+        end = pos + length
+        value = data[pos:end].decode('utf-8')
+        if tag == T_DECIMAL and not raw:
+            value = Decimal(value)
+        return value, end
+    if tag == T_INT:
+        return _read_varint(data, pos)
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_FLOAT:
+        return _double.unpack_from(data, pos)[0], pos + 8
+    if tag == T_DATETIME:
+        micros, pos = _read_varint(data, pos)
+        value = EPOCH + timedelta(microseconds=micros)
+    elif tag == T_DATETIME_TZ:
+        micros, pos = _read_varint(data, pos)
+        offset, pos = _read_varint(data, pos)
+        value = (EPOCH_TZ + timedelta(microseconds=micros)).astimezone(
+            timezone(timedelta(seconds=offset)))
+    elif tag == T_DATE:
+        ordinal, pos = _read_varint(data, pos)
+        value = date.fromordinal(ordinal)
+    elif tag == T_UUID:
+        value = uuid.UUID(bytes=bytes(data[pos:pos + 16]))
+        return (str(value) if raw else value), pos + 16
+    else:
+        raise ValueError('unknown tag %d' % tag)
+    return (dt2ts(value) if raw else value), pos
+
+
+def _decode_payload(data, raw):
+    # every frame is [decoded items, items left, Q dict or None]
+    stack = [[[], 1, None]]
+    pos = 0
+    while True:
+        frame = stack[-1]
+        if not frame[1]:
+            stack.pop()
+            value = frame[0] if frame[2] is None else frame[2]
+            if not stack:
+                if pos != len(data):
+                    raise ValueError('trailing data')
+                return value[0]
+            frame = stack[-1]
+            frame[0].append(value)
+            frame[1] -= 1
+            continue
+
+        tag = data[pos]
+        pos += 1
+        if tag == T_LOOKUP:
+            key, pos = _read_scalar(data, pos, T_STR, raw)
+            value, pos = _read_scalar(data, pos + 1, data[pos], raw)
+            value = [key, value]
+        elif tag == T_Q:
+            flags = data[pos]
+            count, pos = _read_varint(data, pos + 1)
+            children = []
+            stack.append([children, count, {
+                'connector': Q.OR if flags & Q_OR else Q.AND,
+                'negated': bool(flags & Q_NEGATED),
+                'children': children,
+            }])
+            continue
+        elif tag == T_LIST:
+            count, pos = _read_varint(data, pos)
+            stack.append([[], count, None])
+            continue
+        else:
+            value, pos = _read_scalar(data, pos, tag, raw)
+        frame[0].append(value)
+        frame[1] -= 1
+
+
+class BinaryQSerializer(QSerializer):
+    """
+    Serialize Q objects into a compact, versioned binary format which keeps
+    the type of datetime, date, Decimal and UUID values. Anything written
+    by QSerializer (JSON) can still be loaded.
+    """
+    def __init__(self, base64=False, compress=True):
+        super(BinaryQSerializer, self).__init__(base64=base64)
+        self.compress = compress
+
+    def dumps(self, obj):
+        if not isinstance(obj, Q):
+            raise SerializationError
+        data = encode_binary(obj, compress=self.compress)
+        if self.b64_enabled:
+            return base64.b64encode(data).decode('ascii')
+        return data
+
+
+SERIALIZERS = {
+    'json': QSerializer,
+    'binary': BinaryQSerializer,
+}
+
+
+def get_serializer(base64=True):
+    """ The serializer of ADVANCED_FILTERS_QUERY_FORMAT ('json'/'binary') """
+    name = getattr(settings, 'ADVANCED_FILTERS_QUERY_FORMAT', 'json')
+    return SERIALIZERS[name](base64=base64)
+
+
+def _canonical_value(obj):
+    if isinstance(obj, datetime):
+        if obj.utcoffset() is not None:
+            obj = obj.astimezone(timezone.utc)
+        return obj.isoformat()
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return str(obj.normalize())
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError('Can not canonicalize %r' % obj)
+
+
+def _token(value):
+    return json.dumps(value, default=_canonical_value, use_decimal=False,
+                      separators=(',', ':'))
+
+
+def _canonical_lookup(child):
+    """ Return a canonical (lookup, value) tuple and its token """
+    lookup, value = child[0], child[1]
+    if lookup.endswith('__in') and isinstance(value, (list, tuple)):
+        values = dict((_token(v), v) for v in value)
+        value = [values[t] for t in sorted(values)]
+    return (lookup, value), _token([lookup, value])
+
+
+def _canonical_node(node, entries, is_root):
+    """
+    Combine the canonical (child, token) entries of ``node``; returns None
+    for an empty node and a single entry when the node is redundant.
+    """
+    connector, negated = node.connector, node.negated
+    # the AND-ed children of the root are applied as separate filter units,
+    # merging a nested AND into them would change multi-valued semantics
+    keep_units = is_root and connector == Q.AND and not negated
+    unique = {}
+    for entry in entries:
+        if entry is None:  # i.e. the empty Q() generate_query starts from
+            continue
+        child, token, sub_entries = entry
+        if (sub_entries is not None and not child.negated and
+                (len(sub_entries) == 1 or
+                 (child.connector == connector and not keep_units))):
+            for sub_entry in sub_entries:
+                unique.setdefault(sub_entry[1], sub_entry)
+        else:
+            unique.setdefault(token, entry)
+    entries = [unique[token] for token in sorted(unique)]
+
+    if not entries:
+        return None
+    if len(entries) == 1:
+        child, token, sub_entries = entries[0]
+        if not negated and not (keep_units and sub_entries is not None and
+                                child.connector == Q.AND):
+            return entries[0]
+        if sub_entries is not None:
+            # ~(~X) is X, ~(X) is a negated X
+            return _make_node(child.connector, not child.negated, sub_entries)
+        connector = Q.AND
+    return _make_node(connector, negated, entries)
+
+
+def _make_node(connector, negated, entries):
+    query = Q()
+    query.connector = connector
+    query.negated = negated
+    query.children = [entry[0] for entry in entries]
+    token = '%s%s(%s)' % ('~' if negated else '', connector,
+                          ','.join(entry[1] for entry in entries))
+    return query, token, entries
+
+
+def _canonicalize(q):
+    results = {}
+    stack = [(q, False)]
+    while stack:
+        node, visited = stack.pop()
+        if not visited:
+            stack.append((node, True))
+            stack.extend((c, False) for c in node.children if isinstance(c, Q))
+            continue
+        entries = []
+        for child in node.children:
+            if isinstance(child, Q):
+                entries.append(results[id(child)])
+            else:
+                entries.append(_canonical_lookup(child) + (None,))
+        results[id(node)] = _canonical_node(node, entries, node is q)
+
+    entry = results[id(q)]
+    if entry is None:
+        return _make_node(Q.AND, False, [])
+    if entry[2] is None:  # a single lookup
+        return _make_node(Q.AND, False, [entry])
+    return entry
+
+
+def canonicalize(q):
+    """
+    Return a new, canonical Q tree which selects the same rows as ``q``:
+    empty nodes are dropped, redundant wrappers and double negations
+    removed, nested nodes of the same connector flattened (but never into
+    the AND-ed filter units of the root), and children de-duplicated and
+    sorted.
+
+    >>> print(canonicalize(Q() & ~~Q(b=2) & (Q(a=1) | Q(a=1))))
+    (AND: ('a', 1), ('b', 2))
+
+    Negations are not pushed down with De Morgan's laws: Django compiles a
+    negated multi-valued lookup into a single subquery, so ~(A & B) is not
+    equivalent to ~A | ~B.
+    """
+    return _canonicalize(q)[0]
+
+
+def fingerprint(q):
+    """ A stable digest of the canonical form of ``q`` """
+    return hashlib.sha1(_canonicalize(q)[1].encode('utf-8')).hexdigest()
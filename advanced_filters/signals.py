@@ -0,0 +1,22 @@
+from django.db.models.signals import (class_prepared, post_delete,
+                                      post_migrate, post_save)
+from django.dispatch import receiver
+
+from .cache import sql_cache, track_new_model
+from .models import AdvancedFilter
+
+
+@receiver(post_save, sender=AdvancedFilter)
+@receiver(post_delete, sender=AdvancedFilter)
+def invalidate_compiled_sql(sender, instance, **kwargs):
+    instance.invalidate_compiled_sql()
+
+
+@receiver(post_migrate)
+def clear_compiled_sql(sender, **kwargs):
+    sql_cache.clear()
+
+
+@receiver(class_prepared)
+def model_prepared(sender, **kwargs):
+    track_new_model(sender)
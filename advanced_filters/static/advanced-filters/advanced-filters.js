@@ -83,10 +83,26 @@ var OperatorHandlers = function($) {
 							  MODEL_LABEL) + '/' + field;
 			var input = $(elm).parents('tr').find('input.query-value');
 			input.select2("destroy");
-			$.get(choices_url, function(data) {
-				input.select2({'data': data, 'createSearchChoice': function(term) {
-	                return { 'id': term, 'text': term };
-	            }});
+			// choices are searched and paged by the server as the user types
+			input.select2({
+				'ajax': {
+					'url': choices_url,
+					'dataType': 'json',
+					'quietMillis': 250,
+					'data': function(term, page) {
+						return { 'term': term, 'page': page };
+					},
+					'results': function(data, page) {
+						return { 'results': data.results, 'more': data.more };
+					}
+				},
+				'initSelection': function(element, callback) {
+					var value = $(element).val();
+					callback({ 'id': value, 'text': value });
+				},
+				'createSearchChoice': function(term) {
+					return { 'id': term, 'text': term };
+				}
 			});
 		}
 		else {
@@ -117,9 +133,49 @@ var OperatorHandlers = function($) {
 			}
 			op.val("iexact").change();
 			self.initialize_select2(elm);
+			self.expand_relation(elm);
 		}
 	};
 
+	self.expanded_relations = {};
+
+	self.expand_relation = function(elm) {
+		// load the fields of a selected relation (marked as such when using
+		// advanced_filter_fields = '__all__') into all field selects
+		var path = $(elm).val();
+		var option = $(elm).find('option:selected');
+		if (!window.ADVANCED_FILTER_TREE_URL || !option.data('relation') ||
+				self.expanded_relations[path]) {
+			return;
+		}
+		self.expanded_relations[path] = true;
+		var tree_url = ADVANCED_FILTER_TREE_URL + (FORM_MODEL || MODEL_LABEL) + '/';
+		$.get(tree_url, {'path': path}, function(data) {
+			$('select.query-field').each(function() {
+				var select = $(this);
+				var anchor = select.find('option').filter(function() {
+					return this.value == path;
+				});
+				$.each(data.results, function(i, result) {
+					var exists = select.find('option').filter(function() {
+						return this.value == result.id;
+					});
+					if (exists.length) return;
+					var child = $('<option>').val(result.id).text(result.text);
+					if (result.relation) child.attr('data-relation', 'true');
+					if (anchor.length) {
+						anchor.after(child);
+					} else {
+						select.append(child);
+					}
+					anchor = child;
+				});
+			});
+		}).fail(function() {
+			delete self.expanded_relations[path];
+		});
+	};
+
 	self.init = function() {
 		var rows = $('[data-rules-formset] tr.form-row');
 		if (rows.length == 1 && rows.eq(0).hasClass('empty-form')) {
@@ -2,12 +2,14 @@ try:
     from django.urls import reverse
 except ImportError:  # Django < 2.0
     from django.core.urlresolvers import reverse
+from django.contrib.admin import ModelAdmin, site
 from django.contrib.auth.models import Permission
 from django.db.models import Q
 from django.test import TestCase
+from unittest.mock import patch
 
 from ..models import AdvancedFilter
-from ..admin import AdvancedListFilters
+from ..admin import AdminAdvancedFiltersMixin, AdvancedListFilters
 from tests import factories
 
 
@@ -174,3 +176,149 @@ class AdvancedFilterUsageTest(TestCase):
         assert cl.filter_specs
         if hasattr(cl, 'queryset'):
             assert cl.queryset.count() == 2
+
+    def test_filter_counts(self):
+        self.a.users.add(self.user)
+        url = reverse('admin:customers_client_changelist')
+        model_admin = site._registry[self.a.model_class]
+        with patch.object(model_admin, 'advanced_filter_show_counts', True):
+            res = self.client.get(url)
+        assert res.status_code == 200
+        assert 'Russian speakers (2)' in res.content.decode('utf-8')
+
+
+class KeysetPaginationTest(TestCase):
+    """ Test seek pagination of changelists filtered by an advanced filter """
+    def setUp(self):
+        self.user = factories.SalesRep()
+        assert self.client.login(username='user', password='test')
+        self.clients = factories.Client.create_batch(
+            5, assigned_to=self.user, language='ru')
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='change_client'))
+        self.a = AdvancedFilter(title='Russian speakers', url='foo',
+                                created_by=self.user, model='customers.Client')
+        self.a.query = Q(language='ru')
+        self.a.save()
+        self.a.users.add(self.user)
+        self.url = reverse('admin:customers_client_changelist')
+        model_admin = site._registry[self.a.model_class]
+        patches = [
+            patch.object(model_admin, 'advanced_filter_keyset_pagination',
+                         True),
+            patch.object(model_admin, 'list_per_page', 2),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _get_page(self, **params):
+        params['_afilter'] = self.a.pk
+        res = self.client.get(self.url, data=params)
+        assert res.status_code == 200
+        return res.context_data['cl']
+
+    def test_seek_pages(self):
+        pks = [c.pk for c in self.clients]
+        no_count = AssertionError('count() should not be called')
+        with patch('django.db.models.query.QuerySet.count',
+                   side_effect=no_count):
+            cl = self._get_page()
+        assert cl.keyset_pagination
+        assert [c.pk for c in cl.result_list] == pks[:2]
+        assert cl.previous_url is None
+        assert '_after=%s' % pks[1] in cl.next_url
+
+        cl = self._get_page(_after=pks[1])
+        assert [c.pk for c in cl.result_list] == pks[2:4]
+        assert '_before=%s' % pks[2] in cl.previous_url
+
+        cl = self._get_page(_after=pks[3])
+        assert [c.pk for c in cl.result_list] == pks[4:]
+        assert cl.next_url is None
+
+        cl = self._get_page(_before=pks[2])
+        assert [c.pk for c in cl.result_list] == pks[:2]
+
+    def test_invalid_cursor(self):
+        for params in ({'_after': 'abc'}, {'_before': '1.5'}):
+            params['_afilter'] = self.a.pk
+            res = self.client.get(self.url, data=params)
+            # the admin redirects to the changelist with ?e=1
+            assert res.status_code == 302
+            assert res['Location'].endswith('?e=1')
+
+    def test_sorting_falls_back_to_offset_pagination(self):
+        cl = self._get_page(o='1')
+        assert not cl.keyset_pagination
+        assert cl.result_count == 5
+
+
+class EstimatedCountTest(TestCase):
+    """ Test approximate counts of changelists filtered by a filter """
+    def setUp(self):
+        self.user = factories.SalesRep()
+        assert self.client.login(username='user', password='test')
+        factories.Client.create_batch(5, assigned_to=self.user, language='ru')
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='change_client'))
+        self.a = AdvancedFilter(title='Russian speakers', url='foo',
+                                created_by=self.user, model='customers.Client')
+        self.a.query = Q(language='ru')
+        self.a.save()
+        self.a.users.add(self.user)
+        self.url = reverse('admin:customers_client_changelist')
+        self.model_admin = site._registry[self.a.model_class]
+        p = patch.object(self.model_admin, 'list_per_page', 2)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def _get_changelist(self, threshold, **params):
+        params['_afilter'] = self.a.pk
+        with patch.object(self.model_admin, 'advanced_filter_count_threshold',
+                          threshold):
+            res = self.client.get(self.url, data=params)
+        assert res.status_code == 200
+        return res.context_data['cl'], res.content.decode('utf-8')
+
+    def test_exact_below_threshold(self):
+        cl, _ = self._get_changelist(10)
+        assert not cl.count_is_estimate
+        assert cl.result_count == 5
+        assert cl.show_full_result_count
+
+    def test_capped_above_threshold(self):
+        cl, content = self._get_changelist(3)
+        assert cl.count_is_estimate
+        assert cl.result_count == 3
+        assert not cl.show_full_result_count
+        assert cl.full_result_count is None
+        assert '3+ clients' in content
+        assert 'p=1' in cl.next_page_url
+
+        # paging past the capped count
+        cl, _ = self._get_changelist(3, p=2)
+        assert len(cl.result_list) == 1
+        assert cl.next_page_url is None
+
+    def test_capped_below_page_size(self):
+        with patch.object(self.model_admin, 'list_per_page', 3):
+            cl, _ = self._get_changelist(2)
+        assert cl.count_is_estimate
+        assert cl.multi_page
+        assert len(cl.result_list) == 3
+
+
+class TrackModelChangesTest(TestCase):
+    def test_all_fields_tracks_direct_relations(self):
+        class AllFieldsAdmin(AdminAdvancedFiltersMixin, ModelAdmin):
+            advanced_filter_fields = '__all__'
+
+        Client = factories.Client._meta.model
+        Rep = factories.SalesRep._meta.model
+        with patch('advanced_filters.admin.track_model_changes') as track:
+            AllFieldsAdmin(Client, site)
+        tracked = track.call_args[0][0]
+        assert {Client, Rep} <= tracked
+        # relations of related models are tracked once a filter uses them
+        assert Rep.groups.field.related_model not in tracked
@@ -0,0 +1,76 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import Group
+from django.db.models import Q
+from django.test import TestCase, override_settings
+
+from ..compiler import compile_query, filter_queryset, resolve_lookup
+from ..models import AdvancedFilter
+from tests import factories
+
+
+class FilterCompilerTest(TestCase):
+    def setUp(self):
+        self.user = factories.SalesRep()
+        self.other = factories.SalesRep(username='other', email='o@o.com')
+        self.group_a = Group.objects.create(name='a')
+        self.group_b = Group.objects.create(name='b')
+        self.user.groups.add(self.group_a, self.group_b)
+        self.other.groups.add(self.group_a)
+        self.Rep = type(self.user)
+
+    def test_resolve_lookup(self):
+        fields, lookups = resolve_lookup(self.Rep, 'groups__name__iexact')
+        assert [f.name for f in fields] == ['groups', 'name']
+        assert lookups == ['iexact']
+
+    def test_forward_paths_are_not_subqueries(self):
+        factories.Client.create_batch(2, assigned_to=self.user)
+        query = Q(assigned_to__username='user') & Q(email__icontains='foo')
+        compiled = compile_query(factories.Client._meta.model, query)
+        assert not compiled.annotations
+        qs = compiled.apply(factories.Client._meta.model.objects.all())
+        assert not qs.query.distinct
+        assert qs.count() == 2
+
+    def test_multivalued_paths_use_exists(self):
+        query = Q(groups__name='a') & Q(groups__name='b')
+        compiled = compile_query(self.Rep, query)
+        assert len(compiled.annotations) == 2
+        qs = filter_queryset(self.Rep.objects.all(), query)
+        assert 'DISTINCT' not in str(qs.query)
+        assert list(qs) == [self.user]
+
+    def test_matches_legacy_semantics(self):
+        queries = [
+            Q(groups__name='a') & Q(groups__name='b'),
+            Q(groups__name='a') & ~Q(groups__name='b'),
+            Q(username='user') & Q(groups__name__iexact='A'),
+        ]
+        for query in queries:
+            new = filter_queryset(self.Rep.objects.all(), query)
+            with override_settings(ADVANCED_FILTERS_LEGACY_FILTERING=True):
+                legacy = filter_queryset(self.Rep.objects.all(), query)
+                assert legacy.query.distinct
+            assert set(new) == set(legacy), query
+
+    def test_filtering_default_manager(self):
+        # i.e a soft-delete manager hiding every row
+        hidden = self.Rep._base_manager.none()
+        query = Q(groups__name='a') & Q(groups__name='b')
+        with patch.object(self.Rep._meta, 'default_manager', hidden):
+            qs = filter_queryset(self.Rep._base_manager.all(), query)
+            assert list(qs) == [self.user]
+            compiled = compile_query(self.Rep, query, correlated=False)
+            qs = compiled.apply(self.Rep._base_manager.all())
+            assert list(qs) == [self.user]
+
+    def test_top_level_or(self):
+        query = Q(groups__name='b') | Q(username='other')
+        qs = filter_queryset(self.Rep.objects.all(), query)
+        assert set(qs) == {self.user, self.other}
+
+    def test_filter_queryset(self):
+        af = AdvancedFilter(model='reps.SalesRep')
+        af.query = Q(groups__name='a') & Q(groups__name='b')
+        assert list(af.filter_queryset()) == [self.user]
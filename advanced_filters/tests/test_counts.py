@@ -0,0 +1,97 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+
+from ..counts import _planner_estimate, count_filters, estimate_distinct
+from ..models import AdvancedFilter
+from tests import factories
+
+
+class CountFiltersTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = factories.SalesRep()
+        self.Rep = type(self.user)
+        factories.SalesRep(username='other', email='o@o.com')
+        self.user.groups.add(Group.objects.create(name='a'))
+
+    def _filter(self, query):
+        af = AdvancedFilter(title='t', url='t', created_by=self.user,
+                            model='reps.SalesRep')
+        af.query = query
+        af.save()
+        return af
+
+    def test_count_in_one_query(self):
+        filters = [
+            self._filter(Q(username='other')),
+            self._filter(Q(groups__name='a')),
+            self._filter(~Q(groups__name='a') & Q(is_staff=True)),
+        ]
+        with self.assertNumQueries(1):
+            counts = count_filters(filters, self.Rep.objects.all())
+        assert counts == {filters[0].pk: 1, filters[1].pk: 1,
+                          filters[2].pk: 1}
+        # served from the cache
+        with self.assertNumQueries(0):
+            assert count_filters(filters, self.Rep.objects.all()) == counts
+
+    def test_invalid_filter_falls_back(self):
+        good = self._filter(Q(username='other'))
+        bad = self._filter(Q(no_such_field='x'))
+        counts = count_filters([good, bad], self.Rep.objects.all())
+        assert counts == {good.pk: 1, bad.pk: None}
+
+    def test_empty_queryset(self):
+        af = self._filter(Q(username='other'))
+        for queryset in (self.Rep.objects.none(),
+                         self.Rep.objects.filter(pk__in=[])):
+            with self.assertNumQueries(0):
+                assert count_filters([af], queryset) == {af.pk: 0}
+
+
+class PlannerEstimateTest(TestCase):
+    def test_json_plan(self):
+        plan = [{'Plan': {'Node Type': 'Seq Scan', 'Plan Rows': 1234}}]
+        Rep = factories.SalesRep._meta.model
+        # psycopg2 decodes the json column, other drivers may not
+        for row in ((plan,), ('[{"Plan": {"Plan Rows": 1234}}]',)):
+            with patch.object(connection, 'cursor') as cursor:
+                cur = cursor.return_value.__enter__.return_value
+                cur.fetchone.return_value = row
+                assert _planner_estimate(
+                    Rep.objects.filter(username='a')) == 1234
+            sql = cur.execute.call_args[0][0]
+            assert sql.startswith('EXPLAIN (FORMAT JSON) SELECT')
+
+
+class EstimateDistinctTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = factories.SalesRep()
+        self.Client = type(factories.Client(assigned_to=self.user,
+                                            language='en'))
+        factories.Client.create_batch(3, assigned_to=self.user,
+                                      language='it')
+
+    def test_sampled_estimate(self):
+        language = self.Client._meta.get_field('language')
+        email = self.Client._meta.get_field('email')
+        assert estimate_distinct(self.Client, language) == 2
+        with override_settings(ADVANCED_FILTERS_CARDINALITY_SAMPLE_SIZE=2):
+            # a lower bound from the sample
+            assert estimate_distinct(self.Client, email) == 2
+
+    def test_cached_estimate(self):
+        language = self.Client._meta.get_field('language')
+        assert estimate_distinct(self.Client, language) == 2
+        factories.Client(assigned_to=self.user, language='sp')
+        with self.assertNumQueries(0):
+            assert estimate_distinct(self.Client, language) == 2
+        with override_settings(ADVANCED_FILTERS_CARDINALITY_TIMEOUT=0):
+            cache.clear()
+            assert estimate_distinct(self.Client, language) == 3
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+from django.test import TestCase
+from django.utils import timezone
+
+from ..evaluator import UnsupportedLookup, compile_matcher
+from ..models import AdvancedFilter
+from tests import factories
+
+
+class EvaluatorTest(TestCase):
+    def setUp(self):
+        self.user = factories.SalesRep()
+        self.other = factories.SalesRep(username='other', email='o@o.com')
+        now = timezone.now()
+        self.clients = [
+            factories.Client(assigned_to=self.user, first_name='John',
+                             language='en', date_joined=now),
+            factories.Client(assigned_to=self.other, first_name='Paul',
+                             language='it', is_active=False,
+                             date_joined=now - timedelta(days=30)),
+            factories.Client(assigned_to=self.user, first_name='',
+                             language='sp', email='x@bar.com'),
+        ]
+        self.Client = type(self.clients[0])
+
+    def assert_same_as_db(self, query):
+        matcher = compile_matcher(self.Client, query)
+        expected = set(self.Client.objects.filter(query).values_list(
+            'pk', flat=True))
+        actual = set(c.pk for c in self.clients if matcher(c))
+        assert actual == expected, query
+
+    def test_operators(self):
+        last_week = datetime.now() - timedelta(days=7)
+        queries = [
+            Q(first_name__iexact='john'),
+            Q(first_name__icontains='AU'),
+            Q(language__iregex='(en|sp)'),
+            Q(date_joined__range=(last_week, datetime.now() +
+                                  timedelta(days=1))),
+            Q(date_joined__lt=last_week),
+            Q(date_joined__gte=last_week),
+            Q(id__gt=self.clients[0].pk),
+            Q(id__lte=self.clients[1].pk),
+            Q(is_active=True),
+            Q(is_active=False),
+            Q(email__isnull=True),
+        ]
+        for query in queries:
+            self.assert_same_as_db(query)
+
+    def test_relations_and_connectors(self):
+        queries = [
+            Q(assigned_to__username__iexact='USER'),
+            Q(assigned_to=self.other.pk),
+            ~Q(assigned_to__email__icontains='example'),
+            Q(language='en') | Q(is_active=False),
+            Q(assigned_to__username='user') & ~Q(language__iexact='EN'),
+            Q(),
+        ]
+        for query in queries:
+            self.assert_same_as_db(query)
+
+    def test_unsupported_lookups(self):
+        with self.assertRaises(UnsupportedLookup):
+            compile_matcher(type(self.user), Q(groups__name='a'))
+        with self.assertRaises(UnsupportedLookup):
+            compile_matcher(self.Client, Q(first_name__unaccent='a'))
+
+    def test_advanced_filter_matches(self):
+        af = AdvancedFilter(model='customers.Client')
+        af.query = Q(language__iregex='(en|it)') & Q(is_active=True)
+        with self.assertNumQueries(0):
+            assert af.matches(self.clients[0])
+            assert af.matches_many(self.clients) == [True, False, False]
+
+    def test_relations_are_prefetched(self):
+        af = AdvancedFilter(model='customers.Client')
+        af.query = Q(assigned_to__email__icontains='o@') | Q(language='sp')
+        clients = list(self.Client.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            assert af.matches_many(clients) == [False, True, True]
+        with self.assertNumQueries(0):
+            assert af.matches_many(clients) == [False, True, True]
+
+    def test_advanced_filter_falls_back_to_db(self):
+        self.user.groups.create(name='a')
+        af = AdvancedFilter(model='reps.SalesRep')
+        af.query = Q(groups__name='a')
+        with self.assertNumQueries(1):
+            assert af.matches_many([self.user, self.other]) == [True, False]
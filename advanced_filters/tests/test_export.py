@@ -0,0 +1,123 @@
+import json
+from unittest.mock import patch
+
+from django.contrib.admin import site
+from django.contrib.auth.models import Permission
+from django.core.management import call_command, CommandError
+from django.db.models import Q
+from django.test import TestCase
+from django.utils.six import StringIO
+try:
+    from django.urls import reverse
+except ImportError:  # Django < 2.0
+    from django.core.urlresolvers import reverse
+
+import pytest
+
+from ..models import AdvancedFilter
+from tests import factories
+
+
+class ExportTestMixin(object):
+    def setUp(self):
+        self.user = factories.SalesRep()
+        factories.Client.create_batch(3, assigned_to=self.user, language='en')
+        factories.Client.create_batch(2, assigned_to=self.user, language='it')
+        self.advfilter = AdvancedFilter(
+            title='Italians', url='foo', created_by=self.user,
+            model='customers.Client')
+        self.advfilter.query = Q(language='it')
+        self.advfilter.save()
+
+
+class RunAdvancedFilterCommandTest(ExportTestMixin, TestCase):
+    def test_csv(self):
+        out = StringIO()
+        call_command('run_advanced_filter', self.advfilter.pk,
+                     fields='email,language,assigned_to__username',
+                     stdout=out)
+        lines = out.getvalue().splitlines()
+        assert lines[0] == 'email,language,assigned_to__username'
+        assert len(lines) == 3
+        assert all(line.endswith(',it,user') for line in lines[1:])
+
+    def test_jsonl(self):
+        out = StringIO()
+        call_command('run_advanced_filter', self.advfilter.pk,
+                     format='jsonl', chunk_size=1, stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert len(rows) == 2
+        assert set(rows[0]) >= {'id', 'email', 'assigned_to_id'}
+        assert 'password' not in rows[0]
+
+    def test_invalid_fields(self):
+        with pytest.raises(CommandError):
+            call_command('run_advanced_filter', self.advfilter.pk,
+                         fields='no_such_field', stdout=StringIO())
+        # multi-valued paths would repeat rows
+        with pytest.raises(CommandError):
+            call_command('run_advanced_filter', self.advfilter.pk,
+                         fields='email,assigned_to__groups__name',
+                         stdout=StringIO())
+
+
+class ExportFilterResultsViewTest(ExportTestMixin, TestCase):
+    def setUp(self):
+        super(ExportFilterResultsViewTest, self).setUp()
+        assert self.client.login(username='user', password='test')
+        self.advfilter.users.add(self.user)
+        self.url = reverse('afilters_export', args=(self.advfilter.pk,))
+
+    def test_requires_model_permission(self):
+        res = self.client.get(self.url)
+        assert res.status_code == 404
+
+    def test_streaming_csv(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='view_client'))
+        res = self.client.get(self.url, {'fields': 'email,language'})
+        assert res.status_code == 200
+        assert res.streaming
+        assert res['Content-Type'] == 'text/csv'
+        content = b''.join(res.streaming_content).decode('utf-8')
+        assert content.splitlines()[0] == 'email,language'
+        assert len(content.splitlines()) == 3
+
+    def test_exposed_fields_only(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='view_client'))
+        # exposed by the advanced_filter_fields of ClientAdmin
+        res = self.client.get(self.url, {'fields': 'id,assigned_to__email'})
+        assert res.status_code == 200
+        for fields in ('assigned_to__password', 'assigned_to__username',
+                       'password'):
+            res = self.client.get(self.url, {'fields': fields})
+            assert res.status_code == 400
+
+    def test_model_admin_queryset(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='view_client'))
+        Client = self.advfilter.model_class
+        visible = Client.objects.filter(language='it').first()
+        with patch.object(site._registry[Client], 'get_queryset',
+                          return_value=Client.objects.filter(pk=visible.pk)):
+            res = self.client.get(self.url, {'format': 'jsonl'})
+            rows = [json.loads(line) for line in res.streaming_content]
+        assert [row['id'] for row in rows] == [visible.pk]
+        assert 'password' not in rows[0]
+
+    def test_invalid_format(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='view_client'))
+        res = self.client.get(self.url, {'format': 'xls'})
+        assert res.status_code == 400
+
+
+class RefreshSnapshotsCommandTest(ExportTestMixin, TestCase):
+    def test_refresh(self):
+        self.advfilter.materialized = True
+        self.advfilter.save()
+        out = StringIO()
+        call_command('refresh_advanced_filter_snapshots', stdout=out)
+        assert '5 rows tested, 2 matching' in out.getvalue()
+        assert self.advfilter.snapshot_rows.count() == 2
@@ -0,0 +1,57 @@
+from django.contrib import admin
+from django.test import TestCase
+
+from ..field_tree import FieldTree, model_fields
+from tests.customers.models import Client
+from tests.reps.models import SalesRep
+
+
+class FieldTreeTest(TestCase):
+    def test_model_fields(self):
+        fields = dict((name, (verbose_name, related))
+                      for name, verbose_name, related in model_fields(SalesRep))
+        assert fields['username'][1] is None
+        assert fields['groups'][1] is not None
+        # reverse relations, by their query name
+        assert fields['client'] == ('clients', Client)
+
+    def test_children(self):
+        tree = FieldTree(Client, exclude=['password', 'assigned_to__user_*'])
+        top = dict((path, expandable) for path, _, expandable in tree.children())
+        assert 'password' not in top
+        assert top['assigned_to'] and not top['email']
+        children = dict((path, (name, expandable)) for path, name, expandable
+                        in tree.children('assigned_to'))
+        assert children['assigned_to__email'] == (
+            'assigned to / email address', False)
+        # depth is exhausted: relations of the related model are leaves
+        assert children['assigned_to__groups'][1] is False
+        assert 'assigned_to__user_permissions' not in children
+        assert tree.children('assigned_to__groups') is None
+        assert tree.children('email') is None
+
+    def test_allows(self):
+        tree = FieldTree(Client, include=['assigned_to__groups__name'],
+                         exclude=['last_*'], max_depth=1)
+        assert tree.allows('assigned_to__email')
+        assert tree.allows('assigned_to__groups__name')
+        assert not tree.allows('assigned_to__groups__permissions')
+        assert not tree.allows('last_name')
+        assert not tree.allows('assigned_to__nope')
+        assert not tree.allows('_OR')
+        assert [f for f in tree.fields(['assigned_to__email', 'last_name'])
+                if '__' in f[0]] == [
+            ('assigned_to__groups__name', 'assigned to / groups / name'),
+            ('assigned_to__email', 'assigned to / email address')]
+
+    def test_for_admin(self):
+        model_admin = admin.site._registry[Client]
+        assert FieldTree.for_admin(model_admin) is None
+        model_admin.advanced_filter_fields = '__all__'
+        model_admin.advanced_filter_max_depth = 2
+        try:
+            tree = FieldTree.for_admin(model_admin)
+            assert tree.model is Client and tree.max_depth == 2
+        finally:
+            del model_admin.advanced_filter_fields
+            del model_admin.advanced_filter_max_depth
@@ -5,6 +5,7 @@ from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.db.models import Q, FieldDoesNotExist
 from django.test import TestCase
+from django.utils import timezone
 import django
 
 import pytest
@@ -209,6 +210,67 @@ class TestQueryForm(TestCase):
             assert res == expected[i]
 
 
+class TestTypedQueryForm(TestCase):
+    fields = dict(assigned_to='assigned', date_joined='joined',
+                  first_name='first name', id='id')
+
+    def setUp(self):
+        from tests import factories
+        self.rep = factories.SalesRep()
+        self.Client = type(factories.Client(assigned_to=self.rep))
+
+    def build(self, **data):
+        data.setdefault('operator', 'iexact')
+        form = AdvancedFilterQueryForm(self.fields, data=data,
+                                       model=self.Client)
+        assert form.is_valid(), form.errors
+        return form._build_query_dict()
+
+    def test_equals_uses_exact_for_typed_fields(self):
+        assert self.build(field='assigned_to', value=str(self.rep.pk)) == {
+            'assigned_to__exact': self.rep.pk}
+        assert self.build(field='id', value='7', operator='gte') == {
+            'id__gte': 7}
+        query = self.build(field='date_joined', value='2020-01-02 10:00')
+        assert list(query) == ['date_joined__exact']
+        assert query['date_joined__exact'].startswith('2020-01-02T10:00:00')
+
+    def test_equals_uses_current_time_zone(self):
+        with timezone.override('Asia/Tokyo'):
+            query = self.build(field='date_joined', value='2020-01-02 10:00')
+        assert query['date_joined__exact'].startswith(
+            '2020-01-02T10:00:00+09:00')
+
+    def test_equals_keeps_iexact_for_text(self):
+        assert self.build(field='first_name', value='john') == {
+            'first_name__iexact': 'john'}
+        # not an integer: kept as it was submitted
+        assert self.build(field='id', value='x') == {'id__iexact': 'x'}
+
+    def test_one_of_is_anchored(self):
+        assert self.build(field='first_name', value='john, paul',
+                          operator='iregex') == {
+            'first_name__iregex': '^(john|paul)$'}
+        assert self.build(field='first_name', value='john',
+                          operator='iregex') == {
+            'first_name__iregex': '^(john)$'}
+        # a restored filter is saved again as it was
+        assert self.build(field='first_name', value='^(john|paul)$',
+                          operator='iregex') == {
+            'first_name__iregex': '^(john|paul)$'}
+
+    def test_exact_is_restored_as_equals(self):
+        af = AdvancedFilter(model='customers.Client')
+        af.query = Q(assigned_to__exact=3) & Q(
+            date_joined__exact=datetime(2020, 1, 2, 10, 0))
+        parsed = [AdvancedFilterQueryForm._parse_query_dict(f, self.Client)
+                  for f in af.list_fields()]
+        assert [(f['field'], f['operator'], f['value']) for f in parsed] == [
+            ('assigned_to', 'iexact', 3),
+            ('date_joined', 'iexact', '2020-01-02 10:00:00'),
+        ]
+
+
 class CommonFormTest(TestCase):
     mgmg_form_data = {
         'form-TOTAL_FORMS': 1,
@@ -285,6 +347,56 @@ class TestAdvancedFilterForm(CommonFormTest):
                                    ['last_name__iexact', 'john'])
 
 
+class TestSharedChoices(CommonFormTest):
+    fields = ['first_name', 'last_name', ('groups__name', 'Group')]
+
+    def test_choices_are_shared(self):
+        self.af.query = Q(first_name='a') | Q(last_name__icontains='b')
+        form = AdvancedFilterForm(instance=self.af, filter_fields=self.fields)
+        formset = form.fields_formset
+        choices = formset.forms[0].fields['field'].choices
+        assert [c[0] for c in choices] == [
+            'first_name', 'last_name', 'groups__name', '_OR']
+        assert all(f.FIELD_CHOICES is formset.forms[0].FIELD_CHOICES
+                   for f in formset.forms + [formset.empty_form])
+
+
+class TestAllFields(CommonFormTest):
+    def _field(self, form, index=0):
+        return form.fields_formset.forms[index].fields['field']
+
+    def test_model_fields_and_relations(self):
+        form = AdvancedFilterForm(instance=self.af, filter_fields='__all__')
+        field = self._field(form)
+        paths = [c[0] for c in field.choices]
+        assert 'username' in paths and 'groups' in paths
+        assert 'groups__name' not in paths
+        assert 'data-relation' in field.widget.render('field', None)
+        assert 'data-relation="true">Groups' in field.widget.render(
+            'field', None)
+
+    def test_related_paths_are_valid(self):
+        data = self._create_query_form_data(data=dict(
+            field='groups__name', value='staff', operator='iexact'))
+        form = AdvancedFilterForm(data, instance=self.af,
+                                  filter_fields='__all__')
+        assert form.is_valid(), (form.errors, form.fields_formset.errors)
+        instance = form.save(commit=False)
+        assert instance.query.children == [['groups__name__iexact', 'staff']]
+
+        # the path of a stored row is listed
+        form = AdvancedFilterForm(instance=instance, filter_fields='__all__')
+        assert ('groups__name', 'Groups / name') in [
+            tuple(c) for c in self._field(form).choices]
+
+        # too deep
+        data = self._create_query_form_data(data=dict(
+            field='groups__permissions__name', value='x', operator='iexact'))
+        form = AdvancedFilterForm(data, instance=self.af,
+                                  filter_fields='__all__')
+        assert not form.is_valid()
+
+
 class TestAdminInitialization(CommonFormTest):
     def setUp(self):
         super(TestAdminInitialization, self).setUp()
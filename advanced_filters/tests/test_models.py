@@ -1,7 +1,13 @@
-from django.test import TestCase
+from importlib import import_module
+from unittest.mock import patch
+
+from django.apps import apps
+from django.test import TestCase, override_settings
 from django.db.models import Q
 
+from ..cache import get_model_versions, query_cache, query_digest, sql_cache
 from ..models import AdvancedFilter
+from ..q_serializer import QSerializer
 
 
 class AdvancedFilterPermissions(TestCase):
@@ -59,3 +65,298 @@ class AdvancedFilterPermissions(TestCase):
             'value_to': 10,
             'negate': True,
         }]
+
+    def test_query_cache_returns_copies(self):
+        query_cache.clear()
+        self.advancedfilter.query = Q(some_field__range=(1, 10))
+        query = self.advancedfilter.query
+        query.children.append(('other_field', 1))
+        query.children[0][1] = None
+
+        fresh = self.advancedfilter.query
+        assert len(fresh.children) == 1
+        assert fresh.children[0][1] is not None
+        assert self.advancedfilter.list_fields()[0]['value'] == [1, 10]
+        stats = query_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+
+    def test_query_format(self):
+        query = Q(some_field__iexact='some_value')
+        self.advancedfilter.query = query
+        assert self.advancedfilter.b64_query == QSerializer(
+            base64=True).dumps(query)
+        with override_settings(ADVANCED_FILTERS_QUERY_FORMAT='binary'):
+            self.advancedfilter.query = query
+        assert self.advancedfilter.b64_query.startswith('r1EB')  # b'\xafQ\x01'
+        assert self.advancedfilter.query.children == [
+            ['some_field__iexact', 'some_value']]
+
+    def test_migrate_legacy_queries(self):
+        migration = import_module(
+            'advanced_filters.migrations.0008_binary_query')
+        legacy = QSerializer(base64=True).dumps(Q(some_field__range=(1, 10)))
+        AdvancedFilter.objects.filter(pk=self.advancedfilter.pk).update(
+            b64_query=legacy, snapshot_query_hash=query_digest(legacy))
+
+        # the data migration only converts with the binary format enabled
+        migration.forwards(apps, None)
+        assert AdvancedFilter.objects.get(
+            pk=self.advancedfilter.pk).b64_query == legacy
+        with override_settings(ADVANCED_FILTERS_QUERY_FORMAT='binary'):
+            migration.forwards(apps, None)
+        converted = AdvancedFilter.objects.get(pk=self.advancedfilter.pk)
+        assert converted.b64_query != legacy
+        assert converted.snapshot_query_hash == query_digest(
+            converted.b64_query)
+        assert converted.list_fields()[0]['value'] == [1, 10]
+
+        migration.to_json(apps, None)
+        reverted = AdvancedFilter.objects.get(pk=self.advancedfilter.pk)
+        assert reverted.b64_query.startswith('ey')  # b'{"'
+        assert reverted.list_fields()[0]['value'] == [1, 10]
+
+
+class AdvancedFilterCompiledSQL(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import Group
+        from tests import factories
+        self.user = factories.SalesRep()
+        factories.SalesRep(username='other', email='o@o.com')
+        self.user.groups.add(Group.objects.create(name='a'))
+        self.advancedfilter = AdvancedFilter.objects.create(
+            title='test', url='test', created_by=self.user,
+            model='reps.SalesRep', b64_query='MQ==')
+        self.advancedfilter.query = Q(groups__name='a')
+        self.advancedfilter.save()
+        sql_cache.clear()
+
+    @override_settings(ADVANCED_FILTERS_COMPILED_SQL_CACHE=True)
+    def test_compiled_sql_is_reused(self):
+        qs = self.advancedfilter.filter_queryset()
+        assert list(qs) == [self.user]
+        assert sql_cache.stats()['misses'] == 1
+        assert list(self.advancedfilter.filter_queryset()) == [self.user]
+        assert sql_cache.stats()['hits'] == 1
+
+    def test_compiled_for_database(self):
+        from django.db.models.sql.query import Query
+        with patch.object(Query, 'get_compiler', autospec=True) as compiler:
+            compiler.return_value.as_sql.return_value = ('SQL', ())
+            assert self.advancedfilter.compiled_sql('replica') == ('SQL', ())
+        assert compiler.call_args[1] == {'using': 'replica'}
+
+    def test_compiled_with_base_manager(self):
+        # as the subqueries of compile_query, ignoring default manager filters
+        Rep = type(self.user)
+        assert type(Rep._default_manager) is not type(Rep._base_manager)
+        with patch.object(type(Rep._default_manager), 'get_queryset',
+                          return_value=Rep._base_manager.none()):
+            sql, params = self.advancedfilter.compiled_sql()
+        assert sql.startswith('SELECT')
+
+    @override_settings(ADVANCED_FILTERS_COMPILED_SQL_CACHE=True)
+    def test_compiled_sql_invalidated_on_save(self):
+        self.advancedfilter.compiled_sql()
+        assert len(sql_cache) == 1
+        self.advancedfilter.query = Q(username='other')
+        self.advancedfilter.save()
+        assert len(sql_cache) == 0
+        qs = self.advancedfilter.filter_queryset()
+        assert [u.username for u in qs] == ['other']
+
+
+class AdvancedFilterResultCache(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import Group
+        from django.core.cache import cache
+        from tests import factories
+        cache.clear()
+        self.user = factories.SalesRep()
+        self.group = Group.objects.create(name='a')
+        self.advancedfilter = AdvancedFilter(
+            title='test', url='test', created_by=self.user,
+            model='reps.SalesRep')
+        self.advancedfilter.query = Q(groups__name='a')
+        self.advancedfilter.save()
+
+    def test_related_models(self):
+        from django.contrib.auth.models import Group
+        related = self.advancedfilter.related_models()
+        assert type(self.user) in related
+        assert Group in related
+        assert type(self.user).groups.through in related
+
+    def test_results_cached_until_data_changes(self):
+        assert self.advancedfilter.result_count() == 0
+        with self.assertNumQueries(0):
+            assert self.advancedfilter.result_count() == 0
+
+        self.user.groups.add(self.group)  # m2m_changed
+        assert self.advancedfilter.result_pks() == [self.user.pk]
+        assert self.advancedfilter.result_count() == 1
+
+        self.group.name = 'b'
+        self.group.save()  # post_save on a related model
+        assert self.advancedfilter.result_count() == 0
+
+    def test_tracked_models(self):
+        from django.contrib.sessions.models import Session
+        from django.db.models.deletion import Collector
+        from tests import factories
+        collector = Collector(using='default')
+        # models no filter depends on keep their fast deletes
+        assert collector.can_fast_delete(Session.objects.all())
+        # models of admins using the mixin are tracked upfront
+        assert not collector.can_fast_delete(
+            factories.Client._meta.model.objects.all())
+
+    def test_proxy_changes_bump_the_concrete_model(self):
+        from django.db import models
+        from django.test.utils import isolate_apps
+        Rep = type(self.user)
+        self.advancedfilter.result_count()
+        with isolate_apps('tests.reps'):
+            class ProxyRep(Rep):
+                class Meta:
+                    proxy = True
+        versions = get_model_versions([Rep])
+        assert get_model_versions([ProxyRep]) == versions
+        assert models.signals.post_save.has_listeners(ProxyRep)
+        ProxyRep.objects.get(pk=self.user.pk).save()
+        assert get_model_versions([Rep]) != versions
+
+    @override_settings(ADVANCED_FILTERS_TRACK_MODEL_CHANGES=False)
+    def test_tracking_disabled(self):
+        from django.contrib.auth.models import Permission
+        from django.db.models.signals import post_delete
+        get_model_versions([Permission])
+        assert not post_delete.has_listeners(Permission)
+
+    def test_duplicates_share_results(self):
+        other = AdvancedFilter(
+            title='copy', url='test', created_by=self.user,
+            model='reps.SalesRep')
+        other.query = Q() & Q(groups__name='a') & Q(groups__name='a')
+        other.save()
+        assert other.fingerprint == self.advancedfilter.fingerprint
+        assert list(self.advancedfilter.duplicates()) == [other]
+
+        assert self.advancedfilter.result_count() == 0
+        with self.assertNumQueries(0):
+            assert other.result_count() == 0
+
+        other.query = Q(groups__name='b')
+        other.save()
+        assert not self.advancedfilter.duplicates().exists()
+
+
+class AdvancedFilterFieldPaths(TestCase):
+    def setUp(self):
+        from tests import factories
+        self.user = factories.SalesRep()
+        self.advancedfilter = AdvancedFilter(
+            title='test', url='test', created_by=self.user,
+            model='customers.Client')
+        self.advancedfilter.query = (Q(assigned_to__email__iexact='a@b.com') |
+                                     ~Q(language='en'))
+        self.advancedfilter.save()
+
+    def test_referencing(self):
+        assert set(self.advancedfilter.referenced_fields.values_list(
+            'path', flat=True)) == {
+                'assigned_to', 'assigned_to__email', 'language'}
+        for path in ('assigned_to__email', 'assigned_to', 'language'):
+            assert list(AdvancedFilter.objects.referencing(path)) == [
+                self.advancedfilter]
+        assert not AdvancedFilter.objects.referencing('email').exists()
+        assert not AdvancedFilter.objects.referencing(
+            'language', model='reps.SalesRep').exists()
+
+        self.advancedfilter.query = Q(language__iexact='it')
+        self.advancedfilter.save()
+        assert not AdvancedFilter.objects.referencing('assigned_to').exists()
+        assert AdvancedFilter.objects.referencing('language').count() == 1
+
+    def test_query_json(self):
+        import json
+        tree = json.loads(self.advancedfilter.query_json)
+        assert tree['connector'] == 'OR'
+        assert tree['children'][0] == ['assigned_to__email__iexact', 'a@b.com']
+        assert tree['children'][1]['negated']
+
+    def test_backfill(self):
+        migration = import_module(
+            'advanced_filters.migrations.0010_advancedfilter_field_paths')
+        AdvancedFilter.objects.update(query_json='')
+        self.advancedfilter.referenced_fields.all().delete()
+
+        migration.set_field_paths(apps, None)
+        assert AdvancedFilter.objects.get().query_json
+        assert list(AdvancedFilter.objects.referencing(
+            'assigned_to__email')) == [self.advancedfilter]
+
+
+class AdvancedFilterSnapshotTest(TestCase):
+    def setUp(self):
+        from tests import factories
+        self.user = factories.SalesRep()
+        self.clients = factories.Client.create_batch(
+            3, assigned_to=self.user, language='ru')
+        factories.Client.create_batch(2, assigned_to=self.user, language='en')
+        self.advancedfilter = AdvancedFilter(
+            title='test', url='test', created_by=self.user,
+            model='customers.Client', materialized=True)
+        self.advancedfilter.query = Q(language='ru')
+        self.advancedfilter.save()
+        self.Client = type(self.clients[0])
+
+    def test_full_refresh(self):
+        assert not self.advancedfilter.has_snapshot
+        assert self.advancedfilter.refresh_snapshot() == 5
+        assert self.advancedfilter.has_snapshot
+        assert self.advancedfilter.snapshot_rows.count() == 3
+
+        self.Client.objects.filter(pk=self.clients[0].pk).update(
+            language='en')
+        # served from the (now stale) snapshot until refreshed
+        qs = self.advancedfilter.filter_queryset()
+        assert 'advanced_filters_advancedfiltersnapshot' in str(qs.query)
+        assert qs.count() == 3
+        self.advancedfilter.refresh_snapshot()
+        assert self.advancedfilter.filter_queryset().count() == 2
+
+    def test_refresh_invalidates_cached_results(self):
+        from django.core.cache import cache
+        from django.db.models.deletion import Collector
+        cache.clear()
+        self.advancedfilter.refresh_snapshot()
+        assert len(self.advancedfilter.result_pks()) == 3
+        self.Client.objects.filter(pk=self.clients[0].pk).update(
+            language='en')
+        self.advancedfilter.refresh_snapshot(full=True)
+        assert len(self.advancedfilter.result_pks()) == 2
+        assert Collector(using='default').can_fast_delete(
+            self.advancedfilter.snapshot_rows.all())
+
+    def test_changed_query_is_not_served_from_snapshot(self):
+        self.advancedfilter.refresh_snapshot()
+        self.advancedfilter.query = Q(language='en')
+        assert not self.advancedfilter.has_snapshot
+        assert self.advancedfilter.filter_queryset().count() == 2
+
+    @override_settings(ADVANCED_FILTERS_SNAPSHOT_WATERMARK_FIELDS={
+        'customers.Client': 'date_joined'})
+    def test_incremental_refresh(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        self.advancedfilter.refresh_snapshot()
+        refreshed_at = self.advancedfilter.snapshot_refreshed_at
+
+        later = timezone.now() + timedelta(seconds=1)
+        changed = self.Client.objects.filter(pk=self.clients[0].pk)
+        changed.update(language='en', date_joined=later)
+        assert self.advancedfilter.refresh_snapshot() == 1
+        assert self.advancedfilter.snapshot_refreshed_at > refreshed_at
+        assert set(self.advancedfilter.filter_queryset()) == set(
+            self.clients[1:])
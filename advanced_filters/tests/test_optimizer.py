@@ -0,0 +1,177 @@
+from datetime import date, datetime, timedelta
+
+from django.db import models
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from ..models import AdvancedFilter
+from ..optimizer import literal_alternatives, optimize_query, rewrite_range
+from ..q_serializer import BinaryQSerializer, QSerializer
+from tests import factories
+
+
+class LiteralAlternativesTest(TestCase):
+    def test_literals(self):
+        assert literal_alternatives('^(a|b c|d-e)$') == ['a', 'b c', 'd-e']
+        assert literal_alternatives('^(a|b)$') == ['a', 'b']
+        assert literal_alternatives('^a\\+b$') == ['a+b']
+
+    def test_patterns(self):
+        for pattern in ('^(a|b)+$', '^(a|)$', '^$', '^a.b$', '^(a|[bc])$',
+                        '^\\d+$', '^(a|(b|c))$', '^a\\$', '^a|b$'):
+            assert literal_alternatives(pattern) is None, pattern
+
+    def test_unanchored(self):
+        # these match any value containing a literal, unlike an __in lookup
+        for pattern in ('(a|b)', 'test', '^(a|b)', '(a|b)$'):
+            assert literal_alternatives(pattern) is None, pattern
+
+
+class OptimizeQueryTest(TestCase):
+    def setUp(self):
+        self.user = factories.SalesRep()
+        self.Client = type(factories.Client(
+            assigned_to=self.user, language='en', first_name='John'))
+        factories.Client(assigned_to=self.user, language='it',
+                         first_name='johnny')
+        factories.Client(assigned_to=self.user, language='sp',
+                         first_name='Paul')
+
+    def optimize(self, query):
+        return optimize_query(self.Client, query)
+
+    def test_text_field(self):
+        query = self.optimize(Q(first_name__iregex='^(JOHN|paul|john)$'))
+        assert query.children == [('first_name__afilters_lower__in', ['john', 'paul'])]
+        sql = str(self.Client.objects.filter(query).query)
+        assert 'LOWER' in sql and 'REGEXP' not in sql
+        assert set(self.Client.objects.filter(query).values_list(
+            'first_name', flat=True)) == {'John', 'Paul'}
+
+        # values without a case do not need the transform
+        query = self.optimize(Q(email__iregex='^(1|2)$'))
+        assert query.children == [('email__in', ['1', '2'])]
+
+    def test_project_lookups_are_kept(self):
+        from django.db import models
+        assert 'lower' not in models.CharField.get_lookups()
+        assert 'afilters_lower' in models.TextField.get_lookups()
+
+    def test_other_fields(self):
+        query = self.optimize(
+            Q(assigned_to__iregex='^(%d|0)$' % self.user.pk) &
+            ~Q(id__iregex='^(x|1)$') &
+            Q(id__iregex='^(01)$'))
+        assert query.children[0] == ('assigned_to__in', [self.user.pk, 0])
+        # not an integer: kept as a regex
+        assert query.children[1].children == [('id__iregex', '^(x|1)$')]
+        assert query.children[1].negated
+        # 1 written out as text is not '01'
+        assert query.children[2] == ('id__iregex', '^(01)$')
+
+    def test_equals_on_typed_fields(self):
+        query = self.optimize(
+            Q(assigned_to__iexact=str(self.user.pk)) &
+            Q(assigned_to__email__iexact='A@B.com') &
+            Q(date_joined__iexact='2020-01-01') &
+            Q(id__iexact='x'))
+        assert query.children[:2] == [
+            ('assigned_to__exact', self.user.pk),
+            Q(assigned_to__email__iexact='A@B.com').children[0]]
+        lookup, value = query.children[2]
+        assert lookup == 'date_joined__exact' and value.tzinfo is not None
+        assert query.children[3] == ('id__iexact', 'x')
+        sql = str(self.Client.objects.filter(query.children[0]).query)
+        assert 'LIKE' not in sql and 'UPPER' not in sql
+
+    @override_settings(TIME_ZONE='Europe/Zagreb')
+    def test_equals_uses_default_time_zone(self):
+        with timezone.override('Asia/Tokyo'):
+            query = self.optimize(Q(date_joined__iexact='2020-01-01 10:00'))
+        lookup, value = query.children[0]
+        assert value == timezone.make_aware(
+            datetime(2020, 1, 1, 10), timezone.get_default_timezone())
+
+    def test_genuine_patterns_are_kept(self):
+        query = Q(first_name__iregex='^jo.*') | Q(language__iexact='en')
+        optimized = self.optimize(query)
+        assert optimized.children == query.children
+        assert optimized.connector == Q.OR
+        assert optimized is not query
+
+        # filters saved before "One of" was anchored match substrings
+        query = Q(first_name__iregex='(john|paul)')
+        assert self.optimize(query).children == query.children
+        assert set(self.Client.objects.filter(query).values_list(
+            'first_name', flat=True)) == {'John', 'johnny', 'Paul'}
+
+    def test_advanced_filter_query(self):
+        afilter = AdvancedFilter(model='customers.Client')
+        afilter.query = Q(language__iregex='^(EN|it)$')
+        assert afilter.query.children == [
+            ('language__afilters_lower__in', ['en', 'it'])]
+        assert afilter.filter_queryset().count() == 2
+        assert afilter.list_fields()[0]['field'] == 'language__iregex'
+
+        with override_settings(ADVANCED_FILTERS_OPTIMIZE_QUERIES=False):
+            assert afilter.query.children == [['language__iregex', '^(EN|it)$']]
+
+
+@override_settings(TIME_ZONE='Europe/Zagreb')
+class RangeTest(TestCase):
+    def setUp(self):
+        self.user = factories.SalesRep()
+        joined = timezone.make_aware(datetime(2020, 1, 1))
+        self.clients = [
+            factories.Client(assigned_to=self.user,
+                             date_joined=joined + timedelta(hours=h))
+            for h in (-1, 0, 12, 24, 48)]
+        self.Client = type(self.clients[0])
+
+    def assert_equivalent(self, query):
+        optimized = optimize_query(self.Client, query)
+        assert 'range' not in str(optimized), optimized
+        pks = self.Client.objects.values_list('pk', flat=True)
+        assert set(pks.filter(optimized)) == set(pks.filter(query)), query
+        return optimized
+
+    def test_datetime_field(self):
+        low = timezone.make_aware(datetime(2020, 1, 1))
+        high = timezone.make_aware(datetime(2020, 1, 2))
+        optimized = self.assert_equivalent(Q(date_joined__range=(low, high)))
+        assert optimized.children[0].children == [
+            ('date_joined__gte', low.astimezone(timezone.utc)),
+            ('date_joined__lt', high + timedelta(microseconds=1)),
+        ]
+        assert optimized.children[0].children[0][1].tzinfo == timezone.utc
+        # naive bounds are in the default time zone, as for the ORM
+        self.assert_equivalent(Q(date_joined__range=(
+            datetime(2020, 1, 1), datetime(2020, 1, 2))))
+
+    def test_open_bounds(self):
+        low = datetime(2020, 1, 1, 12)
+        for s in (QSerializer(base64=True), BinaryQSerializer(base64=True)):
+            stored = s.dumps(Q(date_joined__range=(low, None)))
+            query = s.loads(stored)
+            optimized = self.assert_equivalent(query)
+            assert optimized.children == [('date_joined__gte', (
+                timezone.make_aware(low).astimezone(timezone.utc)))]
+
+            # the sentinel bounds overflow once made aware east of UTC
+            stored = s.dumps(Q(date_joined__range=(None, None)))
+            optimized = optimize_query(self.Client, s.loads(stored))
+            assert optimized.children == [('date_joined__isnull', False)]
+            assert self.Client.objects.filter(optimized).count() == 5
+
+    def test_date_field(self):
+        day = models.DateField(name='day')
+        low = timezone.make_aware(datetime(2020, 1, 1, 23, 30))
+        high = datetime(2020, 1, 10, 12)
+        result = rewrite_range([day], ['range'], 'day__range', (low, high))
+        assert result.children == [('day__gte', date(2020, 1, 1)),
+                                   ('day__lt', date(2020, 1, 11))]
+
+    def test_other_ranges_are_kept(self):
+        query = Q(id__range=(1, 3))
+        assert optimize_query(self.Client, query).children == query.children
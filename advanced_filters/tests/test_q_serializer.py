@@ -1,8 +1,17 @@
+from copy import deepcopy
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+import json
+import time
+import uuid
+
+from django.core.serializers.base import SerializationError
 from django.db.models import Q
 from django.test import TestCase
-import json
 
-from ..q_serializer import QSerializer
+from ..q_serializer import (BINARY_MAGIC, BINARY_VERSION, BinaryQSerializer,
+                            QSerializer, canonicalize, decode_binary,
+                            fingerprint)
 
 
 class QSerializerTest(TestCase):
@@ -37,3 +46,173 @@ class QSerializerTest(TestCase):
         qres = self.s.loads('{"connector": "AND", "negated": false, "children"'
                             ' :[["test", 1234]], "subtree_parents": []}')
         self.assertIsInstance(qres, Q)
+
+    def test_serialize_does_not_mutate(self):
+        inner = Q(a=1) | Q(b=2)
+        query = Q(inner, c=3)
+        before = list(query.children)
+        res = self.s.serialize(query)
+        self.assertEqual(query.children, before)
+        self.assertIs(query.children[0], inner)
+        self.assertEqual(res['children'][0]['children'], [('a', 1), ('b', 2)])
+
+    def test_deserialize_does_not_mutate(self):
+        d = {
+            'connector': 'AND', 'negated': False,
+            'children': [['x__range', [10, None]], ['y__in', [1, 2]]],
+        }
+        snapshot = deepcopy(d)
+        query = self.s.deserialize(d)
+        query.children[1][1].append(3)
+        self.assertEqual(d, snapshot)
+        self.assertIsInstance(query.children[0][1][0], datetime)
+
+    def test_deep_and_wide_trees(self):
+        query = Q(leaf=0)
+        for i in range(5000):
+            node = Q()
+            node.connector = Q.OR if i % 2 else Q.AND
+            node.children = [('field%d' % i, i), query]
+            query = node
+        query.children.extend(('wide%d' % i, i) for i in range(5000))
+
+        # (simplejson itself recurses, so JSON dumps/loads are not used)
+        binary = BinaryQSerializer()
+        for loaded in (self.s.deserialize(self.s.serialize(query)),
+                       binary.loads(binary.dumps(query))):
+            depth = 0
+            node = loaded
+            while len(node.children) > 1:
+                node = node.children[1]
+                depth += 1
+            self.assertEqual(depth, 5000)
+            self.assertEqual(len(loaded.children), 5002)
+            self.assertEqual(list(node.children[0]), ['leaf', 0])
+        fields = self.s.get_field_values_list(self.s.serialize(query))
+        self.assertEqual(len([f for f in fields if f['field'] != '_OR']),
+                         10001)
+
+    def test_field_values_list_or_lines(self):
+        fields = self.s.get_field_values_list({
+            'connector': 'OR', 'negated': False,
+            'children': [['a', 1], ['a', 1], {
+                'connector': 'AND', 'negated': True,
+                'children': [['b', 2], ['c', 3]]}],
+        })
+        self.assertEqual([f['field'] for f in fields],
+                         ['a', '_OR', 'a', '_OR', 'b', 'c'])
+        self.assertTrue(fields[-1]['negate'])
+
+
+class BinaryQSerializerTest(TestCase):
+    def setUp(self):
+        self.s = BinaryQSerializer(base64=True)
+
+    def test_roundtrip_typed_values(self):
+        aware = datetime(2020, 5, 1, 12, 30, tzinfo=timezone(timedelta(hours=2)))
+        query = (Q(name__iexact='Žiga') | ~Q(created__range=(
+            aware, datetime(2021, 1, 1, 0, 0, 0, 5)))) & Q(
+                day=date(2020, 2, 29), price=Decimal('10.50'),
+                uid=uuid.UUID(int=7), score=-1.5, count=-300, flag=None,
+                tags__in=[1, 2, True])
+        loaded = self.s.loads(self.s.dumps(query))
+        self.assertEqual(loaded.connector, Q.AND)
+        self.assertEqual(loaded.children[0].connector, Q.OR)
+        self.assertTrue(loaded.children[0].children[1].negated)
+        self.assertEqual(loaded.children[0].children[0], ['name__iexact', 'Žiga'])
+        created = loaded.children[0].children[1].children[0][1]
+        self.assertEqual(created, (aware, datetime(2021, 1, 1, 0, 0, 0, 5)))
+        self.assertEqual(created[0].utcoffset(), timedelta(hours=2))
+        self.assertEqual(dict(loaded.children[1:]), dict(query.children[1:]))
+
+    def test_raw_is_json_compatible(self):
+        stamp = datetime(2020, 5, 1, 12, 30)
+        query = Q(created__range=(stamp, None), uid=uuid.UUID(int=7),
+                  price=Decimal('1.5'))
+        raw = self.s.loads(self.s.dumps(query), raw=True)
+        self.assertEqual(raw['children'], [
+            ['created__range', [time.mktime(stamp.timetuple()), None]],
+            ['price', '1.5'],
+            ['uid', str(uuid.UUID(int=7))],
+        ])
+        json.dumps(raw)
+
+    def test_smaller_than_json(self):
+        query = Q()
+        for i in range(20):
+            query &= Q(**{'field%d__icontains' % i: 'value %d' % i})
+        self.assertLess(len(self.s.dumps(query)),
+                        len(QSerializer(base64=True).dumps(query)) / 2)
+        self.assertLessEqual(
+            len(self.s.dumps(query)),
+            len(BinaryQSerializer(base64=True, compress=False).dumps(query)))
+
+    def test_reads_legacy_json(self):
+        legacy = QSerializer(base64=True).dumps(Q(test=1234))
+        self.assertEqual(self.s.loads(legacy).children, [['test', 1234]])
+        binary = self.s.dumps(Q(test=1234))
+        self.assertEqual(QSerializer(base64=True).loads(binary).children,
+                         [['test', 1234]])
+
+    def test_header(self):
+        data = BinaryQSerializer().dumps(Q(test=1))
+        self.assertEqual(data[:2], BINARY_MAGIC)
+        self.assertEqual(data[2], BINARY_VERSION)
+        future = data[:2] + bytes((BINARY_VERSION + 1,)) + data[3:]
+        self.assertRaises(SerializationError, decode_binary, future)
+        self.assertRaises(SerializationError, decode_binary, data[:-1])
+
+    def test_unsupported_value(self):
+        self.assertRaises(SerializationError, self.s.dumps, Q(test=object()))
+
+
+class CanonicalFormTest(TestCase):
+    def assertEquivalent(self, a, b):
+        self.assertEqual(canonicalize(a), canonicalize(b))
+        self.assertEqual(fingerprint(a), fingerprint(b))
+
+    def test_equivalent_queries(self):
+        self.assertEquivalent(Q() & Q(a=1) & Q(b=2), Q(b=2) & Q(a=1))
+        self.assertEquivalent(Q(a=1) | (Q(b=2) | Q(c=3)),
+                              Q(c=3) | Q(b=2) | Q(a=1) | Q(a=1))
+        self.assertEquivalent(~~Q(a=1), Q(a=1))
+        self.assertEquivalent(Q(a__in=[3, 1, 1, 2]), Q(a__in=(1, 2, 3)))
+        self.assertEquivalent(Q(a=Decimal('1.50')), Q(a=Decimal('1.5')))
+        self.assertEquivalent(
+            Q(d=datetime(2020, 1, 1, 12, tzinfo=timezone.utc)),
+            Q(d=datetime(2020, 1, 1, 14, tzinfo=timezone(timedelta(hours=2)))))
+        # a loaded query fingerprints like the one it was stored from
+        query = ~Q(a__range=(datetime(2020, 1, 1), datetime(2021, 1, 1)))
+        s = BinaryQSerializer(base64=True)
+        self.assertEqual(fingerprint(s.loads(s.dumps(query))),
+                         fingerprint(query))
+
+    def test_different_queries(self):
+        self.assertNotEqual(fingerprint(Q(a=1) & Q(b=2)),
+                            fingerprint(Q(a=1) | Q(b=2)))
+        self.assertNotEqual(fingerprint(~Q(a=1, b=2)),
+                            fingerprint(~Q(a=1) | ~Q(b=2)))
+        self.assertNotEqual(fingerprint(Q(a=1)), fingerprint(Q(a='1')))
+        self.assertNotEqual(fingerprint(Q(a__range=(2, 1))),
+                            fingerprint(Q(a__range=(1, 2))))
+        # the AND-ed root children are separate filter units
+        nested = Q()
+        nested.children = [Q(m2m__a=1, m2m__b=2)]
+        self.assertNotEqual(fingerprint(nested), fingerprint(
+            Q(m2m__a=1) & Q(m2m__b=2)))
+
+    def test_canonical_structure(self):
+        nested = Q(x=1) | (Q(y=2) | ~Q(z=3))
+        query = Q()
+        query.children = [nested, Q(), ~~(Q(b=2) & Q(a=1))]
+        canonical = canonicalize(query)
+        self.assertEqual(canonical.connector, Q.AND)
+        self.assertEqual(len(canonical.children), 2)
+        # the double negation is dropped, but the unit is kept
+        self.assertEqual(canonical.children[0].children, [('a', 1), ('b', 2)])
+        ored = canonical.children[1]
+        self.assertEqual(ored.connector, Q.OR)
+        self.assertEqual(ored.children[:2], [('x', 1), ('y', 2)])
+        self.assertTrue(ored.children[2].negated)
+        self.assertEqual(len(query.children), 3)  # not modified
+        self.assertEqual(canonicalize(Q()), Q())
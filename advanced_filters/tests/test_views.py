@@ -1,6 +1,13 @@
+from io import StringIO
+import json
 import sys
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 try:
     from django.test import override_settings
 except ImportError:
@@ -12,6 +19,7 @@ except ImportError:  # Django < 2.0
     from django.core.urlresolvers import reverse
 import django
 
+from ..models import AdvancedFilter
 from tests import factories
 
 
@@ -19,6 +27,7 @@ class TestGetFieldChoicesView(TestCase):
     url_name = 'afilters_get_field_choices'
 
     def setUp(self):
+        cache.clear()  # cardinality estimates are cached per column
         self.user = factories.SalesRep()
         assert self.client.login(username='user', password='test')
 
@@ -113,8 +122,54 @@ class TestGetFieldChoicesView(TestCase):
         factories.Client.create_batch(5, assigned_to=self.user)
         view_url = reverse(self.url_name, kwargs=dict(
             model='customers.Client', field_name='id'))
-        res = self.client.get(view_url)
+        with self.assertNumQueries(3):  # session, user and choices
+            res = self.client.get(view_url)
+        self.assert_json(res, {'results': []})
+
+    @override_settings(ADVANCED_FILTERS_MAX_CHOICES=4)
+    def test_max_database_choices_with_label(self):
+        clients = factories.Client.create_batch(4, assigned_to=self.user)
+        view_url = reverse(self.url_name, kwargs=dict(
+            model='customers.Client', field_name='id|email'))
+        with self.assertNumQueries(4):  # with the cardinality sample
+            res = self.client.get(view_url)
+        self.assert_json(res, {'results': [
+            dict(id=c.pk, text=c.email) for c in clients]})
+
+    @override_settings(ADVANCED_FILTERS_MAX_CHOICES=4,
+                       ADVANCED_FILTERS_CARDINALITY_SAMPLE_SIZE=10)
+    def test_high_cardinality_field(self):
+        factories.Client.create_batch(6, assigned_to=self.user)
+        view_url = reverse(self.url_name, kwargs=dict(
+            model='customers.Client', field_name='email'))
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(view_url)
         self.assert_json(res, {'results': []})
+        assert not any('DISTINCT' in q['sql'] for q in queries)
+        key = 'advanced_filters:cardinality:default:customers_client:email'
+        assert cache.get(key) == 6
+
+        # the first page select2 requests is not listed either
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(view_url, {'term': '', 'page': 1})
+        self.assert_json(res, {'results': [], 'more': False})
+        assert not any('DISTINCT' in q['sql'] for q in queries)
+        res = self.client.get(view_url, {'term': 'foo.com', 'page': 1})
+        assert len(json.loads(force_text(res.content))['results']) == 6
+
+        # the estimate is overridden by the settings
+        cache.set(key, 1000)
+        mode = {'customers.Client.email': 'list'}
+        with override_settings(ADVANCED_FILTERS_MAX_CHOICES=10,
+                               ADVANCED_FILTERS_CHOICES_MODE=mode):
+            res = self.client.get(view_url)
+            assert len(json.loads(force_text(res.content))['results']) == 6
+        mode = {'customers.Client.language': 'search'}
+        with override_settings(ADVANCED_FILTERS_CHOICES_MODE=mode):
+            res = self.client.get(reverse(self.url_name, kwargs=dict(
+                model='customers.Client', field_name='language')))
+            # predefined choices are always listed
+            assert len(json.loads(force_text(res.content))['results']) == 3
 
     @override_settings(ADVANCED_FILTERS_MAX_CHOICES=4)
     def test_distinct_database_choices(self):
@@ -123,3 +178,220 @@ class TestGetFieldChoicesView(TestCase):
             model='customers.Client', field_name='email'))
         res = self.client.get(view_url)
         self.assert_json(res, {'results': [{'id': 'foo@bar.com', 'text': 'foo@bar.com'}]})
+
+    def test_cached_choices(self):
+        from ..cache import choices_stats
+        clients = factories.Client.create_batch(2, assigned_to=self.user)
+        view_url = reverse(self.url_name, kwargs=dict(
+            model='customers.Client', field_name='email'))
+        choices_stats.clear()
+        res = self.client.get(view_url)
+        assert choices_stats.stats() == {'hits': 0, 'misses': 1}
+        etag = res['ETag']
+        with self.assertNumQueries(2):  # session and user
+            cached = self.client.get(view_url)
+        assert choices_stats.stats() == {'hits': 1, 'misses': 1}
+        assert cached.content == res.content
+        assert 'no-cache' in res['Cache-Control']
+
+        res = self.client.get(view_url, HTTP_IF_NONE_MATCH=etag)
+        assert res.status_code == 304
+        assert res['ETag'] == etag
+
+        # changing the model invalidates the list
+        clients[0].email = 'changed@example.com'
+        clients[0].save()
+        res = self.client.get(view_url, HTTP_IF_NONE_MATCH=etag)
+        assert res.status_code == 200
+        assert res['ETag'] != etag
+        assert 'changed@example.com' in force_text(res.content)
+        assert choices_stats.stats()['misses'] == 2
+
+    @override_settings(ADVANCED_FILTERS_MAX_CHOICES=2,
+                       ADVANCED_FILTERS_CHOICES_PAGE_SIZE=2)
+    def test_paged_choices(self):
+        for i in range(5):
+            factories.Client(assigned_to=self.user,
+                             email='client%d@example.com' % i)
+        factories.Client(assigned_to=self.user, email='other@example.com')
+        view_url = reverse(self.url_name, kwargs=dict(
+            model='customers.Client', field_name='email'))
+
+        res = self.client.get(view_url, {'term': 'CLIENT', 'page': 1})
+        self.assert_json(res, {'results': [
+            dict(id='client0@example.com', text='client0@example.com'),
+            dict(id='client1@example.com', text='client1@example.com'),
+        ], 'more': True})
+        res = self.client.get(view_url, {'term': 'client', 'page': 3})
+        self.assert_json(res, {'results': [
+            dict(id='client4@example.com', text='client4@example.com'),
+        ], 'more': False})
+
+        with override_settings(ADVANCED_FILTERS_CHOICES_SEARCH='istartswith'):
+            res = self.client.get(view_url, {'term': 'example'})
+            self.assert_json(res, {'results': [], 'more': False})
+
+        res = self.client.get(view_url, {'page': 'x'})
+        assert res.status_code == 400
+
+    def test_paged_predefined_choices(self):
+        view_url = reverse(self.url_name, kwargs=dict(
+            model='customers.Client', field_name='language'))
+        res = self.client.get(view_url, {'term': 'ian'})
+        self.assert_json(res, {'results': [
+            {'id': 'it', 'text': 'Italian'}], 'more': False})
+
+    def test_paged_relation_choices(self):
+        other = factories.SalesRep(username='other', email='o@o.com')
+        factories.Client(assigned_to=self.user)
+        factories.Client(assigned_to=other)
+        view_url = reverse(self.url_name, kwargs=dict(
+            model='customers.Client', field_name='assigned_to'))
+        res = self.client.get(view_url, {'term': str(other.pk)})
+        self.assert_json(res, {'results': [
+            {'id': other.pk, 'text': str(other.pk)}], 'more': False})
+
+        # a label which cannot be searched
+        res = self.client.get(view_url + '|assigned_to', {'term': 'x'})
+        self.assert_json(res, {'results': [], 'more': False})
+
+
+class TestGetFieldChoicesBatchView(TestCase):
+    def setUp(self):
+        self.user = factories.SalesRep()
+        assert self.client.login(username='user', password='test')
+        self.url = reverse('afilters_get_field_choices_batch',
+                           kwargs=dict(model='customers.Client'))
+
+    def test_batch(self):
+        from ..cache import choices_stats
+        clients = factories.Client.create_batch(2, assigned_to=self.user)
+        fields = 'language,email,assigned_to__email,is_active'
+        choices_stats.clear()
+        res = self.client.get(self.url, {'fields': fields})
+        self.assertJSONEqual(force_text(res.content), {'results': {
+            'language': [{'id': 'en', 'text': 'English'},
+                         {'id': 'it', 'text': 'Italian'},
+                         {'id': 'sp', 'text': 'Spanish'}],
+            'email': [dict(id=c.email, text=c.email) for c in clients],
+            'assigned_to__email': [
+                dict(id=self.user.email, text=self.user.email)],
+            'is_active': [],
+        }})
+        assert choices_stats.stats() == {'hits': 0, 'misses': 4}
+
+        # the per-field cache is shared with GetFieldChoices
+        single = self.client.get(reverse('afilters_get_field_choices', kwargs=dict(
+            model='customers.Client', field_name='email')))
+        assert choices_stats.stats() == {'hits': 1, 'misses': 4}
+        self.assertJSONEqual(force_text(single.content), {
+            'results': [dict(id=c.email, text=c.email) for c in clients]})
+
+        res = self.client.get(self.url, {'fields': fields},
+                              HTTP_IF_NONE_MATCH=res['ETag'])
+        assert res.status_code == 304
+
+    def test_invalid_fields(self):
+        res = self.client.get(self.url)
+        assert res.status_code == 400
+        res = self.client.get(self.url, {'fields': 'email,baz'})
+        assert res.status_code == 400
+        self.assertJSONEqual(force_text(res.content), {
+            'error': "Client has no field named 'baz'"})
+
+
+class TestGetFieldTreeView(TestCase):
+    def setUp(self):
+        from django.contrib import admin
+        self.user = factories.SalesRep()
+        assert self.client.login(username='user', password='test')
+        self.url = reverse('afilters_get_field_tree',
+                           kwargs=dict(model='customers.Client'))
+        self.model_admin = admin.site._registry[factories.Client._meta.model]
+        self.model_admin.advanced_filter_fields = '__all__'
+        self.addCleanup(delattr, self.model_admin, 'advanced_filter_fields')
+
+    def test_tree(self):
+        res = self.client.get(self.url)
+        assert res.status_code == 200
+        results = json.loads(force_text(res.content))['results']
+        by_id = dict((r['id'], r) for r in results)
+        assert by_id['assigned_to']['relation'] is True
+        assert by_id['email']['relation'] is False
+
+        res = self.client.get(self.url, {'path': 'assigned_to'})
+        results = json.loads(force_text(res.content))['results']
+        by_id = dict((r['id'], r) for r in results)
+        assert by_id['assigned_to__email']['text'] == (
+            'Assigned to / email address')
+        # max_depth is 1: relations of a relation are not expandable
+        assert by_id['assigned_to__groups']['relation'] is False
+
+    def test_errors(self):
+        res = self.client.get(self.url, {'path': 'assigned_to__groups'})
+        assert res.status_code == 400
+        res = self.client.get(self.url, {'path': 'email'})
+        assert res.status_code == 400
+
+        del self.model_admin.advanced_filter_fields
+        self.addCleanup(setattr, self.model_admin,
+                        'advanced_filter_fields', '__all__')
+        res = self.client.get(self.url)
+        assert res.status_code == 400
+        self.assertJSONEqual(force_text(res.content), {
+            'error': "Fields of customers.Client are not discoverable"})
+
+
+class TestWarmCommand(TransactionTestCase):
+    def setUp(self):
+        from ..cache import choices_stats
+        cache.clear()
+        choices_stats.clear()
+        self.user = factories.SalesRep()
+        for name in ('Bob', 'Alice'):
+            factories.Client(assigned_to=self.user, language='en',
+                             first_name=name)
+        self.advfilter = AdvancedFilter(
+            title='english', url='test', created_by=self.user,
+            model='customers.Client')
+        self.advfilter.query = Q(language='en')
+        self.advfilter.save()
+
+    def warm(self, **options):
+        out = StringIO()
+        call_command('warm_advanced_filters', stdout=out, **options)
+        return out.getvalue()
+
+    def test_warm(self):
+        from ..cache import choices_stats
+        output = self.warm(workers=2)
+        assert 'Warmed 4 of 4 entries (0 failed, 0 skipped)' in output
+        assert '/4] choices customers.Client.assigned_to__email: ok' in output
+        assert '/4] filter %s "english": ok' % self.advfilter.pk in output
+        assert choices_stats.stats() == {'hits': 0, 'misses': 3}
+
+        assert self.client.login(username='user', password='test')
+        # the request of the select2 widget, with the label of the template
+        res = self.client.get(reverse('afilters_get_field_choices', kwargs=dict(
+            model='customers.client', field_name='first_name')),
+            {'term': '', 'page': 1})
+        assert choices_stats.stats() == {'hits': 1, 'misses': 3}
+        self.assertJSONEqual(force_text(res.content), {'results': [
+            dict(id='Alice', text='Alice'), dict(id='Bob', text='Bob')],
+            'more': False})
+        with self.assertNumQueries(0):  # served from the result cache
+            assert self.advfilter.result_count() == 2
+
+    def test_all_fields(self):
+        from django.contrib import admin
+        model_admin = admin.site._registry[factories.Client._meta.model]
+        model_admin.advanced_filter_fields = '__all__'
+        self.addCleanup(delattr, model_admin, 'advanced_filter_fields')
+        output = self.warm(workers=0, skip_filters=True)
+        assert '(0 failed, 0 skipped)' in output
+        assert '] choices customers.Client.email: ok' in output
+        assert '] choices customers.Client.assigned_to: ok' in output
+
+    def test_time_budget(self):
+        output = self.warm(workers=0, time_budget=0, skip_choices=True)
+        assert 'Warmed 0 of 1 entries (0 failed, 1 skipped)' in output
@@ -1,6 +1,7 @@
 from django.conf.urls import url
 
-from advanced_filters.views import GetFieldChoices
+from advanced_filters.views import (ExportFilterResults, GetFieldChoices,
+                                    GetFieldChoicesBatch, GetFieldTree)
 
 urlpatterns = [
     url(r'^field_choices/(?P<model>.+)/(?P<field_name>.+)/?',
@@ -11,4 +12,21 @@ urlpatterns = [
     url(r'^field_choices/$',
         GetFieldChoices.as_view(),
         name='afilters_get_field_choices'),
+
+    url(r'^field_choices_batch/(?P<model>[^/]+)/$',
+        GetFieldChoicesBatch.as_view(),
+        name='afilters_get_field_choices_batch'),
+
+    url(r'^field_tree/(?P<model>[^/]+)/$',
+        GetFieldTree.as_view(),
+        name='afilters_get_field_tree'),
+
+    # only to allow building dynamically
+    url(r'^field_tree/$',
+        GetFieldTree.as_view(),
+        name='afilters_get_field_tree'),
+
+    url(r'^export/(?P<pk>\d+)/$',
+        ExportFilterResults.as_view(),
+        name='afilters_export'),
 ]
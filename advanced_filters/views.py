@@ -1,20 +1,40 @@
 from operator import itemgetter
+import hashlib
 import logging
+import time
 
 from django.apps import apps
 from django.conf import settings
-from django.contrib.admin.utils import get_fields_from_path
+from django.contrib import admin
+from django.contrib.admin.utils import NotRelationField, get_fields_from_path
+from django.core.cache import cache
+from django.core.exceptions import FieldError
 from django.db import models
 from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.encoding import force_text
+from django.utils.http import http_date, quote_etag
+from django.utils.text import capfirst
 from django.views.generic import View
 
 from braces.views import (CsrfExemptMixin, StaffuserRequiredMixin,
                           JSONResponseMixin)
 
+from .cache import choices_stats, get_model_versions
+from .counts import estimate_distinct
+from .export import DEFAULT_CHUNK_SIZE, export_filter, exportable_fields
+from .field_tree import FieldTree
+from .models import AdvancedFilter
+
 logger = logging.getLogger('advanced_filters.views')
 
 
+class InvalidField(Exception):
+    """ A model or field path choices can not be looked up for """
+
+
 class GetFieldChoices(CsrfExemptMixin, StaffuserRequiredMixin,
                       JSONResponseMixin, View):
     """
@@ -26,12 +46,57 @@ class GetFieldChoices(CsrfExemptMixin, StaffuserRequiredMixin,
     all distinct entries in the DB are presented, unless field name is in
     ADVANCED_FILTERS_DISABLE_FOR_FIELDS and limited to display only results
     under ADVANCED_FILTERS_MAX_CHOICES.
+
+    With a "term" and/or "page" GET parameter a page of the choices whose
+    label matches the term is returned instead, with a "more" flag, as used
+    by the select2 widget in ajax mode; ADVANCED_FILTERS_MAX_CHOICES does
+    not apply to pages.
+
+    Choice lists are cached (for ADVANCED_FILTERS_CHOICES_CACHE_TIMEOUT
+    seconds) until data of the model they are read from changes, and are
+    sent with ETag/Last-Modified headers for browsers to revalidate.
     """
     def get(self, request, model=None, field_name=None):
         if model is field_name is None:
             return self.render_json_response(
                 {'error': "GetFieldChoices view requires 2 arguments"},
                 status=400)
+        try:
+            model_obj, field, field_label = self.resolve_field(
+                model, field_name)
+        except InvalidField as e:
+            return self.render_json_response(
+                {'error': force_text(e)}, status=400)
+
+        term = request.GET.get('term')
+        page = request.GET.get('page')
+        if term is not None or page is not None:
+            try:
+                page = max(int(page or 1), 1)
+            except ValueError:
+                return self.render_json_response(
+                    {'error': "Invalid page: %s" % page}, status=400)
+            term = term or ''
+
+        timeout = getattr(
+            settings, 'ADVANCED_FILTERS_CHOICES_CACHE_TIMEOUT', 3600)
+        if not timeout:
+            return self.render_json_response(self.choices_payload(
+                model_obj, field, field_label, term, page))
+
+        key, (payload, modified) = self.cached_choices(
+            model, field_name, timeout, term=term, page=page)
+        # the key changes with the data versions: it is a strong validator
+        return self.conditional_response(
+            request, key.rsplit(':', 1)[-1], modified, lambda: payload)
+
+    def resolve_field(self, model, field_name):
+        """
+        Return the model the choices are read from, the field and the label
+        field (if any) of a "field__path|label" string.
+
+        Raises InvalidField for unknown models and fields.
+        """
         app_label, model_name = model.split('.', 1)
         try:
             model_obj = apps.get_model(app_label, model_name)
@@ -43,45 +108,337 @@ class GetFieldChoices(CsrfExemptMixin, StaffuserRequiredMixin,
             model_obj = field.model  # use new model if followed a ForeignKey
         except AttributeError as e:
             logger.debug("Invalid kwargs passed to view: %s", e)
-            return self.render_json_response(
-                {'error': "No installed app/model: %s" % model}, status=400)
+            raise InvalidField("No installed app/model: %s" % model)
         except (LookupError, FieldDoesNotExist) as e:
             logger.debug("Invalid kwargs passed to view: %s", e)
-            return self.render_json_response(
-                {'error': force_text(e)}, status=400)
+            raise InvalidField(force_text(e))
+        return model_obj, field, field_label
+
+    def cached(self, key, compute, timeout):
+        """ Return the cached (payload, timestamp) entry of a key """
+        entry = cache.get(key)
+        if entry is None:
+            choices_stats.miss()
+            entry = (compute(), int(time.time()))
+            cache.set(key, entry, timeout)
+        else:
+            choices_stats.hit()
+        return entry
+
+    def choices_payload(self, model_obj, field, field_label, term=None,
+                        page=None):
+        """
+        The response of the view: the list of choices of a field, or the
+        page of them matching ``term`` when a term or page is given.
+        """
+        if term is None and page is None:
+            return {'results': self.get_choices(model_obj, field, field_label)}
+        return self.get_page(model_obj, field, field_label, term or '',
+                             page or 1)
+
+    def cached_choices(self, model, field_name, timeout, term=None,
+                       page=None):
+        """
+        Return the cache key and the cached (payload, timestamp) entry of
+        the choices (or a page of them) of a "field__path|label" of
+        ``model``, computed on a cache miss.
+
+        Raises InvalidField for unknown models and fields.
+        """
+        model_obj, field, field_label = self.resolve_field(model, field_name)
+        key = self.cache_key(model, field_name.split('|', 1)[0], field,
+                             field_label, term=term, page=page)
+        return key, self.cached(key, lambda: self.choices_payload(
+            model_obj, field, field_label, term, page), timeout)
+
+    def conditional_response(self, request, etag, modified, payload):
+        """
+        A 304 response if the client's copy is current, otherwise the JSON
+        response of ``payload()``, with validators for revalidation.
+        """
+        etag = quote_etag(etag)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=modified)
+        if response is None:
+            response = self.render_json_response(payload())
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
-        choices = field.choices
+    def cache_key(self, model, field_name, field, field_label, term=None,
+                  page=None):
+        """
+        The cache key of the choices (or a page of them) of a field path,
+        which includes the data versions of the models the choices are read
+        from. The model label is normalized ("customers.client" and
+        "customers.Client" share entries).
+        """
+        model = apps.get_model(model)._meta.label_lower
+        related = {field.model}
+        if field_label:
+            try:
+                related.update(f.related_model for f in get_fields_from_path(
+                    field.model, field_label) if f.related_model is not None)
+            except (FieldDoesNotExist, NotRelationField):
+                pass
+        versions = get_model_versions(related)
+        limits = (getattr(settings, 'ADVANCED_FILTERS_MAX_CHOICES', 254),
+                  getattr(settings, 'ADVANCED_FILTERS_DISABLE_FOR_FIELDS', ()),
+                  getattr(settings, 'ADVANCED_FILTERS_CHOICES_PAGE_SIZE', 30),
+                  getattr(settings, 'ADVANCED_FILTERS_CHOICES_SEARCH',
+                          'icontains'),
+                  getattr(settings, 'ADVANCED_FILTERS_CHOICES_MODE', {}))
+        signature = '%s:%s:%s:%r:%r:%r:%r' % (
+            model, field_name, field_label, term, page, limits, versions)
+        return 'advanced_filters:choices:%s' % hashlib.sha1(
+            signature.encode('utf-8')).hexdigest()
+
+    def get_choices(self, model_obj, field, field_label=None):
+        """
+        Return the list of choices of a field as select2 results, or an
+        empty list when there are more than ADVANCED_FILTERS_MAX_CHOICES.
+        """
+        if field.choices:
+            return [{'id': value, 'text': force_text(label)} for value, label
+                    in sorted(field.flatchoices, key=itemgetter(0))]
         # if no choices, populate with distinct values from instances
-        if not choices:
-            choices = []
-            disabled = getattr(settings, 'ADVANCED_FILTERS_DISABLE_FOR_FIELDS',
-                               tuple())
-            max_choices = getattr(settings, 'ADVANCED_FILTERS_MAX_CHOICES', 254)
-            if field.name in disabled:
-                logger.debug('Skipped lookup of choices for disabled fields')
-            elif isinstance(field, (models.BooleanField, models.DateField,
-                                    models.TimeField)):
-                logger.debug('No choices calculated for field %s of type %s',
-                             field, type(field))
-            else:
-                # the order_by() avoids ambiguity with values() and distinct()
-                if field_label:
-                    choices = model_obj.objects.order_by(field.name).values_list(
-                        field.name, field_label).distinct()
-                    count = choices.count()
-                else:
-                    choices = model_obj.objects.order_by(field.name).values_list(
-                        field.name, flat=True).distinct()
-                    choices = list(zip(choices, choices))
-                    count = len(choices)
-                # additional query is ok to avoid fetching too many values
-                if count <= max_choices:
-                    logger.debug('Choices found for field %s: %s',
-                                 field.name, choices)
+        choices = self.choices_queryset(model_obj, field, field_label)
+        if choices is None:
+            return []
+        if self.search_only(model_obj, field):
+            logger.debug('Choices of field %s are only searched', field.name)
+            return []
+        max_choices = getattr(settings, 'ADVANCED_FILTERS_MAX_CHOICES', 254)
+        # fetching a single row more than allowed tells whether there are
+        # too many, without counting or reading all distinct values
+        results = self.to_results(choices[:max_choices + 1], field_label)
+        if len(results) > max_choices:
+            logger.debug('Too many choices for field %s', field.name)
+            return []
+        logger.debug('Choices found for field %s: %s', field.name, results)
+        return results
+
+    def search_only(self, model_obj, field):
+        """
+        Whether a field has too many distinct values to be listed, so its
+        choices are only offered by searching (see get_page()).
+
+        ADVANCED_FILTERS_CHOICES_MODE may map "app_label.Model.field" to
+        "list" or "search", otherwise an estimate of the number of distinct
+        values is compared with ADVANCED_FILTERS_MAX_CHOICES.
+        """
+        modes = getattr(settings, 'ADVANCED_FILTERS_CHOICES_MODE', {})
+        mode = modes.get('%s.%s' % (model_obj._meta.label, field.name))
+        if mode is not None:
+            return mode == 'search'
+        if getattr(field, 'column', None) is None:
+            return False
+        max_choices = getattr(settings, 'ADVANCED_FILTERS_MAX_CHOICES', 254)
+        return estimate_distinct(
+            model_obj, field, model_obj.objects.db) > max_choices
+
+    def to_results(self, rows, field_label=None):
+        """ select2 results of the rows of a choices_queryset() """
+        if field_label:
+            return [{'id': value, 'text': force_text(label)}
+                    for value, label in rows]
+        return [{'id': value, 'text': force_text(value)} for value in rows]
+
+    def choices_queryset(self, model_obj, field, field_label=None):
+        """
+        The ordered, distinct values (or (value, label) tuples) of a field
+        to present as choices, or None for fields not looked up.
+        """
+        disabled = getattr(settings, 'ADVANCED_FILTERS_DISABLE_FOR_FIELDS',
+                           tuple())
+        if field.name in disabled:
+            logger.debug('Skipped lookup of choices for disabled fields')
+            return None
+        if isinstance(field, (models.BooleanField, models.DateField,
+                              models.TimeField)):
+            logger.debug('No choices calculated for field %s of type %s',
+                         field, type(field))
+            return None
+        # the order_by() avoids ambiguity with values() and distinct()
+        choices = model_obj.objects.order_by(field.name)
+        if field_label:
+            return choices.values_list(field.name, field_label).distinct()
+        return choices.values_list(field.name, flat=True).distinct()
+
+    def get_page(self, model_obj, field, field_label, term, page):
+        """
+        Return a page of the choices of a field whose label matches a search
+        term (using ADVANCED_FILTERS_CHOICES_SEARCH, "icontains" or
+        "istartswith"), as select2 results with a "more" flag. Without a
+        term, the page of a search_only() field is empty.
+        """
+        size = getattr(settings, 'ADVANCED_FILTERS_CHOICES_PAGE_SIZE', 30)
+        search = getattr(settings, 'ADVANCED_FILTERS_CHOICES_SEARCH',
+                         'icontains')
+        offset = (page - 1) * size
+        if field.choices:
+            term = term.lower()
+            results = []
+            for value, label in field.flatchoices:
+                text = force_text(label)
+                if search == 'istartswith':
+                    matches = text.lower().startswith(term)
                 else:
-                    choices = []
+                    matches = term in text.lower()
+                if matches:
+                    results.append({'id': value, 'text': text})
+            results = results[offset:offset + size + 1]
+        else:
+            choices = self.choices_queryset(model_obj, field, field_label)
+            if choices is None or (not term and
+                                   self.search_only(model_obj, field)):
+                # high cardinality columns are only searched
+                return {'results': [], 'more': False}
+            if term:
+                column = field_label or field.name
+                if not field_label and field.is_relation:
+                    # the related key, i.e assigned_to__id for assigned_to
+                    column += '__' + field.target_field.name
+                try:
+                    choices = choices.filter(
+                        **{'%s__%s' % (column, search): term})
+                except FieldError as e:
+                    logger.debug('Unable to search choices of %s: %s',
+                                 column, e)
+                    return {'results': [], 'more': False}
+            # one more row than the page size tells whether there are more
+            results = self.to_results(
+                choices[offset:offset + size + 1], field_label)
+        return {'results': results[:size], 'more': len(results) > size}
+
+
+class GetFieldChoicesBatch(GetFieldChoices):
+    """
+    A JSONResponse view that returns the choices of several fields of a
+    model in a single response, as GetFieldChoices would for each of them.
+
+    The "fields" GET parameter is a comma separated list of field paths
+    (with an optional "|label" suffix); the response maps each of them to
+    its list of choices. Choice lists are cached per field, shared with
+    GetFieldChoices.
+    """
+    def get(self, request, model=None):
+        fields = []
+        for field_name in request.GET.get('fields', '').split(','):
+            if field_name and field_name not in fields:
+                fields.append(field_name)
+        if model is None or not fields:
+            return self.render_json_response(
+                {'error': "GetFieldChoicesBatch view requires a model and "
+                          "a fields parameter"}, status=400)
+        for field_name in fields:
+            try:
+                self.resolve_field(model, field_name)
+            except InvalidField as e:
+                return self.render_json_response(
+                    {'error': force_text(e)}, status=400)
 
-        results = [{'id': c[0], 'text': force_text(c[1])} for c in sorted(
-                   choices, key=itemgetter(0))]
+        timeout = getattr(
+            settings, 'ADVANCED_FILTERS_CHOICES_CACHE_TIMEOUT', 3600)
+        if not timeout:
+            results = {}
+            for field_name in fields:
+                model_obj, field, field_label = self.resolve_field(
+                    model, field_name)
+                results[field_name] = self.get_choices(
+                    model_obj, field, field_label)
+            return self.render_json_response({'results': results})
 
-        return self.render_json_response({'results': results})
+        results = {}
+        digests = []
+        modified = 0
+        for field_name in fields:
+            key, (payload, timestamp) = self.cached_choices(
+                model, field_name, timeout)
+            results[field_name] = payload['results']
+            digests.append(key.rsplit(':', 1)[-1])
+            modified = max(modified, timestamp)
+        etag = hashlib.sha1(':'.join(digests).encode('utf-8')).hexdigest()
+        return self.conditional_response(
+            request, etag, modified, lambda: {'results': results})
+
+
+class GetFieldTree(CsrfExemptMixin, StaffuserRequiredMixin,
+                   JSONResponseMixin, View):
+    """
+    A JSONResponse view that lists the fields of the relation at the "path"
+    GET parameter (or of the model itself, without it), for models whose
+    ModelAdmin sets advanced_filter_fields = '__all__'.
+
+    Each result holds the field path ("id"), its verbose name ("text") and
+    whether it is a relation that can be expanded in turn ("relation").
+    """
+    def get(self, request, model=None):
+        if model is None:
+            return self.render_json_response(
+                {'error': "GetFieldTree view requires a model"}, status=400)
+        try:
+            model_obj = apps.get_model(*model.split('.', 1))
+        except (LookupError, ValueError) as e:
+            logger.debug("Invalid kwargs passed to view: %s", e)
+            return self.render_json_response(
+                {'error': force_text(e)}, status=400)
+        tree = FieldTree.for_admin(admin.site._registry.get(model_obj))
+        if tree is None:
+            return self.render_json_response(
+                {'error': "Fields of %s are not discoverable" % model},
+                status=400)
+        path = request.GET.get('path', '')
+        children = tree.children(path)
+        if children is None:
+            return self.render_json_response(
+                {'error': "Field path can not be expanded: %s" % path},
+                status=400)
+        return self.render_json_response({'results': [
+            {'id': child, 'text': capfirst(name), 'relation': expandable}
+            for child, name, expandable in children]})
+
+
+class ExportFilterResults(StaffuserRequiredMixin, View):
+    """
+    Stream the results of a stored AdvancedFilter as CSV or JSON lines.
+
+    Accepts the optional GET parameters "format" (csv/jsonl), "fields"
+    (comma separated field paths) and "chunk_size". Fields are limited to
+    the editable concrete fields of the model and the paths its ModelAdmin
+    exposes to advanced filters, rows to those of its ModelAdmin queryset.
+    """
+    def get_filter(self, request, pk):
+        filters = AdvancedFilter.objects.all()
+        if not request.user.is_superuser:
+            filters = AdvancedFilter.objects.filter_by_user(request.user)
+        advfilter = get_object_or_404(filters.distinct(), pk=pk)
+        opts = advfilter.model_class._meta
+        perms = ['%s.%s_%s' % (opts.app_label, action, opts.model_name)
+                 for action in ('view', 'change')]
+        if not any(request.user.has_perm(perm) for perm in perms):
+            raise Http404('No permission to view %s' % opts.verbose_name)
+        return advfilter
+
+    def get(self, request, pk):
+        advfilter = self.get_filter(request, pk)
+        export_format = request.GET.get('format', 'csv')
+        fields = [f for f in request.GET.get('fields', '').split(',') if f]
+        model = advfilter.model_class
+        model_admin = admin.site._registry.get(model)
+        allowed = exportable_fields(model, model_admin)
+        queryset = None
+        if model_admin is not None:
+            queryset = model_admin.get_queryset(request)
+        try:
+            chunk_size = int(request.GET.get('chunk_size', DEFAULT_CHUNK_SIZE))
+            chunks, content_type = export_filter(
+                advfilter, fields, export_format, chunk_size, allowed,
+                queryset)
+        except ValueError as e:
+            return HttpResponseBadRequest(force_text(e))
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            'advanced-filter-%s' % advfilter.pk, export_format)
+        return response
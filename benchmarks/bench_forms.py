@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of building an AdvancedFilterForm for a stored filter of
+200 rows, with every form of the formset building its own field choices
+(as before they were shared) and with shared choices.
+
+Run from the repository root:
+
+    python benchmarks/bench_forms.py [--number N] [--rows N]
+"""
+import argparse
+import os
+import sys
+import timeit
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.test_project.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db.models import Q  # noqa: E402
+
+from advanced_filters.forms import (  # noqa: E402
+    AdvancedFilterForm, AdvancedFilterFormSet)
+from advanced_filters.models import AdvancedFilter  # noqa: E402
+
+FIELDS = ['language', 'first_name', 'last_name', 'email', 'is_active',
+          'date_joined', 'assigned_to__email', 'assigned_to__username',
+          'assigned_to__groups__name', ('assigned_to__email', 'Sales Rep.')]
+
+
+def stored_filter(rows):
+    paths = [f for f in FIELDS if not isinstance(f, tuple)]
+    query = Q()
+    for i in range(rows):
+        query &= Q(**{'%s__icontains' % paths[i % len(paths)]: 'v%d' % i})
+    advfilter = AdvancedFilter(model='customers.Client')
+    advfilter.query = query
+    return advfilter
+
+
+def bench(advfilter, number, shared=True):
+    """ The average time (in seconds) to build the form and its formset """
+    def build():
+        form = AdvancedFilterForm(instance=advfilter, filter_fields=FIELDS)
+        return form.fields_formset.forms
+
+    build()  # warm up the query cache
+    if shared:
+        return timeit.timeit(build, number=number) / number
+
+    get_form_kwargs = AdvancedFilterFormSet.get_form_kwargs
+
+    def unshared_kwargs(formset, index):
+        kwargs = get_form_kwargs(formset, index)
+        kwargs['field_choices'] = None  # every form builds its own
+        return kwargs
+
+    with patch.object(AdvancedFilterFormSet, 'get_form_kwargs',
+                      unshared_kwargs):
+        return timeit.timeit(build, number=number) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=200)
+    args = parser.parse_args()
+
+    advfilter = stored_filter(args.rows)
+    print('%-26s %12s' % ('field choices', 'form build'))
+    for label, shared in (('per form (baseline)', False), ('shared', True)):
+        print('%-26s %9.3f ms' % (
+            label, bench(advfilter, args.number, shared) * 1000))
+
+
+if __name__ == '__main__':
+    main()
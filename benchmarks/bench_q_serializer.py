@@ -0,0 +1,141 @@
+"""
+Micro-benchmarks of advanced_filters.q_serializer.QSerializer against the
+previous (recursive, mutating) implementation on flat, deep and wide trees.
+
+Run from the repository root:
+
+    python benchmarks/bench_q_serializer.py [--number N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.db.models import Q  # noqa: E402
+
+from advanced_filters.q_serializer import QSerializer  # noqa: E402
+
+
+class LegacyQSerializer(QSerializer):
+    """ The recursive implementation QSerializer shipped before """
+    def serialize(self, q):
+        children = []
+        for child in q.children:
+            if isinstance(child, Q):
+                children.append(self.serialize(child))
+            else:
+                children.append(child)
+        serialized = q.__dict__
+        serialized['children'] = children
+        return serialized
+
+    def deserialize(self, d):
+        children = []
+        for child in d.pop('children'):
+            if isinstance(child, dict):
+                children.append(self.deserialize(child))
+            else:
+                children.append(self.prepare_value(child))
+        query = Q()
+        query.children = children
+        query.connector = d['connector']
+        query.negated = d['negated']
+        return query
+
+    def get_field_values_list(self, d):
+        fields = []
+        children = d.get('children', [])
+        for child in children:
+            if isinstance(child, dict):
+                fields.extend(self.get_field_values_list(child))
+            else:
+                f = {'field': child[0], 'value': child[1]}
+                if self._is_range(child):
+                    f['value_from'] = child[1][0]
+                    f['value_to'] = child[1][1]
+                f['negate'] = d.get('negated', False)
+                fields.append(f)
+            if d['connector'] == 'OR' and children[-1] != child:
+                fields.append({'field': '_OR', 'value': 'null'})
+        return fields
+
+
+def flat_tree(size=20):
+    return Q(**dict(('field%d__iexact' % i, 'value %d' % i)
+                    for i in range(size)))
+
+
+def wide_tree(size=5000):
+    query = Q()
+    query.connector = Q.OR
+    query.children = [Q(('field%d__iexact' % i, i), ('other%d' % i, i))
+                      for i in range(size)]
+    return query
+
+
+def deep_tree(depth=2000):
+    query = Q(leaf=0)
+    for i in range(depth):
+        node = Q()
+        node.connector = Q.OR if i % 2 else Q.AND
+        node.children = [('field%d' % i, i), query]
+        query = node
+    return query
+
+
+TREES = [
+    ('flat (20 lookups)', flat_tree),
+    ('wide (5000 nodes)', wide_tree),
+    ('deep (2000 levels)', deep_tree),
+]
+
+
+def bench(serializer, factory, number):
+    """
+    Return the average time (in seconds) of serialize, deserialize and
+    get_field_values_list, or None where the implementation fails.
+    """
+    # the legacy implementation mutates its input: give every run a fresh
+    # tree, built outside of the timed section
+    reference = QSerializer()
+    trees = [factory() for _ in range(number)]
+    dicts = [reference.serialize(tree) for tree in trees]
+    serialized = reference.serialize(trees[0])
+    results = {}
+    for name, func, args in (
+            ('serialize', serializer.serialize, trees),
+            ('deserialize', serializer.deserialize, dicts),
+            ('field_values', serializer.get_field_values_list,
+             [serialized] * number)):
+        it = iter(args)
+        try:
+            results[name] = timeit.timeit(lambda: func(next(it)),
+                                          number=number) / number
+        except RecursionError:
+            results[name] = None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    print('%-20s %-13s %15s %12s' % ('tree', 'operation', 'legacy', 'current'))
+    for label, factory in TREES:
+        legacy = bench(LegacyQSerializer(), factory, args.number)
+        current = bench(QSerializer(), factory, args.number)
+        for operation in ('serialize', 'deserialize', 'field_values'):
+            print('%-20s %-13s %15s %12s' % (
+                label, operation, _ms(legacy[operation]),
+                _ms(current[operation])))
+
+
+def _ms(seconds):
+    return 'RecursionError' if seconds is None else '%.3f ms' % (seconds * 1000)
+
+
+if __name__ == '__main__':
+    main()